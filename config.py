@@ -9,6 +9,23 @@ import sys
 import uuid
 from ConfigParser import NoOptionError
 
+# Bit value syntax accepted by strtod()
+BITRATE = re.compile(r'^(\d+)(?:([yzafpnumcdhkKMGTPEZY])(i)?)?([Bb])?$')
+
+BIT_PREFIXES = {'y': -24, 'z': -21, 'a': -18, 'f': -15, 'p': -12,
+                'n': -9,  'u': -6,  'm': -3,  'c': -2,  'd': -1,
+                'h': 2,   'k': 3,   'K': 3,   'M': 6,   'G': 9,
+                'T': 12,  'P': 15,  'E': 18,  'Z': 21,  'Y': 24}
+
+DEFAULT_TMPL = '%(video_codec)s %(video_fps)s %(video_br)s %(max_video_br)s \
+            %(buff_size)s %(aspect_ratio)s %(audio_br)s \
+            %(audio_fr)s %(audio_ch)s %(audio_codec)s %(audio_lang)s \
+            %(ffmpeg_pram)s %(format)s'
+
+profiles = {}  # Compiled TiVoProfiles, by TSN
+resolved = {}  # Raw settings for each TSN, see resolve()
+generation = 0  # Bumped whenever the settings may have changed
+
 class Bdict(dict):
     def getboolean(self, x):
         return self.get(x, 'False').lower() in ('1', 'yes', 'true', 'on')
@@ -44,8 +61,12 @@ def reset():
     global config
     global configs_found
     global tivos_found
+    global generation
 
     bin_paths = {}
+    profiles.clear()
+    resolved.clear()
+    generation += 1
 
     config = ConfigParser.ConfigParser()
     configs_found = config.read(config_files)
@@ -65,10 +86,142 @@ def reset():
         if not config.has_section(section):
             config.add_section(section)
 
+    # Compile the known TiVos up front; anything else (including bad
+    # values here) is dealt with on first lookup.
+    for tsn in [None] + tivos.keys():
+        try:
+            get_profile(tsn)
+        except Exception, msg:
+            logging.getLogger('pyTivo.config').error(
+                'Bad settings for TiVo %s: %s' % (tsn, msg))
+
 def write():
+    global generation
     f = open(configs_found[-1], 'w')
     config.write(f)
     f.close()
+    profiles.clear()
+    resolved.clear()
+    generation += 1
+
+class TiVoProfile(object):
+    """ The settings for one TiVo, resolved through _tivo_<tsn>,
+        _tivo_SD/_tivo_HD and [Server] once, with bitrates and sizes
+        already parsed. Built by get_profile(), and thrown away by
+        reset() or write().
+
+    """
+    def __init__(self, tsn=None):
+        self.tsn = tsn
+        self.is_hd = isHDtivo(tsn)
+        self.ts_capable = is_ts_capable(tsn)
+        self.section = get_section(tsn)
+        self.values = resolve(tsn)
+
+        sections = ['Server', self.section]
+        if tsn:
+            sections.append('_tivo_' + tsn)
+
+        # Each value falls back to its default on its own if it can't
+        # be parsed, so one typo doesn't take the rest down with it
+        self.height = self._parse('height',
+                                  lambda x: nearestTivoHeight(int(x)),
+                                  [480, 1080][self.is_hd])
+        self.width = self._parse('width', lambda x: nearestTivoWidth(int(x)),
+                                 [544, 1920][self.is_hd])
+
+        # convert to non-zero multiple of 64 for ffmpeg compatibility
+        self.max_audio_br = self._parse('max_audio_br', _trunc64, 448)
+        # compare audio_br to max_audio_br and return lowest
+        self.audio_br = str(min(self._parse('audio_br', _trunc64, 448),
+                                self.max_audio_br)) + 'k'
+
+        self.video_br = self._parse('video_br', _k,
+                                    ['4096K', '16384K'][self.is_hd])
+        self.video_bps = strtod(self.video_br)
+
+        self.max_video_br = self._parse('max_video_br', _k, '30000k')
+        self.max_video_bps = strtod(self.max_video_br)
+
+        default = strtod(['1536K', '4096K'][self.is_hd])
+        self.min_video_bps = self._parse('min_video_br',
+                                         lambda x: strtod(_k(x)), default)
+
+        self.buff_size = self._parse('bufsize', _k,
+                                     ['1024k', '4096k'][self.is_hd])
+
+        self.ffmpeg_tmpl = self.get('ffmpeg_tmpl', True) or DEFAULT_TMPL
+        self.ffmpeg_pram = self.get('ffmpeg_pram', True)
+
+        self.optres = False
+        for section in reversed(sections):
+            try:
+                self.optres = config.getboolean(section, 'optres')
+                break
+            except:
+                pass
+
+        self.adaptive = False
+        for section in reversed(sections):
+            try:
+                self.adaptive = config.getboolean(section, 'adaptive_bitrate')
+                break
+            except:
+                pass
+
+    def get(self, name, raw=False):
+        return self.values.get((name, raw))
+
+    def _parse(self, name, parse, default):
+        """ parse() of the named setting, or default if it's unset or
+            bad (which is logged).
+
+        """
+        value = self.get(name)
+        if not value:
+            return default
+        try:
+            return parse(value)
+        except Exception, msg:
+            logging.getLogger('pyTivo.config').error(
+                'Bad %s for TiVo %s: %s (%s)' % (name, self.tsn, value, msg))
+            return default
+
+def resolve(tsn=None):
+    """ The raw settings for one TiVo, by (name, raw): _tivo_<tsn>
+        overrides _tivo_SD/_tivo_HD, which overrides [Server], but
+        only with values that can be read, just as get_tsn() always
+        did. Kept apart from TiVoProfile, so that plain lookups never
+        depend on the parsed values.
+
+    """
+    try:
+        return resolved[tsn]
+    except KeyError:
+        pass
+    sections = ['Server', get_section(tsn)]
+    if tsn:
+        sections.append('_tivo_' + tsn)
+    values = {}
+    for section in sections:
+        if not config.has_section(section):
+            continue
+        for name in config.options(section):
+            for raw in (False, True):
+                try:
+                    values[(name, raw)] = config.get(section, name, raw)
+                except:
+                    pass
+    resolved[tsn] = values
+    return values
+
+def get_profile(tsn=None):
+    try:
+        return profiles[tsn]
+    except KeyError:
+        profile = TiVoProfile(tsn)
+        profiles[tsn] = profile
+        return profile
 
 def tivos_by_ip(tivoIP):
     for key, value in tivos.items():
@@ -200,16 +353,7 @@ def getDebug():
         return False
 
 def getOptres(tsn=None):
-    try:
-        return config.getboolean('_tivo_' + tsn, 'optres')
-    except:
-        try:
-            return config.getboolean(get_section(tsn), 'optres')
-        except:
-            try:
-                return config.getboolean('Server', 'optres')
-            except:
-                return False
+    return get_profile(tsn).optres
 
 def get_bin(fname):
     global bin_paths
@@ -248,17 +392,112 @@ def getFFmpegWait():
     else:
         return 0
 
+def getSpoolPath():
+    return get_server('spool_path')
+
+def getSpoolSize():
+    """ Transcode spool budget, in bytes (set in MB) """
+    try:
+        return int(float(get_server('spool_size', 4096)) * 1024 * 1024)
+    except ValueError:
+        return 4096 * 1024 * 1024
+
+def getSpoolKeep():
+    try:
+        return config.getboolean('Server', 'spool_keep')
+    except:
+        return False
+
+def getMp4RemuxStream():
+    try:
+        return config.getboolean('Server', 'mp4_remux_stream')
+    except:
+        return False
+
+def getPushWorkers():
+    """ Threads preparing pushes (probing, metadata, MP4 remuxes) """
+    try:
+        return max(int(get_server('push_workers', 2)), 1)
+    except ValueError:
+        return 2
+
+def getSpeculativeStart():
+    try:
+        return config.getboolean('Server', 'speculative_start')
+    except:
+        return True
+
+def getTogoDownloads():
+    """ ToGo downloads run at once, from all TiVos together """
+    try:
+        return max(int(get_server('togo_downloads', 2)), 1)
+    except ValueError:
+        return 2
+
+def getTogoTivoDownloads():
+    """ ToGo downloads run at once from any one TiVo """
+    try:
+        return max(int(get_server('togo_tivo_downloads', 1)), 1)
+    except ValueError:
+        return 1
+
+def getTivoIndexPath():
+    """ File the .tivo details index is kept in; '' for memory only """
+    return get_server('tivo_index',
+                      os.path.join(os.path.dirname(__file__),
+                                   '.pyTivo-tivo-index'))
+
+def getPretranscodePath():
+    return get_server('pretranscode_path')
+
+def getPretranscodeSize():
+    """ Pre-transcode cache budget, in bytes (set in MB) """
+    try:
+        return int(float(get_server('pretranscode_size', 20480)) *
+                   1024 * 1024)
+    except ValueError:
+        return 20480 * 1024 * 1024
+
+def getPretranscodeMinutes():
+    """ How much of each file to pre-transcode; 0 for all of it """
+    try:
+        return max(int(get_server('pretranscode_minutes', 0)), 0)
+    except ValueError:
+        return 0
+
+def getParallelSegments(default=1):
+    """ How many pieces to split background transcodes into """
+    try:
+        return max(int(get_server('parallel_segments', default)), 1)
+    except ValueError:
+        return default
+
+def getTranscodeBuffer():
+    """ Size of each transcode's ring buffer, in bytes (set in KB) """
+    try:
+        return int(float(get_server('transcode_buffer', 8192)) * 1024)
+    except ValueError:
+        return 8192 * 1024
+
+def getTranscodePrebuffer():
+    """ Output to collect before sending any, in bytes (set in KB) """
+    try:
+        return int(float(get_server('transcode_prebuffer', 512)) * 1024)
+    except ValueError:
+        return 512 * 1024
+
+def getTranscodeSlots(default=1):
+    """ Most encoders to run at once (default: one per core) """
+    try:
+        return max(int(get_server('transcode_slots', default)), 1)
+    except ValueError:
+        return default
+
 def getFFmpegTemplate(tsn):
-    tmpl = get_tsn('ffmpeg_tmpl', tsn, True)
-    if tmpl:
-        return tmpl
-    return '%(video_codec)s %(video_fps)s %(video_br)s %(max_video_br)s \
-            %(buff_size)s %(aspect_ratio)s %(audio_br)s \
-            %(audio_fr)s %(audio_ch)s %(audio_codec)s %(audio_lang)s \
-            %(ffmpeg_pram)s %(format)s'
+    return get_profile(tsn).ffmpeg_tmpl
 
 def getFFmpegPrams(tsn):
-    return get_tsn('ffmpeg_pram', tsn, True)
+    return get_profile(tsn).ffmpeg_pram
 
 def isHDtivo(tsn):  # tsn's of High Definition Tivo's
     return bool(tsn and tsn[0] >= '6' and tsn[:3] != '649')
@@ -298,88 +537,50 @@ def nearestTivoWidth(width):
     return nearest(width, getValidWidths())
 
 def getTivoHeight(tsn):
-    height = get_tsn('height', tsn)
-    if height:
-        return nearestTivoHeight(int(height))
-    return [480, 1080][isHDtivo(tsn)]
+    return get_profile(tsn).height
 
 def getTivoWidth(tsn):
-    width = get_tsn('width', tsn)
-    if width:
-        return nearestTivoWidth(int(width))
-    return [544, 1920][isHDtivo(tsn)]
+    return get_profile(tsn).width
 
 def _trunc64(i):
     return max(int(strtod(i)) / 64000, 1) * 64
 
 def getAudioBR(tsn=None):
-    rate = get_tsn('audio_br', tsn)
-    if not rate:
-        rate = '448k'
-    # convert to non-zero multiple of 64 to ensure ffmpeg compatibility
-    # compare audio_br to max_audio_br and return lowest
-    return str(min(_trunc64(rate), getMaxAudioBR(tsn))) + 'k'
+    return get_profile(tsn).audio_br
 
 def _k(i):
     return str(int(strtod(i)) / 1000) + 'k'
 
 def getVideoBR(tsn=None):
-    rate = get_tsn('video_br', tsn)
-    if rate:
-        return _k(rate)
-    return ['4096K', '16384K'][isHDtivo(tsn)]
+    return get_profile(tsn).video_br
 
 def getMaxVideoBR(tsn=None):
-    rate = get_tsn('max_video_br', tsn)
-    if rate:
-        return _k(rate)
-    return '30000k'
+    return get_profile(tsn).max_video_br
 
 def getBuffSize(tsn=None):
-    size = get_tsn('bufsize', tsn)
-    if size:
-        return _k(size)
-    return ['1024k', '4096k'][isHDtivo(tsn)]
+    return get_profile(tsn).buff_size
 
 def getMaxAudioBR(tsn=None):
-    rate = get_tsn('max_audio_br', tsn)
-    # convert to non-zero multiple of 64 for ffmpeg compatibility
-    if rate:
-        return _trunc64(rate)
-    return 448
+    return get_profile(tsn).max_audio_br
 
 def get_section(tsn):
     return ['_tivo_SD', '_tivo_HD'][isHDtivo(tsn)]
 
 def get_tsn(name, tsn=None, raw=False):
-    try:
-        return config.get('_tivo_' + tsn, name, raw)
-    except:
-        try:
-            return config.get(get_section(tsn), name, raw)
-        except:
-            try:
-                return config.get('Server', name, raw)
-            except:
-                return None
+    return resolve(tsn).get((name, raw))
 
 # Parse a bitrate using the SI/IEEE suffix values as if by ffmpeg
 # For example, 2K==2000, 2Ki==2048, 2MB==16000000, 2MiB==16777216
 # Algorithm: http://svn.mplayerhq.hu/ffmpeg/trunk/libavcodec/eval.c
 def strtod(value):
-    prefixes = {'y': -24, 'z': -21, 'a': -18, 'f': -15, 'p': -12,
-                'n': -9,  'u': -6,  'm': -3,  'c': -2,  'd': -1,
-                'h': 2,   'k': 3,   'K': 3,   'M': 6,   'G': 9,
-                'T': 12,  'P': 15,  'E': 18,  'Z': 21,  'Y': 24}
-    p = re.compile(r'^(\d+)(?:([yzafpnumcdhkKMGTPEZY])(i)?)?([Bb])?$')
-    m = p.match(value)
+    m = BITRATE.match(value)
     if not m:
         raise SyntaxError('Invalid bit value syntax')
     (coef, prefix, power, byte) = m.groups()
     if prefix is None:
         value = float(coef)
     else:
-        exponent = float(prefixes[prefix])
+        exponent = float(BIT_PREFIXES[prefix])
         if power == 'i':
             # Use powers of 2
             value = float(coef) * pow(2.0, exponent / 0.3)
@@ -0,0 +1,368 @@
+import cookielib
+import hashlib
+import httplib
+import logging
+import os
+import select
+import socket
+import threading
+import time
+import urllib2
+import urlparse
+from cStringIO import StringIO
+
+logger = logging.getLogger('pyTivo.httpclient')
+
+IDLE_TIMEOUT = 30   # seconds an unused connection is kept; TiVos drop
+                    # them not long after this
+MAX_IDLE = 4        # unused connections kept per host
+MAX_REDIRECTS = 5
+
+# Failures that mean a kept-alive connection was closed at the far end
+STALE = (httplib.BadStatusLine, httplib.CannotSendRequest, socket.error)
+
+# Requests that can safely be sent twice
+IDEMPOTENT = ('GET', 'HEAD')
+
+class ConnectionPool(object):
+    """ Persistent HTTP and HTTPS connections, kept per (scheme, host,
+        port) between requests so that each one doesn't cost a new TCP
+        connection and TLS handshake. A connection is only returned to
+        the pool once its response has been read to the end. Shared by
+        all Clients, since connections carry no cookie or login state.
+
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.idle = {}   # (scheme, host, port) -> [(time, connection)]
+        self.hosts = {}  # host:port -> counters, see stats()
+
+    def get(self, scheme, host, port):
+        """ Returns (connection, reused). """
+        key = (scheme, host, port)
+        now = time.time()
+        self.lock.acquire()
+        try:
+            conns = self.idle.get(key, [])
+            while conns:
+                when, conn = conns.pop()
+                if when + IDLE_TIMEOUT > now and not closed(conn):
+                    return conn, True
+                conn.close()
+        finally:
+            self.lock.release()
+        if scheme == 'https':
+            conn = httplib.HTTPSConnection(host, port)
+        else:
+            conn = httplib.HTTPConnection(host, port)
+        return conn, False
+
+    def put(self, scheme, conn):
+        key = (scheme, conn.host, conn.port)
+        self.lock.acquire()
+        try:
+            conns = self.idle.setdefault(key, [])
+            conns.append((time.time(), conn))
+            while len(conns) > MAX_IDLE:
+                conns.pop(0)[1].close()
+        finally:
+            self.lock.release()
+
+    def count(self, host, reused, rtt=None, retry=False):
+        self.lock.acquire()
+        try:
+            h = self.hosts.setdefault(host, {'requests': 0, 'opened': 0,
+                                             'reused': 0, 'retries': 0,
+                                             'rtt': 0.0})
+            if retry:
+                h['retries'] += 1
+            else:
+                h['requests'] += 1
+                h[reused and 'reused' or 'opened'] += 1
+                h['rtt'] += rtt
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        self.lock.acquire()
+        try:
+            return dict([(host, dict(h)) for host, h in self.hosts.items()])
+        finally:
+            self.lock.release()
+
+    def log_stats(self):
+        for host, h in sorted(self.stats().items()):
+            h['host'] = host
+            h['avg'] = h['rtt'] * 1000 / max(h['requests'], 1)
+            logger.info(('%(host)s: %(requests)d requests, %(opened)d ' +
+                         'connections opened, %(reused)d reused, ' +
+                         '%(retries)d retried; round trip %(avg).0f ms ' +
+                         'average') % h)
+
+def closed(conn):
+    """ Whether an idle connection has been closed at the far end (it
+        reads as ready, with EOF), so it's not worth sending on.
+
+    """
+    if not conn.sock:
+        return True
+    try:
+        return bool(select.select([conn.sock], [], [], 0)[0])
+    except (select.error, socket.error, ValueError):
+        return True
+
+pool = ConnectionPool()
+
+class Response(object):
+    """ A response, read like the file urllib2 returns. The connection
+        goes back to the pool when the body has been read to the end,
+        or is dropped if the response is closed before then.
+
+    """
+    def __init__(self, client, url, scheme, conn, response):
+        self.client = client
+        self.url = url
+        self.scheme = scheme
+        self.conn = conn
+        self.response = response
+        self.code = response.status
+        self.msg = response.reason
+        self.headers = response.msg
+
+    def read(self, amt=None):
+        if not self.conn:
+            return ''
+        try:
+            if amt is None:
+                data = self.response.read()
+            else:
+                data = self.response.read(amt)
+        except:
+            self._release(False)
+            raise
+        if self.response.isclosed():
+            # httplib doesn't complain if the body is cut short
+            if not data and amt and self.response.length:
+                self._release(False)
+                raise httplib.IncompleteRead(data, self.response.length)
+            self._release(True)
+        return data
+
+    def info(self):
+        return self.headers
+
+    def geturl(self):
+        return self.url
+
+    def getcode(self):
+        return self.code
+
+    def close(self):
+        if self.conn:
+            self._release(self.response.isclosed())
+
+    def _release(self, finished):
+        conn, self.conn = self.conn, None
+        if finished and not self.response.will_close:
+            pool.put(self.scheme, conn)
+        else:
+            conn.close()
+
+class Client(object):
+    """ Makes requests through the shared ConnectionPool, with its own
+        cookies and passwords. Digest challenges are remembered per
+        host, so later requests answer them up front (reusing the nonce
+        with a rising nonce count) instead of taking a 401 round trip
+        each time; a new challenge, or a stale nonce, is answered and
+        the request retried. Failures come back as urllib2.HTTPError,
+        as from a urllib2 opener.
+
+    """
+    def __init__(self, headers=None):
+        self.cookies = cookielib.CookieJar()
+        self.passwords = urllib2.HTTPPasswordMgrWithDefaultRealm()
+        self.headers = dict(headers or {})
+        self.lock = threading.Lock()
+        self.challenges = {}  # host:port -> digest challenge dict
+
+    def add_password(self, realm, uri, user, passwd):
+        self.passwords.add_password(realm, uri, user, passwd)
+
+    def open(self, url, data=None, headers=None):
+        """ GET url (or POST data to it), following redirects, and
+            return a Response.
+
+        """
+        for i in xrange(MAX_REDIRECTS + 1):
+            response = self._open(url, data, headers or {})
+            if response.code not in (301, 302, 303, 307):
+                break
+            location = response.info().getheader('Location')
+            response.read()
+            if not location:
+                break
+            url = urlparse.urljoin(url, location)
+            if response.code != 307:
+                data = None
+        if response.code >= 400:
+            body = response.read()
+            raise urllib2.HTTPError(url, response.code, response.msg,
+                                    response.info(), StringIO(body))
+        return response
+
+    def _open(self, url, data, headers):
+        scheme, netloc, path, params, query, frag = urlparse.urlparse(url)
+        host, port = urllib2.splitport(netloc)
+        port = port and int(port) or (scheme == 'https' and 443 or 80)
+        hostport = '%s:%d' % (host, port)
+        selector = urlparse.urlunparse(('', '', path or '/', params, query, ''))
+        method = data is None and 'GET' or 'POST'
+        challenged = False
+
+        while True:
+            req = urllib2.Request(url, data)
+            for name, value in self.headers.items() + headers.items():
+                req.add_header(name, value)
+            if data is not None and not req.has_header('Content-type'):
+                req.add_header('Content-type',
+                               'application/x-www-form-urlencoded')
+            self.cookies.add_cookie_header(req)
+            auth = self._authorization(hostport, method, selector, url)
+            if auth:
+                req.add_header('Authorization', auth)
+            sendheaders = dict(req.header_items())
+
+            response, conn = self._send(scheme, host, port, hostport,
+                                        method, selector, data, sendheaders)
+            result = Response(self, url, scheme, conn, response)
+            self.cookies.extract_cookies(result, req)
+
+            if result.code == 401 and not challenged:
+                if self._challenge(hostport, result.info(), url):
+                    challenged = True
+                    result.read()
+                    continue
+            return result
+
+    def _send(self, scheme, host, port, hostport, method, selector, data,
+              headers):
+        """ Send a request, on a pooled connection if there is one. If
+            the far end has closed a pooled connection, try again on a
+            new one -- but a POST only if it failed while being sent,
+            since once it's out the server may have acted on it.
+
+        """
+        while True:
+            conn, reused = pool.get(scheme, host, port)
+            start = time.time()
+            sent = False
+            try:
+                conn.request(method, selector, data, headers)
+                sent = True
+                response = conn.getresponse()
+            except STALE, msg:
+                conn.close()
+                if reused and (method in IDEMPOTENT or not sent):
+                    pool.count(hostport, reused, retry=True)
+                    continue
+                if isinstance(msg, httplib.HTTPException):
+                    raise urllib2.URLError(msg)
+                raise
+            except:
+                conn.close()
+                raise
+            pool.count(hostport, reused, time.time() - start)
+            return response, conn
+
+    def _challenge(self, hostport, headers, url):
+        """ Take in a WWW-Authenticate header. Returns True if it's
+            worth asking again.
+
+        """
+        for value in headers.getheaders('WWW-Authenticate'):
+            scheme, _, rest = value.strip().partition(' ')
+            scheme = scheme.lower()
+            if scheme == 'digest':
+                challenge = urllib2.parse_keqv_list(
+                    urllib2.parse_http_list(rest))
+                challenge['scheme'] = 'digest'
+                challenge['nc'] = 0
+            elif scheme == 'basic':
+                challenge = {'scheme': 'basic'}
+                for item in urllib2.parse_http_list(rest):
+                    if item.lower().startswith('realm='):
+                        challenge.update(urllib2.parse_keqv_list([item]))
+            else:
+                continue
+            user, pw = self.passwords.find_user_password(
+                challenge.get('realm'), url)
+            if user is None:
+                return False
+            self.lock.acquire()
+            try:
+                self.challenges[hostport] = challenge
+            finally:
+                self.lock.release()
+            return True
+        return False
+
+    def _authorization(self, hostport, method, selector, url):
+        self.lock.acquire()
+        try:
+            challenge = self.challenges.get(hostport)
+            if not challenge:
+                return None
+            user, pw = self.passwords.find_user_password(
+                challenge.get('realm'), url)
+            if user is None:
+                return None
+            if challenge['scheme'] == 'basic':
+                return 'Basic ' + ('%s:%s' % (user, pw)).encode('base64'
+                                                                 ).strip()
+            challenge['nc'] += 1
+            nc = '%08x' % challenge['nc']
+        finally:
+            self.lock.release()
+        return digest(challenge, user, pw, method, selector, nc)
+
+    def stats(self):
+        return pool.stats()
+
+def digest(challenge, user, pw, method, uri, nc):
+    """ The Authorization header answering a digest challenge (RFC
+        2617), for MD5 or SHA with qop auth or none.
+
+    """
+    realm = challenge['realm']
+    nonce = challenge['nonce']
+    qop = challenge.get('qop')
+    algorithm = challenge.get('algorithm', 'MD5')
+    if algorithm.upper() == 'SHA':
+        H = lambda x: hashlib.sha1(x).hexdigest()
+    else:
+        H = lambda x: hashlib.md5(x).hexdigest()
+
+    ha1 = H('%s:%s:%s' % (user, realm, pw))
+    ha2 = H('%s:%s' % (method, uri))
+    fields = ['username="%s"' % user, 'realm="%s"' % realm,
+              'nonce="%s"' % nonce, 'uri="%s"' % uri]
+    if qop:
+        if 'auth' not in [q.strip() for q in qop.split(',')]:
+            return None
+        cnonce = os.urandom(8).encode('hex')
+        response = H('%s:%s:%s:%s:auth:%s' % (ha1, nonce, nc, cnonce, ha2))
+        fields += ['qop=auth', 'nc=%s' % nc, 'cnonce="%s"' % cnonce]
+    else:
+        response = H('%s:%s:%s' % (ha1, nonce, ha2))
+    fields.append('response="%s"' % response)
+    if 'opaque' in challenge:
+        fields.append('opaque="%s"' % challenge['opaque'])
+    if 'algorithm' in challenge:
+        fields.append('algorithm=%s' % algorithm)
+    return 'Digest ' + ', '.join(fields)
+
+def stats():
+    return pool.stats()
+
+def log_stats():
+    pool.log_stats()
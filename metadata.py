@@ -1,11 +1,12 @@
 #!/usr/bin/env python
 
+import cPickle
 import hashlib
 import logging
 import os
-import struct
 import subprocess
 import sys
+import threading
 from datetime import datetime
 from xml.dom import minidom
 from xml.parsers import expat
@@ -19,7 +20,7 @@ from lrucache import LRUCache
 
 import config
 import plugins.video.transcode
-import turing
+import tivodecrypt
 
 # Something to strip
 TRIBUNE_CR = ' Copyright Tribune Media Services, Inc.'
@@ -52,13 +53,18 @@ GB = 1024 ** 3
 MB = 1024 ** 2
 KB = 1024
 
-tivo_cache = LRUCache(50)
 mp4_cache = LRUCache(50)
 dvrms_cache = LRUCache(50)
 nfo_cache = LRUCache(50)
 
 mswindows = (sys.platform == "win32")
 
+logger = logging.getLogger('pyTivo.metadata')
+
+TIVO_INDEX_VERSION = 1  # bump when what from_details() returns changes
+TIVO_INDEX_DELAY = 30   # seconds from a change to the index being saved
+TIVO_INDEX_SIZE = 1000  # entries kept when tivo_index is blank
+
 def get_mpaa(rating):
     return HUMAN['mpaaRating'].get(rating, 'NR')
 
@@ -81,6 +87,9 @@ def human_size(raw):
     return tsize
 
 def tag_data(element, tag):
+    if isinstance(element, dict):
+        # A flat record from stream_records()
+        return element.get(tag, '')
     for name in tag.split('/'):
         found = False
         for new_element in element.childNodes:
@@ -94,15 +103,6 @@ def tag_data(element, tag):
         return ''
     return element.firstChild.data
 
-def _vtag_data(element, tag):
-    for name in tag.split('/'):
-        new_element = element.getElementsByTagName(name)
-        if not new_element:
-            return []
-        element = new_element[0]
-    elements = element.getElementsByTagName('element')
-    return [x.firstChild.data for x in elements if x.firstChild]
-
 def _vtag_data_alternate(element, tag):
     elements = [element]
     for name in tag.split('/'):
@@ -112,11 +112,119 @@ def _vtag_data_alternate(element, tag):
         elements = new_elements
     return [x.firstChild.data for x in elements if x.firstChild]
 
-def _tag_value(element, tag):
-    item = element.getElementsByTagName(tag)
-    if item:
-        value = item[0].attributes['value'].value
-        return int(value[0])
+class _Records(object):
+    """ Pulls fields out of an XML document in one streaming pass with
+        expat, without building a DOM. Each element named record (e.g.
+        'Item') starts a flat dict, into which go:
+
+        - for each of paths (e.g. 'Details/Title', relative to the
+          record), the element's text, found as tag_data() would (the
+          first child of each name at each level);
+        - for each key, path in lists, the text of the <element>
+          children of the element at path, as a list;
+        - for each key, (within, name) in values, the 'value'
+          attribute of the first element called name under the path
+          within ('' for anywhere).
+
+        With top_paths, the same text fields are kept for the document
+        outside the records, by their paths from the root.
+
+    """
+    def __init__(self, record, paths=(), lists={}, values={}, top_paths=(),
+                 first_only=False):
+        self.record = record
+        self.paths = set(paths)
+        self.lists = dict([(path, key) for key, path in lists.items()])
+        self.values = values
+        self.top_paths = set(top_paths)
+        self.first_only = first_only
+        self.top = {}
+        self.records = []
+        self.current = None   # the record being filled, or None
+        self.stack = []       # (path, all first of their name, child counts)
+        self.depth = 0        # of the current record's element
+        self.capture = None   # (dict or list, key, text) being read
+        self.listing = None   # (key, depth) inside a lists element
+
+    def parse(self, source):
+        parser = expat.ParserCreate()
+        parser.buffer_text = True
+        parser.StartElementHandler = self.start
+        parser.EndElementHandler = self.end
+        parser.CharacterDataHandler = self.text
+        if hasattr(source, 'read'):
+            parser.ParseFile(source)
+        else:
+            parser.Parse(source, True)
+        return self.top, self.records
+
+    def start(self, name, attrs):
+        self.commit()  # text after a child isn't the first child
+        if self.stack:
+            parent_path, parent_first, counts = self.stack[-1]
+            counts[name] = counts.get(name, 0) + 1
+            first = parent_first and counts[name] == 1
+            path = parent_path and parent_path + '/' + name or name
+        else:
+            first, path = True, name
+
+        if self.current is None:
+            if name == self.record and not (self.first_only and
+                                            self.records):
+                self.current = {}
+                self.records.append(self.current)
+                self.depth = len(self.stack)
+                path, first = '', True
+            elif first and path in self.top_paths:
+                self.capture = (self.top, path, [])
+            self.stack.append((path, first, {}))
+            return
+
+        if self.listing and name == 'element':
+            self.capture = (self.current[self.listing[0]], None, [])
+        elif first and path in self.lists:
+            self.listing = (self.lists[path], len(self.stack))
+            self.current.setdefault(self.lists[path], [])
+        elif first and path in self.paths and path not in self.current:
+            self.capture = (self.current, path, [])
+        for key, (within, tag) in self.values.items():
+            if (name == tag and key not in self.current and
+                (not within or path.startswith(within + '/'))):
+                if 'value' in attrs:
+                    self.current[key] = attrs['value']
+        self.stack.append((path, first, {}))
+
+    def text(self, data):
+        if self.capture:
+            self.capture[2].append(data)
+
+    def commit(self):
+        if self.capture:
+            target, key, text = self.capture
+            self.capture = None
+            if text:
+                if key is None:
+                    target.append(''.join(text))
+                else:
+                    target[key] = ''.join(text)
+
+    def end(self, name):
+        self.commit()
+        self.stack.pop()
+        if self.listing and len(self.stack) == self.listing[1]:
+            self.listing = None
+        if self.current is not None and len(self.stack) == self.depth:
+            self.current = None
+
+def stream_records(source, record, paths=(), lists={}, values={},
+                   top_paths=(), first_only=False):
+    """ Returns (top, records) from an XML string or file in one
+        streaming pass; see _Records. The flat dicts can be given to
+        tag_data() and from_container() in place of DOM elements.
+
+    """
+    return _Records(record, paths, lists, values, top_paths,
+                    first_only).parse(source)
 
 def from_moov(full_path):
     if full_path in mp4_cache:
@@ -371,20 +479,54 @@ def basic(full_path, mtime=None):
 
     return metadata
 
+CONTAINER_KEYS = {'title': 'Title', 'episodeTitle': 'EpisodeTitle',
+                  'description': 'Description', 'programId': 'ProgramId',
+                  'seriesId': 'SeriesId', 'episodeNumber': 'EpisodeNumber',
+                  'tvRating': 'TvRating', 'displayMajorNumber': 'SourceChannel',
+                  'callsign': 'SourceStation', 'showingBits': 'ShowingBits',
+                  'mpaaRating': 'MpaaRating'}
+
+# The Item fields from_container() reads, for stream_records()
+CONTAINER_PATHS = ['Details/' + tag for tag in CONTAINER_KEYS.values()]
+
+DETAILS_ITEMS = {'description': 'program/description',
+                 'title': 'program/title',
+                 'episodeTitle': 'program/episodeTitle',
+                 'episodeNumber': 'program/episodeNumber',
+                 'programId': 'program/uniqueId',
+                 'seriesId': 'program/series/uniqueId',
+                 'seriesTitle': 'program/series/seriesTitle',
+                 'originalAirDate': 'program/originalAirDate',
+                 'isEpisode': 'program/isEpisode',
+                 'movieYear': 'program/movieYear',
+                 'partCount': 'partCount',
+                 'partIndex': 'partIndex',
+                 'time': 'time'}
+
+DETAILS_VITEMS = ['vActor', 'vChoreographer', 'vDirector',
+                  'vExecProducer', 'vProgramGenre', 'vGuestStar',
+                  'vHost', 'vProducer', 'vWriter']
+
+# key -> (where, element) for 'value' attributes in details
+DETAILS_VALUES = {'showingBits': ('', 'showingBits'),
+                  'starRating': ('program', 'starRating'),
+                  'mpaaRating': ('program', 'mpaaRating'),
+                  'tvRating': ('', 'tvRating')}
+
 def from_container(xmldoc):
-    metadata = {}
+    """ Metadata from an NPL Item: a DOM element, or a flat dict from
+        stream_records() with at least CONTAINER_PATHS.
 
-    keys = {'title': 'Title', 'episodeTitle': 'EpisodeTitle',
-            'description': 'Description', 'programId': 'ProgramId',
-            'seriesId': 'SeriesId', 'episodeNumber': 'EpisodeNumber',
-            'tvRating': 'TvRating', 'displayMajorNumber': 'SourceChannel',
-            'callsign': 'SourceStation', 'showingBits': 'ShowingBits',
-            'mpaaRating': 'MpaaRating'}
+    """
+    metadata = {}
 
-    details = xmldoc.getElementsByTagName('Details')[0]
+    if isinstance(xmldoc, dict):
+        details, prefix = xmldoc, 'Details/'
+    else:
+        details, prefix = xmldoc.getElementsByTagName('Details')[0], ''
 
-    for key in keys:
-        data = tag_data(details, keys[key])
+    for key in CONTAINER_KEYS:
+        data = tag_data(details, prefix + CONTAINER_KEYS[key])
         if data:
             if key == 'description':
                 data = data.replace(TRIBUNE_CR, '')
@@ -398,55 +540,38 @@ def from_container(xmldoc):
     return metadata
 
 def from_details(xml):
+    """ Metadata from a TiVo details document, read in one streaming
+        pass.
+
+    """
     metadata = {}
 
-    xmldoc = minidom.parseString(xml)
-    showing = xmldoc.getElementsByTagName('showing')[0]
-    program = showing.getElementsByTagName('program')[0]
-
-    items = {'description': 'program/description',
-             'title': 'program/title',
-             'episodeTitle': 'program/episodeTitle',
-             'episodeNumber': 'program/episodeNumber',
-             'programId': 'program/uniqueId',
-             'seriesId': 'program/series/uniqueId',
-             'seriesTitle': 'program/series/seriesTitle',
-             'originalAirDate': 'program/originalAirDate',
-             'isEpisode': 'program/isEpisode',
-             'movieYear': 'program/movieYear',
-             'partCount': 'partCount',
-             'partIndex': 'partIndex',
-             'time': 'time'}
+    lists = dict([(item, 'program/' + item) for item in DETAILS_VITEMS])
+    top, records = stream_records(xml, 'showing', DETAILS_ITEMS.values(),
+                                  lists, DETAILS_VALUES, first_only=True)
+    if not records:
+        raise ValueError('No showing in details')
+    showing = records[0]
 
-    for item in items:
-        data = tag_data(showing, items[item])
+    for item in DETAILS_ITEMS:
+        data = showing.get(DETAILS_ITEMS[item])
         if data:
             if item == 'description':
                 data = data.replace(TRIBUNE_CR, '')
             metadata[item] = data
 
-    vItems = ['vActor', 'vChoreographer', 'vDirector',
-              'vExecProducer', 'vProgramGenre', 'vGuestStar',
-              'vHost', 'vProducer', 'vWriter']
-
-    for item in vItems:
-        data = _vtag_data(program, item)
+    for item in DETAILS_VITEMS:
+        data = showing.get(item)
         if data:
             metadata[item] = data
 
-    sb = showing.getElementsByTagName('showingBits')
-    if sb:
-        metadata['showingBits'] = sb[0].attributes['value'].value
+    if 'showingBits' in showing:
+        metadata['showingBits'] = showing['showingBits']
 
-    #for tag in ['starRating', 'mpaaRating', 'colorCode']:
-    for tag in ['starRating', 'mpaaRating']:
-        value = _tag_value(program, tag)
-        if value:
-            metadata[tag] = value
-
-    rating = _tag_value(showing, 'tvRating')
-    if rating:
-        metadata['tvRating'] = rating
+    for tag in ['starRating', 'mpaaRating', 'tvRating']:
+        value = showing.get(tag)
+        if value and int(value[0]):
+            metadata[tag] = int(value[0])
 
     return metadata
 
@@ -653,57 +778,160 @@ def _tdcat_bin(tdcat_path, full_path, tivo_mak):
     tdcat = subprocess.Popen(tcmd, stdout=subprocess.PIPE)
     return tdcat.stdout.read()
 
-def _tdcat_py(full_path, tivo_mak):
-    xml_data = {}
-
-    tfile = open(full_path, 'rb')
-    header = tfile.read(16)
-    offset, chunks = struct.unpack('>LH', header[10:])
-    rawdata = tfile.read(offset - 16)
-    tfile.close()
-
-    count = 0
-    for i in xrange(chunks):
-        chunk_size, data_size, id, enc = struct.unpack('>LLHH',
-            rawdata[count:count + 12])
-        count += 12
-        data = rawdata[count:count + data_size]
-        xml_data[id] = {'enc': enc, 'data': data, 'start': count + 16}
-        count += chunk_size - 12
-
-    chunk = xml_data[2]
-    details = chunk['data']
-    if chunk['enc']:
-        xml_key = xml_data[3]['data']
-
-        hexmak = hashlib.md5('tivo:TiVo DVR:' + tivo_mak).hexdigest()
-        key = hashlib.sha1(hexmak + xml_key).digest()[:16] + '\0\0\0\0'
-
-        turkey = hashlib.sha1(key[:17]).digest()
-        turiv = hashlib.sha1(key).digest()
-
-        details = turing.Turing(turkey, turiv).crypt(details, chunk['start'])
-
-    return details
-
-def from_tivo(full_path):
-    if full_path in tivo_cache:
-        return tivo_cache[full_path]
-
-    tdcat_path = config.get_bin('tdcat')
-    tivo_mak = config.get_server('tivo_mak')
+class TivoIndex(object):
+    """ What has been read from each .tivo file's header: whether it
+        holds a transport stream, and its parsed details. An entry is
+        good for as long as the file's size and mtime, and the MAK,
+        stay the same, so listings, TVBus and ToGo each find it with
+        one stat, without opening the file or running tdcat again.
+        The index is kept in tivo_index, loaded on first use and saved
+        TIVO_INDEX_DELAY seconds after a change, dropping the entries
+        of files that are gone. With tivo_index blank, it lives only
+        in memory, as an LRUCache of TIVO_INDEX_SIZE entries.
+
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.fname = None
+        self.entries = {}  # path -> {'stamp', 'ts', 'details'}
+        self.timer = None
+        self.counts = {'hits': 0, 'reads': 0}
+
+    def _load(self):
+        """ Read the saved index, if it hasn't been yet (lock held). """
+        fname = config.getTivoIndexPath()
+        if fname == self.fname:
+            return
+        self.fname = fname
+        if not fname:
+            self.entries = LRUCache(TIVO_INDEX_SIZE)
+            return
+        self.entries = {}
+        try:
+            f = open(fname, 'rb')
+            try:
+                version, entries = cPickle.load(f)
+            finally:
+                f.close()
+        except IOError:
+            return
+        except Exception, msg:
+            logger.error('Reading %s: %s' % (fname, msg))
+            return
+        if version == TIVO_INDEX_VERSION:
+            self.entries = entries
+
+    def get(self, path, stamp):
+        self.lock.acquire()
+        try:
+            self._load()
+            if path in self.entries:
+                entry = self.entries[path]
+                if entry['stamp'] == stamp:
+                    self.counts['hits'] += 1
+                    return entry
+            return None
+        finally:
+            self.lock.release()
+
+    def put(self, path, entry):
+        self.lock.acquire()
+        try:
+            self._load()
+            self.entries[path] = entry
+            self.counts['reads'] += 1
+            if self.fname and not self.timer:
+                self.timer = threading.Timer(TIVO_INDEX_DELAY, self.save)
+                self.timer.setDaemon(True)
+                self.timer.start()
+        finally:
+            self.lock.release()
+
+    def save(self):
+        self.lock.acquire()
+        try:
+            self.timer = None
+            fname = self.fname
+            if not fname:
+                return
+            entries = dict(self.entries)
+        finally:
+            self.lock.release()
+
+        for path in entries.keys():
+            if not os.path.exists(unicode(path, 'utf-8')):
+                del entries[path]
+        try:
+            f = open(fname + '.new', 'wb')
+            cPickle.dump((TIVO_INDEX_VERSION, entries), f, 2)
+            f.close()
+            if mswindows and os.path.exists(fname):
+                os.remove(fname)
+            os.rename(fname + '.new', fname)
+        except (IOError, OSError), msg:
+            logger.error('Saving the .tivo index: %s' % msg)
+            return
+
+        self.lock.acquire()
+        try:
+            for path in self.entries.keys():
+                if path not in entries:
+                    del self.entries[path]
+        finally:
+            self.lock.release()
+        logger.debug('Saved %d .tivo entries to %s; %d hits, %d reads' %
+                     (len(entries), fname, self.counts['hits'],
+                      self.counts['reads']))
+
+tivo_index = TivoIndex()
+
+def tivo_info(full_path, want_details=True):
+    """ The index entry for a .tivo file: a dict with 'ts' (whether it
+        holds a transport stream) and 'details' (from from_details(),
+        {} if they can't be read). On a miss, the header is read once,
+        for both; without want_details, details that would need tdcat
+        are left for later, as None.
+
+    """
+    fname = unicode(full_path, 'utf-8')
     try:
-        assert(tivo_mak)
-        if tdcat_path:
-            details = _tdcat_bin(tdcat_path, full_path, tivo_mak)
-        else:
-            details = _tdcat_py(full_path, tivo_mak)
-        metadata = from_details(details)
-        tivo_cache[full_path] = metadata
+        st = os.stat(fname)
+    except OSError:
+        return {'ts': False, 'details': {}}
+    tivo_mak = config.get_server('tivo_mak') or ''
+    stamp = (st.st_size, st.st_mtime, hashlib.md5(tivo_mak).hexdigest())
+    entry = tivo_index.get(full_path, stamp)
+    if entry and (entry['details'] is not None or not want_details):
+        return entry
+
+    entry = {'stamp': stamp, 'ts': False, 'details': None}
+    try:
+        tfile = open(fname, 'rb')
+        try:
+            header = tivodecrypt.read_header(tfile)
+        finally:
+            tfile.close()
     except:
-        metadata = {}
+        header = None
+    if header:
+        entry['ts'] = header['ts']
+    tdcat_path = config.get_bin('tdcat')
+    if want_details or not tdcat_path:
+        entry['details'] = {}
+        try:
+            assert(tivo_mak and header)
+            if tdcat_path:
+                details = _tdcat_bin(tdcat_path, full_path, tivo_mak)
+            else:
+                details = tivodecrypt.details(header, tivo_mak)
+            entry['details'] = from_details(details)
+        except:
+            pass
+    tivo_index.put(full_path, entry)
+    return entry
 
-    return metadata
+def from_tivo(full_path):
+    return tivo_info(full_path)['details']
 
 def force_utf8(text):
     if type(text) == str:
@@ -1,26 +1,35 @@
-import cookielib
 import logging
 import sys
+import threading
 import time
 import urllib2
 import urllib
 import xml.etree.ElementTree as ElementTree
 
 import config
+import httpclient
 import metadata
 
+SESSION_TTL = 3600  # seconds a logged in Mind is reused
+
+minds = {}  # (tsn, username, password) -> Mind, see getMind()
+minds_lock = threading.Lock()
+
 class Mind:
     def __init__(self, username, password, tsn):
         self.__logger = logging.getLogger('pyTivo.mind')
         self.__username = username
         self.__password = password
         self.__mind = config.get_mind(tsn)
+        self.__pc_body_id = None
+        self.__lock = threading.RLock()  # one request at a time
+        self.timings = {}  # request type -> [count, seconds]
 
-        cj = cookielib.CookieJar()
-        cp = urllib2.HTTPCookieProcessor(cj)
-        self.__opener = urllib2.build_opener(cp)
+        # Its own cookies, but pooled keep-alive connections
+        self.__client = httpclient.Client()
 
         self.__login()
+        self.created = time.time()
 
     def pushVideo(self, tsn, url, description, duration, size,
                   title, subtitle, source='', mime='video/mpeg',
@@ -51,7 +60,10 @@ class Mind:
         mtypes = {'video/mp4': 'avcL41MP4', 'video/bif': 'vc1ApL3'}
         data['encodingType'] = mtypes.get(mime, 'mpeg2ProgramStream')
 
-        data['url'] = url + '?Format=' + mime
+        if '?' in url:
+            data['url'] = url + '&Format=' + mime
+        else:
+            data['url'] = url + '?Format=' + mime
 
         if subtitle:
             data['subtitle'] = subtitle
@@ -126,7 +138,13 @@ class Mind:
 
         return results
 
+    def __time(self, name, start):
+        entry = self.timings.setdefault(name, [0, 0.0])
+        entry[0] += 1
+        entry[1] += time.time() - start
+
     def __login(self):
+        start = time.time()
 
         data = {
             'cams_security_domain': 'tivocom',
@@ -136,26 +154,40 @@ class Mind:
             'cams_original_url': '/mind/mind7?type=infoGet'
         }
 
-        r =  urllib2.Request(
-            'https://%s/mind/login' % self.__mind,
-            urllib.urlencode(data)
-        )
         try:
-            result = self.__opener.open(r)
+            result = self.__client.open(
+                'https://%s/mind/login' % self.__mind,
+                urllib.urlencode(data)
+            )
+            result.read()
         except:
             pass
 
+        self.__time('login', start)
         self.__logger.debug('__login\n%s' % (data))
 
     def __dict_request(self, data, req):
-        r = urllib2.Request(
-            'https://%s/mind/mind7?type=%s' % (self.__mind, req),
-            dictcode(data),
-            {'Content-Type': 'x-tivo/dict-binary'}
-        )
-        result = self.__opener.open(r)
-
-        xml = ElementTree.parse(result).find('.')
+        url = 'https://%s/mind/mind7?type=%s' % (self.__mind, req)
+        body = dictcode(data)
+        headers = {'Content-Type': 'x-tivo/dict-binary'}
+        start = time.time()
+        self.__lock.acquire()
+        try:
+            try:
+                result = self.__client.open(url, body, headers)
+            except urllib2.HTTPError, e:
+                if e.code not in (401, 403):
+                    raise
+                # The session has lapsed; log in again, once
+                self.__logger.debug('%s: %s, logging in again' % (req, e))
+                self.__login()
+                result = self.__client.open(url, body, headers)
+
+            xml = ElementTree.parse(result).find('.')
+            result.close()
+        finally:
+            self.__time(req.split('&')[0], start)
+            self.__lock.release()
 
         self.__logger.debug('%s\n%s\n\n%sg' % (req, data,
                             ElementTree.tostring(xml)))
@@ -197,7 +229,10 @@ class Mind:
         return self.__dict_request(data, 'bodyOfferSchedule')
 
     def __pcBodySearch(self):
-        """Find PCS"""
+        """Find PCS (once per session)"""
+
+        if self.__pc_body_id:
+            return self.__pc_body_id
 
         xml = self.__dict_request({}, 'pcBodySearch')
         id = xml.findtext('.//pcBodyId')
@@ -205,6 +240,7 @@ class Mind:
             xml = self.__pcBodyStore('pyTivo', True)
             id = xml.findtext('.//pcBodyId')
 
+        self.__pc_body_id = id
         return id
 
     def __collectionIdSearch(self, url):
@@ -283,4 +319,26 @@ def getMind(tsn=None):
     if not username or not password:
         raise Exception("tivo_username and tivo_password required")
 
-    return Mind(username, password, tsn)
+    # Logging in and finding the pcBodyId take several round trips,
+    # so each TiVo's Mind is kept for a while
+    key = (tsn, username, password)
+    minds_lock.acquire()
+    try:
+        m = minds.get(key)
+    finally:
+        minds_lock.release()
+    if m and m.created + SESSION_TTL >= time.time():
+        return m
+
+    # Log in without the lock, so one slow account doesn't hold up
+    # the others
+    m = Mind(username, password, tsn)
+    minds_lock.acquire()
+    try:
+        current = minds.get(key)
+        if current and current.created > m.created:
+            return current  # someone else's newer login
+        minds[key] = m
+        return m
+    finally:
+        minds_lock.release()
@@ -15,8 +15,10 @@ from mutagen.mp3 import MP3
 from Cheetah.Template import Template
 from lrucache import LRUCache
 import config
+import reaper
+import scheduler
 from plugin import EncodeUnicode, Plugin, quote, unquote
-from plugins.video.transcode import kill
+from reaper import kill
 
 SCRIPTDIR = os.path.dirname(__file__)
 
@@ -100,53 +102,76 @@ class Music(Plugin):
         ext = os.path.splitext(fname)[1].lower()
         needs_transcode = ext in TRANSCODE or seek or duration or always
 
-        if not needs_transcode:
-            fsize = os.path.getsize(fname)
-            handler.send_response(200)
-            handler.send_header('Content-Length', fsize)
-        else:
-            handler.send_response(206)
-            handler.send_header('Transfer-Encoding', 'chunked')
-        handler.send_header('Content-Type', 'audio/mpeg')
-        handler.end_headers()
-
-        if needs_transcode:
-            if mswindows:
-                fname = fname.encode('cp1252')
-
-            cmd = [config.get_bin('ffmpeg'), '-i', fname, '-vn']
-            if ext in ['.mp3', '.mp2']:
-                cmd += ['-acodec', 'copy']
+        copy = ext in ('.mp3', '.mp2')
+        job = None
+        if needs_transcode and not copy:
+            # Stream copies are cheap enough to go without a slot
+            try:
+                job = scheduler.admit(scheduler.LIVE,
+                                      'music transcode of ' + path)
+            except scheduler.Busy, msg:
+                handler.send_error(503, str(msg))
+                return
+
+        try:
+            if not needs_transcode:
+                fsize = os.path.getsize(fname)
+                handler.send_response(200)
+                handler.send_header('Content-Length', fsize)
             else:
-                cmd += ['-ab', '320k', '-ar', '44100']
-            cmd += ['-f', 'mp3', '-']
-            if seek:
-                cmd[-1:] = ['-ss', '%.3f' % (seek / 1000.0), '-']
-            if duration:
-                cmd[-1:] = ['-t', '%.3f' % (duration / 1000.0), '-']
-
-            ffmpeg = subprocess.Popen(cmd, bufsize=BLOCKSIZE,
-                                      stdout=subprocess.PIPE)
-            while True:
+                handler.send_response(206)
+                handler.send_header('Transfer-Encoding', 'chunked')
+            handler.send_header('Content-Type', 'audio/mpeg')
+            handler.end_headers()
+
+            if needs_transcode:
+                if mswindows:
+                    fname = fname.encode('cp1252')
+
+                cmd = [config.get_bin('ffmpeg'), '-i', fname, '-vn']
+                if copy:
+                    cmd += ['-acodec', 'copy']
+                else:
+                    cmd += ['-ab', '320k', '-ar', '44100']
+                cmd += ['-f', 'mp3', '-']
+                if seek:
+                    cmd[-1:] = ['-ss', '%.3f' % (seek / 1000.0), '-']
+                if duration:
+                    cmd[-1:] = ['-t', '%.3f' % (duration / 1000.0), '-']
+
+                if job:
+                    stderr = subprocess.PIPE
+                else:
+                    stderr = None  # nothing reads it; let errors show
+                ffmpeg = subprocess.Popen(cmd, bufsize=BLOCKSIZE,
+                                          stdout=subprocess.PIPE,
+                                          stderr=stderr)
+                reaper.watch_child(ffmpeg, 'music transcode of ' + path)
+                if job:
+                    job.monitor(ffmpeg.stderr)
+                while True:
+                    try:
+                        block = ffmpeg.stdout.read(BLOCKSIZE)
+                        handler.wfile.write('%x\r\n' % len(block))
+                        handler.wfile.write(block)
+                        handler.wfile.write('\r\n')
+                    except Exception, msg:
+                        handler.server.logger.info(msg)
+                        kill(ffmpeg)
+                        break
+
+                    if not block:
+                        break
+            else:
+                f = open(fname, 'rb')
                 try:
-                    block = ffmpeg.stdout.read(BLOCKSIZE)
-                    handler.wfile.write('%x\r\n' % len(block))
-                    handler.wfile.write(block)
-                    handler.wfile.write('\r\n')
-                except Exception, msg:
-                    handler.server.logger.info(msg)
-                    kill(ffmpeg)
-                    break
-
-                if not block:
-                    break
-        else:
-            f = open(fname, 'rb')
-            try:
-                shutil.copyfileobj(f, handler.wfile)
-            except:
-                pass
-            f.close()
+                    shutil.copyfileobj(f, handler.wfile)
+                except:
+                    pass
+                f.close()
+        finally:
+            if job:
+                job.release()
 
         try:
             handler.wfile.flush()
@@ -253,6 +278,7 @@ class Music(Plugin):
                 ffmpeg = subprocess.Popen(cmd, stderr=subprocess.PIPE,
                                                stdout=subprocess.PIPE, 
                                                stdin=subprocess.PIPE)
+                reaper.watch_child(ffmpeg, 'probe of ' + f.name)
 
                 # wait 10 sec if ffmpeg is not back give up
                 for i in xrange(200):
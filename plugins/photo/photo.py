@@ -48,10 +48,11 @@ except ImportError:
         print 'Python Imaging Library not found; using FFmpeg'
 
 import config
+import reaper
 from Cheetah.Template import Template
 from lrucache import LRUCache
 from plugin import EncodeUnicode, Plugin, quote, unquote
-from plugins.video.transcode import kill
+from reaper import kill
 
 SCRIPTDIR = os.path.dirname(__file__)
 
@@ -228,6 +229,7 @@ class Photo(Plugin):
         ffmpeg = subprocess.Popen(cmd, stderr=err_tmp,
                                   stdout=subprocess.PIPE,
                                   stdin=subprocess.PIPE)
+        reaper.watch_child(ffmpeg, 'probe of ' + fname)
 
         # wait configured # of seconds: if ffmpeg is not back give up
         limit = config.getFFmpegWait()
@@ -304,6 +306,7 @@ class Photo(Plugin):
         jpeg_tmp = tempfile.TemporaryFile()
         ffmpeg = subprocess.Popen(cmd, stdout=jpeg_tmp,
                                   stdin=subprocess.PIPE)
+        reaper.watch_child(ffmpeg, 'photo transcode of ' + path)
 
         # wait configured # of seconds: if ffmpeg is not back give up
         limit = config.getFFmpegWait()
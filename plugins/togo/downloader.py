@@ -0,0 +1,436 @@
+import cgi
+import logging
+import os
+import sys
+import threading
+import time
+import urllib
+import urlparse
+from urllib import unquote
+
+import config
+import httpclient
+import metadata
+import nplsync
+import pipeline
+
+logger = logging.getLogger('pyTivo.togo.downloader')
+
+CHUNK = 256 * 1024   # bytes per read from the TiVo
+RATE_INTERVAL = 5    # seconds between throughput updates
+RETRIES = 3          # tries for a download that can be resumed
+RETRY_DELAY = 30     # seconds between them
+STATE_FILE = '.pyTivo-togo-queue'  # in togo_path
+
+# Characters to remove from filenames
+
+BADCHAR = {'\\': '-', '/': '-', ':': ' -', ';': ',', '*': '.',
+           '?': '.', '!': '.', '"': "'", '<': '(', '>': ')', '|': ' '}
+
+# Persisted with each queued job, see Manager.save()
+FIELDS = ('url', 'tivoIP', 'tsn', 'togo_path', 'stages', 'save',
+          'ts_format', 'started', 'outfile')
+
+mswindows = (sys.platform == "win32")
+
+status = {} # Per download, for the NPL page -- indexed by URL
+queue = {} # Recordings being or to be downloaded -- list per TiVo
+
+def get_togo_path():
+    """ togo_path, with a share name turned into the share's path. """
+    togo_path = config.get_server('togo_path')
+    for name, data in config.getShares():
+        if togo_path == name:
+            togo_path = data.get('path')
+    return togo_path
+
+def tivo_name(tivoIP):
+    tsn = config.tivos_by_ip(tivoIP)
+    if tsn in config.tivos:
+        return config.tivos[tsn].get('name', tivoIP)
+    return tivoIP
+
+def out_name(job):
+    """ The file a download is saved to. """
+    url = job['url']
+    parse_url = urlparse.urlparse(url)
+
+    name = unicode(unquote(parse_url[2]), 'utf-8').split('/')[-1].split('.')
+    try:
+        id = unquote(parse_url[4]).split('id=')[1]
+        name.insert(-1, ' - ' + id)
+    except:
+        pass
+    ts = job['ts_format']
+    if 'remux' in job['stages']:
+        name[-1] = 'mp4'
+    elif 'decrypt' in job['stages']:
+        if ts:
+            name[-1] = 'ts'
+        else:
+            name[-1] = 'mpg'
+    else:
+        if ts:
+            name.insert(-1, ' (TS)')
+        else:
+            name.insert(-1, ' (PS)')
+    name.insert(-1, '.')
+    name = ''.join(name)
+    for ch in BADCHAR:
+        name = name.replace(ch, BADCHAR[ch])
+    return os.path.join(job['togo_path'], name)
+
+class Manager(object):
+    """ Runs queued ToGo downloads, as many at once as togo_downloads
+        allows overall and togo_tivo_downloads allows per TiVo, each on
+        its own thread. The queue is saved in togo_path as it changes,
+        and picked up again by restore() when pyTivo starts. A raw
+        .tivo download that fails, or is cut off by a restart, carries
+        on from the end of its partial file, if the TiVo honours the
+        Range header; otherwise it starts over.
+
+    """
+    def __init__(self, opener, fetch):
+        self.opener = opener  # for passwords; see httpclient.Client
+        self.fetch = fetch    # (url, headers) -> response, retrying if busy
+        self.lock = threading.RLock()
+        self.jobs = []        # in the order queued
+        self.active = {}      # tivoIP -> downloads running
+        self.running = 0
+        self.rates = {}       # url -> bits/s, for those running
+        self.totals = {'done': 0, 'failed': 0, 'cancelled': 0,
+                       'resumed': 0, 'bytes': 0}
+
+    def add(self, tivoIP, url, stages, save, ts_format, togo_path,
+            started='', outfile=''):
+        """ Queue a download, to go through stages (a list of those in
+            pipeline.STAGES) on its way to the disk.
+
+        """
+        stages = [stage for stage in pipeline.STAGES if stage in stages]
+        job = {'url': url, 'tivoIP': tivoIP,
+               'tsn': config.tivos_by_ip(tivoIP) or '',
+               'togo_path': togo_path, 'stages': ','.join(stages),
+               'save': save and '1' or '', 'ts_format': ts_format and '1' or '',
+               'started': started, 'outfile': outfile, 'state': 'queued'}
+        self.lock.acquire()
+        try:
+            status[url] = {'running': False, 'error': '', 'rate': '',
+                           'queued': True, 'size': 0, 'finished': False,
+                           'decode': 'decrypt' in stages, 'save': save,
+                           'ts_format': ts_format}
+            queue.setdefault(tivoIP, []).append(url)
+            self.jobs.append(job)
+            self.save()
+            self.dispatch()
+        finally:
+            self.lock.release()
+
+    def remove(self, url):
+        """ Take a download that hasn't started off the queue. """
+        self.lock.acquire()
+        try:
+            for job in self.jobs:
+                if job['url'] == url and job['state'] == 'queued':
+                    self.jobs.remove(job)
+                    self._unlist(job)
+                    del status[url]
+                    if job['started']:
+                        self._delete(job)
+                    self.save()
+                    return True
+            return False
+        finally:
+            self.lock.release()
+
+    def stop(self, url):
+        if url in status:
+            status[url]['running'] = False
+
+    def dispatch(self):
+        """ Start what the limits allow, in queue order. """
+        self.lock.acquire()
+        try:
+            for job in self.jobs:
+                if self.running >= config.getTogoDownloads():
+                    break
+                ip = job['tivoIP']
+                if (job['state'] != 'queued' or self.active.get(ip, 0) >=
+                    config.getTogoTivoDownloads()):
+                    continue
+                job['state'] = 'running'
+                status[job['url']].update({'running': True,
+                                           'queued': False})
+                self.running += 1
+                self.active[ip] = self.active.get(ip, 0) + 1
+                thread = threading.Thread(target=self._run, args=(job,))
+                thread.setDaemon(True)
+                thread.start()
+        finally:
+            self.lock.release()
+
+    def _run(self, job):
+        url = job['url']
+        result = 'failed'
+        try:
+            for attempt in xrange(RETRIES):
+                result = self.download(job)
+                if result != 'retry' or attempt == RETRIES - 1:
+                    break
+                logger.info('Retrying "%s" in %d s' % (url, RETRY_DELAY))
+                time.sleep(RETRY_DELAY)
+                if not status[url]['running']:
+                    result = 'cancelled'
+                    break
+        except Exception, msg:
+            logger.error('Downloading %s: %s' % (url, msg))
+            status[url]['error'] = str(msg)
+        if result == 'retry':
+            result = 'failed'
+        if result != 'done':
+            self._delete(job)
+
+        self.lock.acquire()
+        try:
+            self.running -= 1
+            self.active[job['tivoIP']] -= 1
+            self.rates.pop(url, None)
+            self.totals[result] += 1
+            self.jobs.remove(job)
+            self._unlist(job)
+            if result == 'cancelled':
+                status.pop(url, None)
+            elif url in status:
+                status[url]['running'] = False
+            self.save()
+            self.dispatch()
+        finally:
+            self.lock.release()
+        self.log_stats()
+
+    def _unlist(self, job):
+        ip = job['tivoIP']
+        if ip in queue and job['url'] in queue[ip]:
+            queue[ip].remove(job['url'])
+            if not queue[ip]:
+                del queue[ip]
+
+    def _delete(self, job):
+        if not job['outfile']:
+            return
+        for name in (job['outfile'], job['outfile'] + '.txt'):
+            try:
+                os.remove(name)
+            except OSError:
+                pass
+
+    def save_meta(self, job):
+        entry = nplsync.lookup(job['url']) or {}
+        meta = dict(entry.get('meta', {}))
+        try:
+            handle = self.fetch(entry['Details'])
+            meta.update(metadata.from_details(handle.read()))
+            handle.close()
+        except:
+            pass
+        metafile = open(job['outfile'] + '.txt', 'w')
+        metadata.dump(metafile, meta)
+        metafile.close()
+
+    def download(self, job):
+        """ Fetch one recording. Returns 'done', 'cancelled', 'failed',
+            or 'retry' if it failed but can be resumed.
+
+        """
+        url = job['url']
+        st = status[url]
+        st['error'] = ''
+        if not job['outfile']:
+            job['outfile'] = out_name(job)
+        outfile = job['outfile']
+        resumable = not job['stages']  # only raw .tivo files
+        name = tivo_name(job['tivoIP'])
+
+        offset = 0
+        if resumable and job['started'] and os.path.exists(outfile):
+            offset = os.path.getsize(outfile)
+        if job['save'] and not (offset and os.path.exists(outfile + '.txt')):
+            self.save_meta(job)
+        if not job['started']:
+            job['started'] = '1'
+            self.lock.acquire()
+            try:
+                self.save()
+            finally:
+                self.lock.release()
+
+        mak = config.get_tsn('tivo_mak', job['tsn'] or None)
+        self.opener.add_password('TiVo DVR', url, 'tivo', mak)
+        fetch_url = url
+        if job['ts_format']:
+            fetch_url += '&Format=video/x-tivo-mpeg-ts'
+        headers = {}
+        if offset:
+            headers['Range'] = 'bytes=%d-' % offset
+        try:
+            handle = self.fetch(fetch_url, headers)
+            if offset and content_start(handle) != offset:
+                logger.info('%s won\'t resume "%s"; starting over' %
+                            (name, outfile))
+                offset = 0
+                if handle.code == 206:
+                    handle.close()
+                    handle = self.fetch(fetch_url)
+            elif offset:
+                logger.info('Resuming "%s" at %d bytes' % (outfile, offset))
+                self.totals['resumed'] += 1
+        except Exception, msg:
+            st['error'] = str(msg)
+            return resumable and 'retry' or 'failed'
+
+        logger.info('[%s] Start getting "%s" from %s' %
+                    (time.strftime('%d/%b/%Y %H:%M:%S'), outfile, name))
+
+        fname = outfile
+        if mswindows:
+            fname = fname.encode('cp1252')
+        try:
+            flow = pipeline.build(job['stages'].split(','), fname, mak,
+                                  offset > 0, bool(job['ts_format']))
+        except (IOError, OSError, ValueError), msg:
+            handle.close()
+            st['error'] = str(msg)
+            return 'failed'
+
+        st['size'] = offset
+        length = 0
+        start_time = time.time()
+        last_interval = last_read = start_time
+        now = start_time
+        error = None
+        try:
+            while st['running'] and not flow.error:
+                output = handle.read(CHUNK)
+                now = time.time()
+                flow.count(len(output), now - last_read)
+                if not output:
+                    break
+                length += len(output)
+                flow.write(output)
+                last_read = time.time()
+                elapsed = now - last_interval
+                if elapsed >= RATE_INTERVAL:
+                    self.rates[url] = length * 8.0 / elapsed
+                    st['rate'] = '%.2f Mb/s' % (length * 8.0 /
+                        (elapsed * 1024 * 1024))
+                    st['size'] += length
+                    self.totals['bytes'] += length
+                    length = 0
+                    last_interval = now
+        except Exception, msg:
+            error = msg
+        handle.close()
+        flow.close()
+        error = error or flow.error
+        st['size'] += length
+        self.totals['bytes'] += length
+
+        if not st['running']:
+            logger.info('[%s] Transfer of "%s" from %s aborted' %
+                        (time.strftime('%d/%b/%Y %H:%M:%S'), outfile, name))
+            return 'cancelled'
+        if error:
+            logger.info('Getting "%s" from %s: %s' % (outfile, name, error))
+            st['error'] = str(error)
+            return resumable and 'retry' or 'failed'
+
+        mega_elapsed = (now - start_time) * 1024 * 1024
+        if mega_elapsed < 1:
+            mega_elapsed = 1
+        size = st['size']
+        rate = (size - offset) * 8.0 / mega_elapsed
+        logger.info('[%s] Done getting "%s" from %s, %d bytes, %.2f Mb/s' %
+                    (time.strftime('%d/%b/%Y %H:%M:%S'), outfile, name,
+                     size, rate))
+        flow.log_stats(outfile)
+        if resumable:
+            # So the video share lists it without reading it again
+            metadata.tivo_info(outfile.encode('utf-8'))
+        st['finished'] = True
+        return 'done'
+
+    def save(self):
+        """ Write out the queue (lock held). """
+        togo_path = get_togo_path()
+        if not togo_path:
+            return
+        fname = os.path.join(togo_path, STATE_FILE)
+        try:
+            f = open(fname + '.new', 'w')
+            for job in self.jobs:
+                fields = []
+                for key in FIELDS:
+                    value = job[key]
+                    if type(value) == unicode:
+                        value = value.encode('utf-8')
+                    fields.append((key, value))
+                f.write(urllib.urlencode(fields) + '\n')
+            f.close()
+            if mswindows and os.path.exists(fname):
+                os.remove(fname)
+            os.rename(fname + '.new', fname)
+        except (IOError, OSError), msg:
+            logger.error('Saving the ToGo queue: %s' % msg)
+
+    def restore(self):
+        """ Queue the downloads saved by an earlier run. """
+        togo_path = get_togo_path()
+        if not togo_path:
+            return
+        try:
+            lines = open(os.path.join(togo_path, STATE_FILE)).readlines()
+        except IOError:
+            return
+        for line in lines:
+            job = dict([(k, v[0]) for k, v in
+                        cgi.parse_qs(line.strip(), True).items()])
+            if 'url' not in job or job['url'] in status:
+                continue
+            logger.info('Requeueing "%s"' % unquote(job['url']))
+            outfile = unicode(job.get('outfile', ''), 'utf-8')
+            self.add(job.get('tivoIP', ''), job['url'],
+                     job.get('stages', '').split(','), bool(job.get('save')),
+                     bool(job.get('ts_format')),
+                     job.get('togo_path', togo_path),
+                     job.get('started', ''), outfile)
+
+    def stats(self):
+        self.lock.acquire()
+        try:
+            result = dict(self.totals)
+            result.update({'running': self.running,
+                           'queued': len(self.jobs) - self.running,
+                           'rate': sum(self.rates.values())})
+            return result
+        finally:
+            self.lock.release()
+
+    def log_stats(self):
+        logger.info(('downloads: %(running)d running, %(queued)d queued, ' +
+                     '%(done)d done (%(resumed)d resumed), %(failed)d ' +
+                     'failed, %(cancelled)d cancelled; %(bytes)d bytes') %
+                    self.stats())
+        httpclient.log_stats()
+
+def content_start(response):
+    """ The first byte in a 206 response, by its Content-Range, or None
+        if the whole file is being sent.
+
+    """
+    if response.code != 206:
+        return None
+    value = response.info().getheader('Content-Range', '')
+    try:
+        return int(value.split()[1].split('-')[0])
+    except (IndexError, ValueError):
+        return -1
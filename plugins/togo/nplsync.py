@@ -0,0 +1,341 @@
+import logging
+import threading
+import time
+import urlparse
+from urllib import quote
+
+import metadata
+
+logger = logging.getLogger('pyTivo.togo.nplsync')
+tag_data = metadata.tag_data
+
+PAGE = 50           # items asked for per request
+REFRESH = 60        # seconds between checks for changes
+IDLE = 3600         # seconds without a look before a TiVo's sync stops
+MAX_SHOWS = 10000   # shows kept per TiVo
+
+mirrors = {}  # tivoIP -> Mirror
+mirrors_lock = threading.Lock()
+
+# Item fields that change when a recording does; an item whose values
+# are the same as last time keeps its parsed entry
+STAMP = ('Details/LastChangeDate', 'Details/TotalItems',
+         'Details/SourceSize', 'Details/CopyProtected',
+         'Links/CustomIcon/Url')
+
+SHOW_KEYS = {'Icon': 'Links/CustomIcon/Url',
+             'Url': 'Links/Content/Url',
+             'Details': 'Links/TiVoVideoDetails/Url',
+             'SourceSize': 'Details/SourceSize',
+             'Duration': 'Details/Duration',
+             'CaptureDate': 'Details/CaptureDate'}
+
+# Everything read from each Item, and from the rest of a page
+ITEM_PATHS = (list(STAMP) + SHOW_KEYS.values() + metadata.CONTAINER_PATHS +
+              ['Details/ContentType', 'Details/Title',
+               'Details/LastCaptureDate', 'Details/UniqueId'])
+PAGE_PATHS = ['TiVoContainer/Details/' + tag
+              for tag in ('Title', 'TotalItems', 'LastChangeDate')]
+
+def getint(thing, base=10):
+    try:
+        result = int(thing, base)
+    except:
+        result = 0
+    return result
+
+def make_entry(item, baseurl):
+    """ The compact form of one NPL item kept in the mirror, with what
+        the listing template shows, the metadata saved with downloads,
+        and raw _title, _date, _size and _duration values to sort on.
+
+    """
+    entry = {}
+    for tag in ('CopyProtected', 'ContentType'):
+        value = tag_data(item, 'Details/' + tag)
+        if value:
+            entry[tag] = value
+    entry.setdefault('ContentType', '')
+    if entry['ContentType'].startswith('x-tivo-container'):
+        entry['Url'] = tag_data(item, 'Links/Content/Url')
+        entry['Title'] = tag_data(item, 'Details/Title')
+        entry['TotalItems'] = tag_data(item, 'Details/TotalItems')
+        lc = tag_data(item, 'Details/LastCaptureDate')
+        if not lc:
+            lc = tag_data(item, 'Details/LastChangeDate')
+        entry['_date'] = getint(lc, 16)
+        entry['LastChangeDate'] = time.strftime('%b %d, %Y',
+            time.localtime(entry['_date']))
+        entry['_title'] = (entry['Title'].lower(), '')
+        entry['_size'] = entry['_duration'] = 0
+        return entry
+
+    for key in SHOW_KEYS:
+        value = tag_data(item, SHOW_KEYS[key])
+        if value:
+            entry[key] = value
+
+    entry['_size'] = getint(entry.get('SourceSize', ''))
+    if 'SourceSize' in entry:
+        entry['SourceSize'] = metadata.human_size(entry['SourceSize'])
+
+    entry['_duration'] = dur = getint(entry.get('Duration', '')) / 1000
+    if 'Duration' in entry:
+        entry['Duration'] = ( '%d:%02d:%02d' %
+            (dur / 3600, (dur % 3600) / 60, dur % 60) )
+
+    entry['_date'] = getint(entry.get('CaptureDate', ''), 16)
+    if 'CaptureDate' in entry:
+        entry['CaptureDate'] = time.strftime('%b %d, %Y',
+            time.localtime(entry['_date']))
+
+    entry['Url'] = urlparse.urljoin(baseurl, entry.get('Url', ''))
+    entry['meta'] = metadata.from_container(item)
+    entry.update(entry['meta'])
+    entry['_title'] = (entry.get('title', '').lower(),
+                       entry.get('episodeTitle', '').lower())
+    return entry
+
+class Container(object):
+    """ One synced container (the top level or a folder): its title,
+        the stamp it was synced at, and its entries in TiVo order,
+        each kept with the id and stamp of the item it came from.
+
+    """
+    def __init__(self, title='', stamp=None):
+        self.title = title
+        self.stamp = stamp
+        self.folder_stamp = None  # the stamp of its item in the top level
+        self.items = []   # (id, stamp, entry)
+
+    def entries(self):
+        return [entry for id, stamp, entry in self.items]
+
+    def known(self):
+        return dict([(id, (stamp, entry)) for id, stamp, entry in self.items])
+
+class Mirror(object):
+    """ A local copy of one TiVo's Now Playing List, kept up to date by
+        a background thread so that the web UI pages, sorts and filters
+        without asking the TiVo. The first sync pages through every
+        container with AnchorItem; after that, every REFRESH seconds, a
+        one-page look at the top level is enough if its LastChangeDate
+        and TotalItems haven't moved. Otherwise the top level is read
+        again, and only the folders whose LastChangeDate or TotalItems
+        changed are re-read. Items that are unchanged (by UniqueId and
+        stamp) keep their parsed entries. The sync stops when no one
+        has looked for IDLE seconds, and starts again on the next look.
+
+    """
+    def __init__(self, tivoIP, baseurl, fetch):
+        self.tivoIP = tivoIP
+        self.baseurl = baseurl
+        self.fetch = fetch   # url -> file-like; see ToGo.tivo_open()
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+        self.containers = {}  # folder Url ('' for the top) -> Container
+        self.index = {}       # show Url -> entry
+        self.synced = 0
+        self.error = None
+        self.accessed = time.time()
+        self.thread = None
+        self.counts = {'syncs': 0, 'pages': 0, 'parsed': 0, 'reused': 0}
+
+    def start(self):
+        self.lock.acquire()
+        try:
+            self.accessed = time.time()
+            if not self.thread:
+                self.thread = threading.Thread(target=self.run)
+                self.thread.setDaemon(True)
+                self.thread.start()
+        finally:
+            self.lock.release()
+
+    def run(self):
+        while True:
+            try:
+                self.sync()
+                self.error = None
+            except Exception, msg:
+                logger.error('Syncing Now Playing from %s: %s' %
+                             (self.tivoIP, msg))
+                self.error = str(msg)
+            self.ready.set()
+            time.sleep(REFRESH)
+            self.lock.acquire()
+            try:
+                if self.accessed + IDLE < time.time():
+                    self.thread = None
+                    return
+            finally:
+                self.lock.release()
+
+    def wait(self, timeout):
+        """ Wait up to timeout seconds for the first sync. Returns
+            whether there is one.
+
+        """
+        self.ready.wait(timeout)
+        return self.ready.isSet()
+
+    def _page(self, url, anchor=None):
+        url += '&ItemCount=%d' % PAGE
+        if anchor:
+            url += '&AnchorItem=' + quote(anchor) + '&AnchorOffset=0'
+        page = self.fetch(url)
+        try:
+            result = metadata.stream_records(page, 'Item', ITEM_PATHS,
+                                             top_paths=PAGE_PATHS)
+        finally:
+            page.close()
+        self.counts['pages'] += 1
+        return result
+
+    def _read(self, folder, old=None, force=True):
+        """ Read one container, page by page, reusing the entries in
+            old for unchanged items. Unless force is set, returns old
+            if the container's LastChangeDate and TotalItems match it.
+
+        """
+        url = self.baseurl
+        if folder:
+            url = urlparse.urljoin(url, folder)
+        top, items = self._page(url)
+        total = getint(tag_data(top, 'TiVoContainer/Details/TotalItems'))
+        lc = tag_data(top, 'TiVoContainer/Details/LastChangeDate')
+        stamp = (total, lc)
+        if old and not force and lc and old.stamp == stamp:
+            return old
+
+        container = Container(
+            tag_data(top, 'TiVoContainer/Details/Title'), stamp)
+        known = old and old.known() or {}
+        while True:
+            for item in items:
+                id = (tag_data(item, 'Details/UniqueId') or
+                      tag_data(item, 'Links/Content/Url'))
+                istamp = tuple([tag_data(item, tag) for tag in STAMP])
+                if id in known and known[id][0] == istamp:
+                    entry = known[id][1]
+                    self.counts['reused'] += 1
+                else:
+                    entry = make_entry(item, self.baseurl)
+                    self.counts['parsed'] += 1
+                container.items.append((id, istamp, entry))
+            if not items or len(container.items) >= total:
+                break
+            anchor = tag_data(items[-1], 'Links/Content/Url')
+            top, items = self._page(url, anchor)
+        return container
+
+    def sync(self):
+        start = time.time()
+        before = dict(self.counts)
+        old = self.containers
+        top = self._read('', old.get(''), not old)
+        if top is old.get(''):
+            self.synced = time.time()
+            return
+
+        containers = {'': top}
+        shows = 0
+        for id, stamp, entry in top.items:
+            if not entry['ContentType'].startswith('x-tivo-container'):
+                shows += 1
+                continue
+            folder = entry['Url']
+            previous = old.get(folder)
+            if previous and previous.folder_stamp == stamp:
+                containers[folder] = previous
+            elif shows < MAX_SHOWS:
+                sub = self._read(folder, previous)
+                sub.folder_stamp = stamp
+                containers[folder] = sub
+            shows += len(containers.get(folder, Container()).items)
+
+        index = {}
+        for container in containers.values():
+            for entry in container.entries():
+                if 'meta' in entry:
+                    index[entry['Url']] = entry
+        if len(index) > MAX_SHOWS:
+            logger.warning('%s has %d shows; only %d are kept' %
+                           (self.tivoIP, len(index), MAX_SHOWS))
+            # Drop the oldest recordings' entries from the lookup
+            index = dict(sorted(index.items(),
+                                key=lambda x: -x[1]['_date'])[:MAX_SHOWS])
+
+        self.lock.acquire()
+        try:
+            self.containers = containers
+            self.index = index
+            self.synced = time.time()
+            self.counts['syncs'] += 1
+        finally:
+            self.lock.release()
+
+        delta = dict([(k, self.counts[k] - before[k]) for k in self.counts])
+        delta.update({'tivo': self.tivoIP, 'shows': len(index),
+                      'folders': len(containers) - 1,
+                      'time': time.time() - start})
+        logger.info(('Now Playing from %(tivo)s: %(shows)d shows in ' +
+                     '%(folders)d folders; %(pages)d pages, %(parsed)d ' +
+                     'items parsed, %(reused)d reused, in %(time).1f s') %
+                    delta)
+
+    def listing(self, folder='', sort='', text=''):
+        """ Returns (title, entries) for a folder (or the top level),
+            filtered to those whose title, episode title or description
+            contains text, and sorted by 'title', 'date', 'size' or
+            'duration', or in TiVo order; or None if the folder isn't
+            known.
+
+        """
+        self.start()
+        self.lock.acquire()
+        try:
+            container = self.containers.get(folder)
+        finally:
+            self.lock.release()
+        if not container:
+            return None
+        entries = container.entries()
+        if text:
+            text = text.lower()
+            entries = [e for e in entries
+                       if [f for f in ('Title', 'title', 'episodeTitle',
+                                       'description')
+                           if text in e.get(f, '').lower()]]
+        if sort == 'title':
+            entries.sort(key=lambda e: e['_title'])
+        elif sort in ('date', 'size', 'duration'):
+            entries.sort(key=lambda e: e['_' + sort], reverse=True)
+        return container.title, entries
+
+    def stats(self):
+        result = dict(self.counts)
+        result.update({'shows': len(self.index),
+                       'folders': len(self.containers) - 1,
+                       'synced': self.synced})
+        return result
+
+def get(tivoIP, baseurl, fetch):
+    """ The Mirror for a TiVo, with its sync running. """
+    mirrors_lock.acquire()
+    try:
+        m = mirrors.get(tivoIP)
+        if not m or m.baseurl != baseurl:
+            m = Mirror(tivoIP, baseurl, fetch)
+            mirrors[tivoIP] = m
+    finally:
+        mirrors_lock.release()
+    m.start()
+    return m
+
+def lookup(url):
+    """ The mirrored entry for a show's download Url, or None. """
+    for m in mirrors.values():
+        if url in m.index:
+            return m.index[url]
+    return None
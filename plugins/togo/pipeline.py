@@ -0,0 +1,222 @@
+import logging
+import Queue
+import subprocess
+import threading
+import time
+
+import config
+import reaper
+import tivodecrypt
+
+logger = logging.getLogger('pyTivo.togo.pipeline')
+
+CHUNK = 256 * 1024   # bytes read from a process at a time
+QUEUE = 32           # chunks buffered in front of each stage
+
+# The optional steps, in the order data goes through them
+STAGES = ('decrypt', 'remux')
+
+class Stage(object):
+    """ One step of a Pipeline, run on its own thread(s) and fed
+        through a bounded queue. It counts bytes in and out, the time
+        spent on its own work (busy), and the time spent waiting for
+        the next stage to take its output (blocked). After an error it
+        keeps taking (and dropping) input, so nothing upstream hangs.
+
+    """
+    def __init__(self, name):
+        self.name = name
+        self.queue = Queue.Queue(QUEUE)
+        self.next = None
+        self.error = None
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.busy = 0.0
+        self.blocked = 0.0
+        self.threads = []
+
+    def put(self, data):
+        self.queue.put(data)
+
+    def emit(self, data):
+        start = time.time()
+        self.next.put(data)
+        self.blocked += time.time() - start
+        if data:
+            self.bytes_out += len(data)
+
+    def spawn(self, target):
+        thread = threading.Thread(target=target)
+        thread.setDaemon(True)
+        thread.start()
+        self.threads.append(thread)
+
+    def join(self):
+        for thread in self.threads:
+            thread.join()
+
+    def inputs(self):
+        """ The chunks put to this stage, up to the None that ends
+            them; dropped after an error.
+
+        """
+        while True:
+            data = self.queue.get()
+            if data is None:
+                return
+            self.bytes_in += len(data)
+            if not self.error:
+                yield data
+
+class Disk(Stage):
+    """ Writes what reaches it to a file. """
+    def __init__(self, fname, append=False):
+        Stage.__init__(self, 'disk')
+        self.f = open(fname, append and 'ab' or 'wb')
+
+    def start(self):
+        self.spawn(self.run)
+
+    def run(self):
+        for data in self.inputs():
+            start = time.time()
+            try:
+                self.f.write(data)
+            except Exception, msg:
+                self.error = msg
+            self.busy += time.time() - start
+        try:
+            self.f.close()
+        except Exception, msg:
+            self.error = self.error or msg
+
+class Process(Stage):
+    """ Passes the data through an external filter (e.g. tivodecode or
+        ffmpeg) reading stdin and writing stdout, with one thread
+        feeding it and another collecting its output.
+
+    """
+    def __init__(self, name, cmd):
+        Stage.__init__(self, name)
+        self.cmd = cmd
+        self.proc = None
+
+    def start(self):
+        self.proc = subprocess.Popen(self.cmd, stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE, bufsize=CHUNK)
+        reaper.watch_child(self.proc, self.name + ' in ToGo')
+        self.spawn(self.feed)
+        self.spawn(self.collect)
+
+    def feed(self):
+        for data in self.inputs():
+            start = time.time()
+            try:
+                self.proc.stdin.write(data)
+            except Exception, msg:
+                self.error = msg
+            self.busy += time.time() - start
+        try:
+            self.proc.stdin.close()
+        except Exception, msg:
+            self.error = self.error or msg
+
+    def collect(self):
+        while True:
+            data = self.proc.stdout.read(CHUNK)
+            if not data:
+                break
+            self.emit(data)
+        self.emit(None)
+        if self.proc.wait() and not self.error:
+            self.error = '%s exited with status %d' % (self.name,
+                                                       self.proc.returncode)
+
+class Pipeline(object):
+    """ Data from a ToGo download going through its stages (decrypt,
+        remux) to the disk in one pass: each stage runs at once on its
+        own threads, with bounded buffers between them, instead of
+        each one being a separate pass over the whole recording. The
+        download itself is counted as the first stage, through count().
+
+    """
+    def __init__(self, stages):
+        self.source = Stage('download')
+        self.stages = stages
+        for stage, next in zip(stages, stages[1:]):
+            stage.next = next
+        self.source.next = stages[0]
+        self.started = time.time()
+        # From the disk back, so a stage that can't start can end the
+        # ones after it
+        for stage in reversed(stages):
+            try:
+                stage.start()
+            except:
+                if stage.next:
+                    stage.next.put(None)
+                raise
+
+    def count(self, nbytes, seconds):
+        """ Note a read of nbytes from the TiVo taking seconds. """
+        self.source.bytes_in += nbytes
+        self.source.busy += seconds
+
+    def write(self, data):
+        self.source.emit(data)
+
+    def close(self):
+        """ Finish, and wait for every stage to be done. """
+        self.source.emit(None)
+        for stage in self.stages:
+            stage.join()
+
+    def _get_error(self):
+        for stage in self.stages:
+            if stage.error:
+                return '%s: %s' % (stage.name, stage.error)
+        return None
+
+    error = property(_get_error)
+
+    def stats(self):
+        """ Per stage: (name, bytes in, bytes out, busy seconds,
+            blocked seconds).
+
+        """
+        return [(s.name, s.bytes_in, s.bytes_out, s.busy, s.blocked)
+                for s in [self.source] + self.stages]
+
+    def log_stats(self, name):
+        elapsed = max(time.time() - self.started, 0.001)
+        parts = []
+        for stage, nin, nout, busy, blocked in self.stats():
+            parts.append('%s %.1f MB in %.1f s busy (%.2f Mb/s), %.1f s '
+                         'blocked' % (stage, nin / 1048576.0, busy,
+                                      nin * 8 / (max(busy, 0.001) * 1048576),
+                                      blocked))
+        logger.info('%s, %.1f s: %s' % (name, elapsed, '; '.join(parts)))
+
+def build(stages, fname, mak='', append=False, ts=False):
+    """ The Pipeline for a download with the given optional stages,
+        written to fname; ts if the download is a transport stream.
+
+    """
+    steps = []
+    if 'decrypt' in stages:
+        cmd = tivodecrypt.command(mak, '-', ts)
+        if not cmd:
+            raise ValueError('transport streams need tivodecode')
+        steps.append(Process('decrypt', cmd))
+    if 'remux' in stages:
+        ffmpeg = config.get_bin('ffmpeg')
+        if not ffmpeg:
+            raise ValueError('remuxing needs ffmpeg')
+        # Fragmented, so the MP4 can be written as it's made
+        steps.append(Process('remux', [ffmpeg,
+                                       '-loglevel', 'error', '-i', '-',
+                                       '-vcodec', 'copy', '-acodec', 'copy',
+                                       '-movflags', 'frag_keyframe+empty_moov',
+                                       '-f', 'mp4', '-']))
+    steps.append(Disk(fname, append))
+    return Pipeline(steps)
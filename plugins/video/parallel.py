@@ -0,0 +1,174 @@
+import bisect
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+import config
+import reaper
+import scheduler
+import transcode
+
+logger = logging.getLogger('pyTivo.video.parallel')
+
+MIN_SEGMENT = 60  # seconds; shorter pieces aren't worth the overhead
+
+def split_points(plan, count, length=0):
+    """ Divide plan's source (or its first length seconds) into at most
+        count (start, duration) pieces of about equal length, each
+        starting at a keyframe where they're known. A duration of None
+        means "to the end".
+
+    """
+    duration = plan.vInfo.get('millisecs', 0) / 1000.0
+    if length:
+        duration = min(duration, float(length))
+    count = max(1, min(count, int(duration / MIN_SEGMENT)))
+    frames = []
+    if count > 1:
+        frames = transcode.index_keyframes(plan.path, True)
+
+    starts = [0.0]
+    for i in xrange(1, count):
+        start = duration * i / count
+        j = bisect.bisect_right(frames, start)
+        if j:
+            start = frames[j - 1]
+        if start > starts[-1]:
+            starts.append(start)
+
+    pieces = []
+    for i, start in enumerate(starts):
+        if i + 1 < len(starts):
+            pieces.append((start, starts[i + 1] - start))
+        elif length:
+            pieces.append((start, duration - start))
+        else:
+            pieces.append((start, None))
+    return pieces
+
+def run(job, cmd, name):
+    """ Run one ffmpeg to completion under job. """
+    transcode.debug(' '.join(cmd))
+    try:
+        ffmpeg = subprocess.Popen(job.limit(cmd), stdin=open(os.devnull),
+                                  stderr=subprocess.PIPE,
+                                  **job.popen_args())
+    except OSError, msg:
+        logger.error('%s: %s' % (name, msg))
+        return False
+    reaper.watch_child(ffmpeg, name)
+    job.monitor(ffmpeg.stderr)
+    if ffmpeg.wait():
+        logger.error('%s failed' % name)
+        return False
+    return True
+
+def segment_cmd(plan, outname, start, duration):
+    cmd = plan.cmd(start)[:-1]  # all but the output, '-'
+    if duration:
+        cmd += ['-t', '%.3f' % duration]
+    return cmd + ['-y', outname]
+
+def encode(plan, outname, length=0, count=None):
+    """ Transcode plan's source (or its first length seconds) into
+        outname. Non-live work like this can use several cores: the
+        source is split at keyframes into up to count pieces (by
+        default parallel_segments, or one per core), which are encoded
+        at once, each by its own ffmpeg with the plan's settings, as
+        far as the scheduler allows, and then joined into one stream
+        with a stream copy. Returns True on success; raises
+        scheduler.Busy if not even one piece can start.
+
+    """
+    if count is None:
+        count = config.getParallelSegments(scheduler.CORES)
+    pieces = split_points(plan, count, length)
+    name = 'transcode of ' + plan.path
+
+    jobs = [scheduler.admit(scheduler.PUSH, name)]
+    for i in xrange(1, len(pieces)):
+        try:
+            jobs.append(scheduler.admit(scheduler.PUSH, name))
+        except scheduler.Busy:
+            break
+
+    if len(pieces) == 1:
+        try:
+            return run(jobs[0], segment_cmd(plan, outname, 0, length), name)
+        finally:
+            jobs[0].release()
+
+    segnames = ['%s.%d' % (outname, i) for i in xrange(len(pieces))]
+    todo = zip(segnames, pieces)
+    lock = threading.Lock()
+    failures = []
+
+    def worker(job):
+        while True:
+            lock.acquire()
+            try:
+                if not todo or failures:
+                    return
+                segname, (start, duration) = todo.pop(0)
+            finally:
+                lock.release()
+            cmd = segment_cmd(plan, segname, start, duration)
+            if not run(job, cmd, '%s at %.1f s' % (name, start)):
+                failures.append(segname)
+
+    logger.info('Transcoding "%s" in %d pieces, %d at a time' %
+                (unicode(plan.path, 'utf-8'), len(pieces), len(jobs)))
+    threads = [threading.Thread(target=worker, args=(job,))
+               for job in jobs]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    try:
+        if failures:
+            return False
+        # The concat protocol is fine for MPEG PS and TS; the copy
+        # straightens out the timestamps where the pieces join.
+        fmt = plan.settings()['format'].split()[:-1]
+        cmd = ([config.get_bin('ffmpeg'), '-i', 'concat:' + '|'.join(segnames),
+                '-vcodec', 'copy', '-acodec', 'copy'] + fmt +
+               ['-y', outname])
+        return run(jobs[0], cmd, 'joining ' + name)
+    finally:
+        for job in jobs:
+            job.release()
+        for segname in segnames:
+            try:
+                os.remove(segname)
+            except OSError:
+                pass
+
+def benchmark(path, tsn='', mime='video/x-tivo-mpeg', length=0, count=None):
+    """ Time a single ffmpeg against encode() for the same file, and
+        return the results (also logged).
+
+    """
+    plan = transcode.get_plan(path, tsn, mime, False)
+    if count is None:
+        count = config.getParallelSegments(scheduler.CORES)
+    tmpdir = tempfile.mkdtemp()
+    results = {'path': path, 'pieces': len(split_points(plan, count, length))}
+    try:
+        for mode, n in (('single', 1), ('parallel', count)):
+            outname = os.path.join(tmpdir, mode + '.mpg')
+            start = time.time()
+            ok = encode(plan, outname, length, n)
+            results[mode] = time.time() - start
+            results[mode + '_size'] = ok and os.path.getsize(outname) or 0
+    finally:
+        shutil.rmtree(tmpdir, True)
+    results['speedup'] = results['single'] / max(results['parallel'], 0.001)
+    logger.info(('%(path)s: single %(single).1f s, %(single_size)d bytes; ' +
+                 '%(pieces)d pieces %(parallel).1f s, %(parallel_size)d ' +
+                 'bytes; speedup %(speedup).2fx') % results)
+    return results
@@ -0,0 +1,287 @@
+import hashlib
+import logging
+import os
+import sys
+import threading
+import time
+
+import config
+import parallel
+import scheduler
+import spool
+import transcode
+
+logger = logging.getLogger('pyTivo.video.pretranscode')
+
+IDLE_CHECK = 60  # seconds between looks for an idle moment
+RESCAN = 3600    # seconds between scans of the shares
+
+FORMATS = ('video/x-tivo-mpeg', 'video/x-tivo-mpeg-ts')
+
+mswindows = (sys.platform == 'win32')
+
+cache = None
+worker = None
+failed = {}  # cache name -> True, for files ffmpeg couldn't convert;
+            # cleared on each rescan
+
+def get_cache():
+    """ The pre-transcode cache, or None if pretranscode_path isn't
+        set.
+
+    """
+    global cache
+    path = config.getPretranscodePath()
+    if not path:
+        cache = None
+    elif cache and cache.path == path:
+        cache.budget = config.getPretranscodeSize()
+    else:
+        try:
+            cache = spool.DiskCache(path, config.getPretranscodeSize(),
+                                    '.mpg')
+        except OSError, msg:
+            logger.error('Bad pretranscode_path: %s' % msg)
+            cache = None
+    return cache
+
+def default_mime(tsn):
+    """ The format this TiVo will ask for, as in the listings. """
+    if config.is_ts_capable(tsn) and config.has_ts_flag():
+        return 'video/x-tivo-mpeg-ts'
+    return 'video/x-tivo-mpeg'
+
+def get_plan(path, tsn, mime):
+    """ The TranscodePlan to pre-transcode path for this TiVo, or None
+        if it can't or needn't be. .tivo files aren't, since they have
+        to go through tivodecode.
+
+    """
+    if path[-5:].lower() == '.tivo' or mime not in FORMATS:
+        return None
+    try:
+        plan = transcode.get_plan(path, tsn, mime, False)
+    except OSError:
+        return None
+    if plan.compatible[0] or not plan.vInfo.get('Supported'):
+        return None
+    return plan
+
+def cache_name(plan, minutes):
+    # The mtime makes edited files miss; their old copies age out
+    key = (plan.path, plan.mtime, tuple(plan.cmd()), minutes)
+    return hashlib.sha1(repr(key)).hexdigest()
+
+def partial_seconds(plan, minutes):
+    """ Length of a pre-transcode of the first minutes of plan, or 0
+        if that covers the whole file.
+
+    """
+    if minutes and plan.vInfo.get('millisecs', 0) > minutes * 60000:
+        return minutes * 60
+    return 0
+
+def lookup(path, tsn, mime):
+    """ Returns (filename, size, seconds) for the cached output for
+        path, or None. seconds is 0 if the whole file is there, or the
+        length of the part that is.
+
+    """
+    c = get_cache()
+    if not c:
+        return None
+    plan = get_plan(path, tsn, mime)
+    if not plan:
+        return None
+    minutes = config.getPretranscodeMinutes()
+    if minutes and c.contains(cache_name(plan, 0)):
+        minutes = 0  # kept from a remux, see remux_file()
+    fname = c.lookup(cache_name(plan, minutes))
+    if not fname:
+        return None
+    try:
+        size = os.path.getsize(fname)
+    except OSError:
+        return None
+    return fname, size, partial_seconds(plan, minutes)
+
+def remux_file(plan):
+    """ For files that only need their streams copied into a new
+        container, the first live transcode is kept in the cache, so
+        that later plays are sent directly. Returns the SpoolFile for
+        TranscodeSession to copy the output to, or None.
+
+    """
+    c = get_cache()
+    if not c or plan.mime not in FORMATS or not plan.remux_only():
+        return None
+    name = cache_name(plan, 0)
+    if c.contains(name):
+        return None
+    try:
+        teefile = spool.SpoolFile(c, name)
+    except IOError, msg:
+        logger.error('Unable to keep remux: %s' % msg)
+        return None
+    logger.info('Keeping remux of "%s"' % unicode(plan.path, 'utf-8'))
+    return teefile
+
+def send_prefix(prefix, outFile, offset, thead=''):
+    """ Send a partial pre-transcode (from lookup()) from offset on as
+        HTTP chunks, after the TiVo header if any. The caller carries
+        on from len(thead) + size with a live transcode.
+
+    """
+    fname, size, seconds = prefix
+    count = 0
+    if offset < len(thead):
+        outFile.write('%x\r\n' % (len(thead) - offset))
+        outFile.write(thead[offset:])
+        outFile.write('\r\n')
+        count = len(thead) - offset
+        offset = len(thead)
+    f = open(fname, 'rb')
+    try:
+        count += spool.send_chunks(f, outFile, offset - len(thead), size)
+    finally:
+        f.close()
+    return count
+
+def warm(path, tsn='', mime=None):
+    """ Pre-transcode path for this TiVo, if it isn't cached already.
+        Returns True if it's in the cache afterwards. Raises
+        scheduler.Busy if there's no transcode slot free.
+
+    """
+    if mime is None:
+        mime = default_mime(tsn)
+    c = get_cache()
+    plan = get_plan(path, tsn, mime)
+    if not c or not plan:
+        return False
+    minutes = config.getPretranscodeMinutes()
+    if plan.remux_only():
+        minutes = 0  # cheap enough to do all of it
+    name = cache_name(plan, minutes)
+    if c.contains(name):
+        return True
+    if name in failed:
+        return False
+
+    part = c.filename(name) + '.%x.part' % id(plan)
+    oname = part
+    if mswindows:
+        oname = oname.encode('cp1252')
+
+    logger.info('Pre-transcoding "%s"' % unicode(path, 'utf-8'))
+    start = time.time()
+    if parallel.encode(plan, oname, partial_seconds(plan, minutes)):
+        size = os.path.getsize(part)
+        if c.reserve(size) and c.add(name, part):
+            logger.info('Pre-transcoded "%s", %d bytes in %.1f s' %
+                        (unicode(path, 'utf-8'), size, time.time() - start))
+            return True
+        logger.info('No room in the pre-transcode cache for "%s"' %
+                    unicode(path, 'utf-8'))
+        c.unreserve(size)
+    else:
+        logger.error('Pre-transcoding "%s" failed' % unicode(path, 'utf-8'))
+        failed[name] = True
+    try:
+        os.remove(part)
+    except OSError:
+        pass
+    return False
+
+def shares(name=None):
+    """ The video shares to pre-transcode: those with pretranscode set,
+        or just the one named.
+
+    """
+    result = []
+    for section, settings in config.getShares():
+        if settings.get('type') != 'video' or 'path' not in settings:
+            continue
+        if (name and section == name or
+            not name and settings.getboolean('pretranscode')):
+            result.append(settings['path'])
+    return result
+
+def tivos():
+    """ The TiVos to pre-transcode for: all known ones, or the defaults
+        if none are known yet.
+
+    """
+    return config.tivos.keys() or ['']
+
+def is_video(path):
+    """ Whether path is worth looking at: a video by the video plugin's
+        extension list. Without ffmpeg there's nothing to do anyway.
+
+    """
+    import video
+    return (video.use_extensions and
+            os.path.splitext(path)[1].lower() in video.EXTENSIONS)
+
+def candidates(share=None, tsns=None):
+    """ (path, tsn) pairs in the shares, in directory order. Each file
+        is probed once, for all the TiVos, and skipped if ffmpeg can't
+        read it.
+
+    """
+    for base in shares(share):
+        for root, dirs, files in os.walk(base):
+            dirs[:] = sorted([d for d in dirs if not d.startswith('.')])
+            for f in sorted(files):
+                path = os.path.join(root, f)
+                # .tivo files aren't pre-transcoded; see get_plan()
+                if (f.startswith('.') or path[-5:].lower() == '.tivo' or
+                    not is_video(path)):
+                    continue
+                try:
+                    if not transcode.video_info(path)['Supported']:
+                        continue
+                except OSError:
+                    continue
+                for tsn in tsns or tivos():
+                    yield path, tsn
+
+def idle():
+    """ Whether now is a good time for background work: no one is
+        watching anything.
+
+    """
+    return not transcode.sessions
+
+def run():
+    while True:
+        if get_cache():
+            failed.clear()
+            for path, tsn in candidates():
+                while not (get_cache() and idle()):
+                    time.sleep(IDLE_CHECK)
+                try:
+                    warm(path, tsn)
+                except scheduler.Busy:
+                    time.sleep(IDLE_CHECK)
+                except Exception, msg:
+                    logger.error('Pre-transcoding %s: %s' % (path, msg))
+            log_stats()
+        time.sleep(RESCAN)
+
+def log_stats():
+    if cache:
+        logger.info(('pre-transcode cache: %(hits)d hits, %(misses)d ' +
+                     'misses, %(evictions)d evicted, %(files)d files, ' +
+                     '%(used)d of %(budget)d bytes') % cache.stats())
+
+def start():
+    """ Start the background pre-transcode service (once). It does
+        nothing unless pretranscode_path is set.
+
+    """
+    global worker
+    if not worker:
+        worker = threading.Thread(target=run)
+        worker.setDaemon(True)
+        worker.start()
@@ -0,0 +1,129 @@
+import logging
+import Queue
+import threading
+import time
+
+import config
+import httpclient
+import mind
+
+logger = logging.getLogger('pyTivo.video.push')
+
+class PushPipeline(object):
+    """ Pushes go through two stages. Preparation (probing, metadata
+        and any MP4 remux) is done by a pool of push_workers threads.
+        Registration with the Mind (bodyOfferModify and subscribe) is
+        done by one thread per TiVo, as each file becomes ready, with
+        the TiVo's logged in Mind reused from one file to the next. So
+        the Mind calls for one file overlap the preparation of the
+        next ones, and nothing waits on a fixed delay. The time each
+        file spends queued, being prepared and being registered is
+        logged, with totals once the queue is empty.
+
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = Queue.Queue()
+        self.workers = []
+        self.registrars = {}  # tsn -> Queue of prepared pushes
+        self.busy = 0
+        self.totals = {'pushed': 0, 'failed': 0, 'wait': 0.0,
+                       'prepare': 0.0, 'register': 0.0}
+
+    def submit(self, plugin, item):
+        """ Queue item (a dict with path, name, tsn and url) to be
+            prepared by plugin.prepare_push() and pushed.
+
+        """
+        item['queued'] = time.time()
+        self.lock.acquire()
+        try:
+            self.busy += 1
+            while len(self.workers) < config.getPushWorkers():
+                worker = threading.Thread(target=self._prepare)
+                worker.setDaemon(True)
+                worker.start()
+                self.workers.append(worker)
+        finally:
+            self.lock.release()
+        self.pending.put((plugin, item))
+
+    def _registrar(self, tsn):
+        self.lock.acquire()
+        try:
+            if tsn not in self.registrars:
+                q = Queue.Queue()
+                thread = threading.Thread(target=self._register,
+                                          args=(tsn, q))
+                thread.setDaemon(True)
+                thread.start()
+                self.registrars[tsn] = q
+            return self.registrars[tsn]
+        finally:
+            self.lock.release()
+
+    def _prepare(self):
+        while True:
+            plugin, item = self.pending.get()
+            start = time.time()
+            item['wait'] = start - item['queued']
+            try:
+                push = plugin.prepare_push(item)
+            except Exception, msg:
+                logger.error('Preparing push of "%s": %s' %
+                             (unicode(item['path'], 'utf-8'), msg))
+                self._done(item, False)
+                continue
+            item['prepare'] = time.time() - start
+            self._registrar(item['tsn']).put((item, push))
+
+    def _register(self, tsn, q):
+        while True:
+            item, push = q.get()
+            start = time.time()
+            try:
+                mind.getMind(tsn).pushVideo(**push)
+                ok = True
+            except Exception, msg:
+                logger.error('Pushing "%s": %s' %
+                             (unicode(item['path'], 'utf-8'), msg))
+                ok = False
+            item['register'] = time.time() - start
+            if ok:
+                logger.info('Pushed "%s" to %s: queued %.1f s, prepared '
+                            'in %.1f s, registered in %.1f s' %
+                            (unicode(item['path'], 'utf-8'), tsn,
+                             item['wait'], item['prepare'], item['register']))
+            self._done(item, ok)
+
+    def _done(self, item, ok):
+        self.lock.acquire()
+        try:
+            self.busy -= 1
+            if ok:
+                self.totals['pushed'] += 1
+            else:
+                self.totals['failed'] += 1
+            for stage in ('wait', 'prepare', 'register'):
+                self.totals[stage] += item.get(stage, 0)
+            idle = not self.busy
+        finally:
+            self.lock.release()
+        if idle:
+            self.log_stats()
+
+    def log_stats(self):
+        logger.info(('pushes: %(pushed)d done, %(failed)d failed; ' +
+                     '%(wait).1f s queued, %(prepare).1f s preparing, ' +
+                     '%(register).1f s registering') % self.totals)
+        for key, m in mind.minds.items():
+            logger.info('Mind requests for %s: %s' %
+                        (key[0], ', '.join(['%s %d in %.1f s' % (name, n, t)
+                                            for name, (n, t) in
+                                            sorted(m.timings.items())])))
+        httpclient.log_stats()
+
+pipeline = PushPipeline()
+
+def submit(plugin, item):
+    pipeline.submit(plugin, item)
@@ -62,18 +62,27 @@
     SOFTWARE.
 """
 
+import array
 import logging
 import os
 import struct
+import sys
+from cStringIO import StringIO
 
-from StringIO import StringIO
+from lrucache import LRUCache
 
-VERSION = "1.7wjm3"
+import spool
+
+VERSION = "1.7wjm4"
 CHUNK_SIZE = 8192
 
 log = logging.getLogger('pyTivo.video.qt-faststart')
 
-count = 0
+# (path, mtime, size) -> output layout, see get_layout(); bounded by
+# the bytes of moov data held, as well as by count
+LAYOUT_BYTES = 32 * 1024 * 1024
+layouts = LRUCache(50)
+layout_bytes = {}  # key -> bytes of strings in its layout
 
 class FastStartException(Exception):
     pass
@@ -169,24 +178,52 @@ def find_atoms(size, datastream):
             # Ignore this atom, seek to the end of it.
             datastream.seek(atom_size - 8, os.SEEK_CUR)
 
-def output(outfile, skip, data):
-    global count
-    length = len(data)
-    if count + length > skip:
-        if skip > count:
-            data = data[skip - count:]
-        outfile.write(data)
-    count += length
-
-def process(datastream, outfile, skip=0):
+def patch_offsets(moov, atom_type, pos, offset):
     """
-        Convert a Quicktime/MP4 file for streaming by moving the metadata to
-        the front of the file. This method writes a new file.
+        Add offset to every entry of the stco or co64 atom whose
+        version field is at pos in moov (a bytearray), and return the
+        position of the end of the atom. stco tables are patched as
+        one array; co64 (only seen in files over 4 GiB) with one
+        struct call.
     """
+    version, entry_count = struct.unpack(">2L", str(moov[pos:pos + 8]))
+    pos += 8
+    log.info("Patching %s with %d entries" % (atom_type, entry_count))
+
+    if atom_type == "stco":
+        end = pos + 4 * entry_count
+        entries = array.array("I")
+        if entries.itemsize != 4:
+            entries = array.array("L")
+        entries.fromstring(str(moov[pos:end]))
+        if sys.byteorder == "little":
+            entries.byteswap()
+        entries = array.array(entries.typecode,
+                              [entry + offset for entry in entries])
+        if sys.byteorder == "little":
+            entries.byteswap()
+        moov[pos:end] = entries.tostring()
+    else:
+        end = pos + 8 * entry_count
+        table = struct.Struct(">%dQ" % entry_count)
+        moov[pos:end] = table.pack(*[entry + offset for entry in
+                                     table.unpack(str(moov[pos:end]))])
+    return end
+
+def get_layout(datastream):
+    """
+        Work out the streamable version of a Quicktime/MP4 file as a
+        list of pieces: strings (the ftyp atom and the patched moov)
+        and (position, size) ranges of the original file. The result
+        is cached by path and modification time, so resumes and
+        repeat plays don't re-read and re-patch the moov.
+    """
+    st = os.fstat(datastream.fileno())
+    key = (getattr(datastream, 'name', None), st.st_mtime, st.st_size)
+    if key[0] and key in layouts:
+        return layouts[key]
 
-    global count
-    count = 0
-
+    datastream.seek(0)
     # Get the top level atom index
     index = get_index(datastream)
 
@@ -209,7 +246,7 @@ def process(datastream, outfile, skip=0):
             # This is some strange zero atom with incorrect size
             free_size += 8
             log.info("Removing strange zero atom at %s (8 bytes)" % pos)
- 
+
     # Offset to shift positions
     offset = moov_size - free_size
 
@@ -219,61 +256,100 @@ def process(datastream, outfile, skip=0):
         if not free_size:
             # No free atoms and moov is correct, we are done!
             log.debug('mp4 already streamable -- copying')
-            datastream.seek(skip)
-            while True:
-                block = datastream.read(CHUNK_SIZE)
-                if not block:
-                    break
-                output(outfile, 0, block)
-            return count
+            layout = [(0, st.st_size)]
+            if key[0]:
+                remember(key, layout)
+            return layout
 
     # Read and fix moov
     datastream.seek(moov_pos)
-    moov = StringIO(datastream.read(moov_size))
+    data = datastream.read(moov_size)
+    moov = bytearray(data)
+    reader = StringIO(data)
 
     # Ignore moov identifier and size, start reading children
-    moov.seek(8)
-
-    for atom_type in find_atoms(moov_size - 8, moov):
-        # Read either 32-bit or 64-bit offsets
-        ctype, csize = atom_type == "stco" and ("L", 4) or ("Q", 8)
-
-        # Get number of entries
-        version, entry_count = struct.unpack(">2L", moov.read(8))
-
-        log.info("Patching %s with %d entries" % (atom_type, entry_count))
-
-        # Read entries
-        entries = struct.unpack(">" + ctype * entry_count,
-                                moov.read(csize * entry_count))
-
-        # Patch and write entries
-        moov.seek(-csize * entry_count, os.SEEK_CUR)
-        moov.write(struct.pack(">" + ctype * entry_count,
-                               *[entry + offset for entry in entries]))
-
-    log.info("Writing output...")
+    reader.seek(8)
+    for atom_type in find_atoms(moov_size - 8, reader):
+        reader.seek(patch_offsets(moov, atom_type, reader.tell(), offset))
 
-    # Write ftype
+    layout = []
     for atom, pos, size in index:
         if atom == "ftyp":
             datastream.seek(pos)
-            output(outfile, skip, datastream.read(size))
-
-    # Write moov
-    moov.seek(0)
-    output(outfile, skip, moov.read())
-
-    # Write the rest
-    atoms = [item for item in index if item[0] not in ["ftyp", "moov", "free"]]
-    for atom, pos, size in atoms:
-        datastream.seek(pos)
-
-        # Write in chunks to not use too much memory
-        for x in range(size / CHUNK_SIZE):
-            output(outfile, skip, datastream.read(CHUNK_SIZE))
+            layout.append(datastream.read(size))
+    layout.append(str(moov))
+    for atom, pos, size in index:
+        if atom not in ["ftyp", "moov", "free"]:
+            if not size and atom == "mdat":
+                size = st.st_size - pos  # final mdat of unknown size
+            if size:
+                layout.append((pos, size))
+    if key[0]:
+        remember(key, layout)
+    return layout
+
+def remember(key, layout):
+    """ Cache a layout, dropping the least recently used ones while
+        their strings come to more than LAYOUT_BYTES.
 
-        if size % CHUNK_SIZE:
-            output(outfile, skip, datastream.read(size % CHUNK_SIZE))
+    """
+    size = sum([len(piece) for piece in layout if isinstance(piece, str)])
+    if size > LAYOUT_BYTES:
+        return
+    layouts[key] = layout
+    layout_bytes[key] = size
+    # Iterating doesn't count as a use; it goes oldest first
+    keys = list(layouts)
+    for old in layout_bytes.keys():
+        if old not in layouts:
+            del layout_bytes[old]
+    total = sum(layout_bytes.values())
+    for old in keys:
+        if total <= LAYOUT_BYTES:
+            break
+        total -= layout_bytes.pop(old)
+        del layouts[old]
+
+def output_size(datastream):
+    """ Length of the streamable version of the file. """
+    total = 0
+    for piece in get_layout(datastream):
+        if isinstance(piece, str):
+            total += len(piece)
+        else:
+            total += piece[1]
+    return total
 
-    return count - skip
+def process(datastream, outfile, skip=0, length=None):
+    """
+        Send a Quicktime/MP4 file to outfile with the metadata at the
+        front, from byte skip of the result on (and at most length
+        bytes). The parts taken straight from the file go out with
+        sendfile() when it's available. Returns the number of bytes
+        written. Safe to use from several threads at once.
+    """
+    count = 0
+    pos = 0
+    for piece in get_layout(datastream):
+        if length is not None and count >= length:
+            break
+        if isinstance(piece, str):
+            size = len(piece)
+        else:
+            size = piece[1]
+        if pos + size > skip:
+            start = max(skip - pos, 0)
+            want = size - start
+            if length is not None:
+                want = min(want, length - count)
+            if isinstance(piece, str):
+                outfile.write(piece[start:start + want])
+                count += want
+            else:
+                sent = spool.send_range(datastream, outfile,
+                                        piece[0] + start, want)
+                count += sent
+                if sent < want:
+                    break
+        pos += size
+    return count
@@ -0,0 +1,353 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+
+try:
+    from sendfile import sendfile
+except ImportError:
+    sendfile = None
+
+import config
+
+logger = logging.getLogger('pyTivo.video.spool')
+
+BLOCKSIZE = 512 * 1024
+
+swept = set()  # (path, suffix) already cleared of .part files
+
+def send_range(f, outFile, offset, length, chunked=False):
+    """ Copy length bytes of the open file f, starting at offset, to
+        outFile (a socket file), optionally as one HTTP chunk. Uses
+        sendfile(2) when the sendfile module is installed. Returns the
+        number of bytes sent. A chunk is cut to what the file holds,
+        and if even that can't be read in full, IOError is raised,
+        since the chunk size has already gone out.
+
+    """
+    if chunked:
+        length = min(length, os.fstat(f.fileno()).st_size - offset)
+        if length <= 0:
+            return 0
+        outFile.write('%x\r\n' % length)
+    count = 0
+    if sendfile:
+        outFile.flush()
+        out_fd = outFile.fileno()
+        in_fd = f.fileno()
+        while count < length:
+            sent = sendfile(out_fd, in_fd, offset + count, length - count)
+            if not sent:
+                break
+            count += sent
+    else:
+        f.seek(offset)
+        while count < length:
+            block = f.read(min(BLOCKSIZE, length - count))
+            if not block:
+                break
+            outFile.write(block)
+            count += len(block)
+    if chunked:
+        if count < length:
+            raise IOError('short read: %d of %d bytes' % (count, length))
+        outFile.write('\r\n')
+    return count
+
+class DiskCache(object):
+    """ A directory of cached files kept within a byte budget, evicting
+        the least recently used complete files first. Files being
+        written are named <name><suffix>[.<id>].part and are never
+        evicted; any of this suffix left over from a previous run are
+        removed by the first DiskCache for the directory in a process,
+        so that a later one (after a settings change) doesn't delete
+        files still being written.
+
+    """
+    def __init__(self, path, budget, suffix=''):
+        self.path = path
+        self.budget = budget
+        self.suffix = suffix
+        self.lock = threading.Lock()
+        self.entries = {}  # name -> [size, last used]
+        self.in_use = {}   # name -> count
+        self.used = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        sweep = (path, suffix) not in swept
+        swept.add((path, suffix))
+        for name in os.listdir(path):
+            fname = os.path.join(path, name)
+            if name.endswith('.part'):
+                if sweep and (suffix + '.') in name:
+                    try:
+                        os.remove(fname)
+                    except OSError:
+                        pass
+            elif name.endswith(suffix) and os.path.isfile(fname):
+                st = os.stat(fname)
+                self.entries[name[:len(name) - len(suffix)]] = [st.st_size,
+                                                                st.st_mtime]
+                self.used += st.st_size
+
+    def filename(self, name):
+        return os.path.join(self.path, name + self.suffix)
+
+    def lookup(self, name):
+        """ Return the path of the complete file for name, or None. """
+        self.lock.acquire()
+        try:
+            if name in self.entries:
+                self.entries[name][1] = time.time()
+                self.hits += 1
+                return self.filename(name)
+            self.misses += 1
+            return None
+        finally:
+            self.lock.release()
+
+    def contains(self, name):
+        """ Like lookup(), but without counting a hit or miss. """
+        self.lock.acquire()
+        try:
+            return name in self.entries
+        finally:
+            self.lock.release()
+
+    def acquire(self, name):
+        self.lock.acquire()
+        try:
+            self.in_use[name] = self.in_use.get(name, 0) + 1
+        finally:
+            self.lock.release()
+
+    def release(self, name):
+        self.lock.acquire()
+        try:
+            self.in_use[name] -= 1
+            if not self.in_use[name]:
+                del self.in_use[name]
+        finally:
+            self.lock.release()
+
+    def reserve(self, nbytes):
+        """ Account for nbytes more being written, evicting old files as
+            needed. Returns False if the budget can't be met.
+
+        """
+        self.lock.acquire()
+        try:
+            self.used += nbytes
+            if self.used > self.budget:
+                victims = sorted([(v[1], k) for k, v in self.entries.items()
+                                  if k not in self.in_use])
+                for atime, name in victims:
+                    if self.used <= self.budget:
+                        break
+                    self._remove(name)
+                    self.evictions += 1
+            return self.used <= self.budget
+        finally:
+            self.lock.release()
+
+    def unreserve(self, nbytes):
+        self.lock.acquire()
+        try:
+            self.used -= nbytes
+        finally:
+            self.lock.release()
+
+    def add(self, name, part):
+        """ Make the finished file part the cached copy of name. """
+        fname = self.filename(name)
+        self.lock.acquire()
+        try:
+            if name in self.entries:
+                self._remove(name)
+            try:
+                os.rename(part, fname)
+            except OSError, msg:
+                logger.info(msg)
+                return None
+            self.entries[name] = [os.path.getsize(fname), time.time()]
+            return fname
+        finally:
+            self.lock.release()
+
+    def remove(self, name):
+        self.lock.acquire()
+        try:
+            if name in self.entries:
+                self._remove(name)
+        finally:
+            self.lock.release()
+
+    def _remove(self, name):
+        size = self.entries.pop(name)[0]
+        try:
+            os.remove(self.filename(name))
+        except OSError, msg:
+            logger.info(msg)
+        self.used -= size
+
+    def stats(self):
+        return {'files': len(self.entries), 'used': self.used,
+                'budget': self.budget, 'hits': self.hits,
+                'misses': self.misses, 'evictions': self.evictions}
+
+class SpoolFile(object):
+    """ The on-disk copy of one transcode's output, written as it is
+        produced, so that any part of it already encoded can be sent
+        again.
+
+    """
+    def __init__(self, cache, name):
+        self.cache = cache
+        self.name = name
+        self.part = cache.filename(name) + '.%x.part' % id(self)
+        self.out = open(self.part, 'wb')
+        self.size = 0
+        self.done = False
+        self.kept = False
+        self.failed = False
+
+    def write(self, block):
+        if self.failed:
+            return
+        if not self.cache.reserve(len(block)):
+            logger.info('spool full, no longer spooling %s' % self.name)
+            self.cache.unreserve(len(block))
+            self.abort()
+            return
+        try:
+            self.out.write(block)
+            self.out.flush()
+            self.size += len(block)
+        except IOError, msg:
+            logger.info(msg)
+            self.cache.unreserve(len(block))
+            self.abort()
+
+    def finish(self, keep):
+        """ The stream is complete; if keep is set, the file stays in
+            the cache for replay after the session is gone.
+
+        """
+        if self.failed or self.done:
+            return
+        self.out.close()
+        self.done = True
+        if keep:
+            self.kept = bool(self.cache.add(self.name, self.part))
+
+    def abort(self):
+        """ Stop spooling, and drop the file unless it was kept. """
+        if self.failed:
+            return
+        self.failed = True
+        if not self.done:
+            self.out.close()
+        if not self.kept:
+            self._discard()
+
+    def _discard(self):
+        self.cache.unreserve(self.size)
+        try:
+            os.remove(self.part)
+        except OSError:
+            pass
+
+    def send(self, outFile, offset, length):
+        """ Send already spooled output as one HTTP chunk. """
+        for fname in (self.part, self.cache.filename(self.name)):
+            try:
+                f = open(fname, 'rb')
+            except IOError:
+                continue
+            try:
+                return send_range(f, outFile, offset, length, True)
+            finally:
+                f.close()
+        raise IOError('spool file for %s is gone' % self.name)
+
+spool = None
+
+def get_spool():
+    """ The transcode spool, or None if spool_path isn't set. """
+    global spool
+    path = config.getSpoolPath()
+    if not path:
+        spool = None
+    elif spool and spool.path == path:
+        spool.budget = config.getSpoolSize()
+    else:
+        try:
+            spool = DiskCache(path, config.getSpoolSize(), '.spool')
+        except OSError, msg:
+            logger.error('Bad spool_path: %s' % msg)
+            spool = None
+    return spool
+
+def spool_name(key):
+    return hashlib.sha1(repr(key)).hexdigest()
+
+def send_chunks(f, outFile, offset, length=None):
+    """ Send the open file f from offset on (length bytes, or to the
+        end) as HTTP chunks. Returns the number of bytes sent.
+
+    """
+    count = 0
+    end = os.fstat(f.fileno()).st_size
+    if length is not None:
+        end = min(end, offset + length)
+    while offset < end:
+        sent = send_range(f, outFile, offset,
+                          min(end - offset, 8 * BLOCKSIZE), True)
+        if not sent:
+            break
+        offset += sent
+        count += sent
+    return count
+
+def send_spooled(name, outFile, offset):
+    """ Send a complete spooled stream from offset on as HTTP chunks. """
+    count = 0
+    spool.acquire(name)
+    try:
+        try:
+            # The one place a replay counts as a hit
+            fname = spool.lookup(name)
+            if not fname:
+                return 0
+            f = open(fname, 'rb')
+            try:
+                count = send_chunks(f, outFile, offset)
+            finally:
+                f.close()
+        except Exception, msg:
+            logger.info(msg)
+    finally:
+        spool.release(name)
+    return count
+
+def spooled_size(name):
+    """ Size of the complete spooled stream for name, or 0 """
+    cache = get_spool()
+    if cache and cache.contains(name):
+        try:
+            return os.path.getsize(cache.filename(name))
+        except OSError:
+            pass
+    return 0
+
+def log_stats():
+    if spool:
+        stats = spool.stats()
+        logger.info(('spool: %(hits)d hits, %(misses)d misses, ' +
+                     '%(evictions)d evicted, %(files)d files, ' +
+                     '%(used)d of %(budget)d bytes') % stats)
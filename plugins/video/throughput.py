@@ -0,0 +1,127 @@
+import logging
+import threading
+import time
+
+import config
+
+logger = logging.getLogger('pyTivo.video.throughput')
+
+HISTORY = 10          # samples kept per TiVo
+BURST = 4 * 1024 ** 2 # bytes at the start of each send that are timed
+MIN_BURST_TIME = 0.05 # seconds; faster than this says nothing useful
+HEADROOM = 0.8        # share of the measured rate a stream may use
+DECISION_TTL = 600    # seconds a ceiling stands, so resumes match
+
+lock = threading.Lock()
+rates = {}      # tsn -> network rates in bits/s, newest last
+speeds = {}     # tsn -> encoder speeds (x realtime), newest last
+decisions = {}  # tsn -> (time, ceiling)
+
+def _add(samples, tsn, value):
+    lock.acquire()
+    try:
+        history = samples.setdefault(tsn, [])
+        history.append(value)
+        del history[:-HISTORY]
+    finally:
+        lock.release()
+
+def record_rate(tsn, count, seconds):
+    """ Note how long the start of a send to this TiVo spent blocked
+        writing count bytes. Only the first BURST bytes are timed:
+        the TiVo reads as fast as it can until its buffer fills, after
+        which writes are paced by playback and say nothing about the
+        network.
+
+    """
+    if not tsn or count < BURST / 4 or seconds < MIN_BURST_TIME:
+        return
+    rate = count * 8 / seconds
+    _add(rates, tsn, rate)
+    logger.debug('%s: %d bytes in %.2f s, %.0f kb/s' %
+                 (tsn, count, seconds, rate / 1000))
+
+def record_speed(tsn, speed):
+    """ Note an encoder's final speed for a transcode to this TiVo. """
+    if tsn and speed:
+        _add(speeds, tsn, speed)
+
+def _median(values):
+    values = sorted(values)
+    return values[len(values) / 2]
+
+def ceiling(tsn):
+    """ Returns (bits/s the network to this TiVo can be trusted with,
+        or None; factor for a slow encoder) if adaptive_bitrate is set
+        for it, or None. Decided from the history at most every
+        DECISION_TTL seconds, and logged with its inputs.
+
+    """
+    if not config.get_profile(tsn).adaptive:
+        return None
+    now = time.time()
+    lock.acquire()
+    try:
+        if tsn in decisions and decisions[tsn][0] + DECISION_TTL > now:
+            return decisions[tsn][1]
+        history = list(rates.get(tsn, []))
+        encoder = list(speeds.get(tsn, []))
+    finally:
+        lock.release()
+
+    capacity = network = None
+    if history:
+        # The harmonic mean leans towards the bad samples
+        capacity = len(history) / sum([1.0 / r for r in history])
+        network = int(capacity * HEADROOM)
+    factor = 1.0
+    speed = None
+    if encoder:
+        speed = _median(encoder)
+        factor = min(1.0, speed)
+    result = (network, factor)
+
+    lock.acquire()
+    try:
+        decisions[tsn] = (now, result)
+    finally:
+        lock.release()
+    if history or encoder:
+        logger.info('Bitrate ceiling for %s: %d network samples%s, %d '
+                    'encoder samples%s; headroom %.0f%% -> %s, x %.2f' %
+                    (tsn, len(history),
+                     capacity and ' (%.0f kb/s)' % (capacity / 1000) or '',
+                     len(encoder), speed and ' (%.2fx)' % speed or '',
+                     HEADROOM * 100,
+                     network and '%d kb/s' % (network / 1000) or 'none',
+                     factor))
+    return result
+
+def adapt(tsn, video_bps, audio_bps, limits):
+    """ The video bitrate to use for a transcode to this TiVo, given
+        the one configured and the limits from ceiling(), kept within
+        min_video_br and the configured rate.
+
+    """
+    if not limits:
+        return video_bps
+    network, factor = limits
+    rate = video_bps
+    if network:
+        rate = min(rate, network - audio_bps)
+    rate = int(rate * factor)
+    low = min(config.get_profile(tsn).min_video_bps, video_bps)
+    rate = max(low, min(rate, video_bps))
+    if rate != video_bps:
+        logger.info('Video bitrate for %s: %d kb/s (configured %d kb/s, '
+                    'floor %d kb/s)' % (tsn, rate / 1000, video_bps / 1000,
+                                        low / 1000))
+    return rate
+
+def stats():
+    lock.acquire()
+    try:
+        return {'rates': dict([(t, list(r)) for t, r in rates.items()]),
+                'speeds': dict([(t, list(s)) for t, s in speeds.items()])}
+    finally:
+        lock.release()
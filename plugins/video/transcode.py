@@ -1,3 +1,4 @@
+import bisect
 import logging
 import math
 import os
@@ -14,19 +15,28 @@ import lrucache
 
 import config
 import metadata
+import reaper
+import scheduler
+import spool
+import throughput
+import tivodecrypt
+from reaper import kill
 
 logger = logging.getLogger('pyTivo.video.transcode')
 
 info_cache = lrucache.LRUCache(1000)
-ffmpeg_procs = {}
-reapers = {}
+plan_cache = lrucache.LRUCache(1000)
+keyframe_cache = lrucache.LRUCache(100)
+sessions = {}  # Running TranscodeSessions, listed by session_key()
+sessions_lock = threading.Lock()
 
 GOOD_MPEG_FPS = ['23.98', '24.00', '25.00', '29.97',
                  '30.00', '50.00', '59.94', '60.00']
 
 BLOCKSIZE = 512 * 1024
-MAXBLOCKS = 2
+READSIZE = 64 * 1024
 TIMEOUT = 600
+SPECULATIVE = 30  # seconds a speculative session waits for its GET
 
 # XXX BIG HACK
 # subprocess is broken for me on windows so super hack
@@ -53,12 +63,128 @@ def debug(msg):
                 msg = msg.decode('cp1252')
     logger.debug(msg)
 
-def transcode(isQuery, inFile, outFile, tsn='', mime='', thead=''):
-    settings = {'video_codec': select_videocodec(inFile, tsn, mime),
-                'video_br': select_videobr(inFile, tsn),
+class TranscodePlan(object):
+    """ Everything pyTivo decides about sending one file to one TiVo in
+        one format: the compatibility verdict, the estimated size, the
+        chosen streams and the ffmpeg command line. Plans are built by
+        get_plan() once per (path, mtime, tsn, mime, limits) and shared
+        by listings, TVBus details and streaming, so treat them as
+        read-only. The more expensive parts are worked out on first
+        use and then kept. limits, if set, are the bitrate limits for
+        this TiVo from throughput.ceiling().
+
+    """
+    def __init__(self, inFile, mtime, tsn='', mime='', limits=None):
+        self.path = inFile
+        self.mtime = mtime
+        self.tsn = tsn
+        self.mime = mime
+        self.limits = limits
+        self.is_tivo_file = (inFile[-5:].lower() == '.tivo')
+
+        self.vInfo = video_info(inFile)
+        self.compatible = tivo_compatible(inFile, tsn, mime)
+
+        self._est_size = None
+        self._video_str = None
+        self._full_str = None
+        self._settings = {}
+        self._cmd = None
+
+    def video_str(self):
+        if self._video_str is None:
+            self._full_str = video_str = select_videostr(self.path, self.tsn)
+            if (self.limits and
+                not tivo_compatible_video(self.vInfo, self.tsn)[0]):
+                audio_bps = config.getMaxAudioBR(self.tsn) * 1000
+                video_str = throughput.adapt(self.tsn, video_str, audio_bps,
+                                             self.limits)
+            self._video_str = video_str
+        return self._video_str
+
+    def byte_rate(self):
+        """ Planned output bytes per second: audio and video bit rate,
+            adding 2%.
+
+        """
+        bitrate = config.getMaxAudioBR(self.tsn) * 1000 + self.video_str()
+        return bitrate * 1.02 / 8
+
+    def est_size(self):
+        if self._est_size is None:
+            if self.compatible[0]:
+                size = os.path.getsize(unicode(self.path, 'utf-8'))
+            else:
+                size = int((self.vInfo['millisecs'] / 1000) *
+                           self.byte_rate())
+            self._est_size = size
+        return self._est_size
+
+    def remux_only(self):
+        """ Whether the container is the only problem, so that ffmpeg
+            just copies the streams into a new one.
+
+        """
+        if (self.compatible[0] or self.is_tivo_file or
+            not self.compatible[1].startswith('container')):
+            return False
+        settings = self.settings()
+        return (settings['video_codec'].startswith('-vcodec copy') and
+                settings['audio_codec'].startswith('-acodec copy'))
+
+    def describe(self):
+        """ The source and target, in brief, for the log. """
+        v = self.vInfo
+        return ('source %s %sx%s %s fps %s kb/s, audio %s %s kb/s; '
+                'TiVo %s, video %d kb/s' %
+                (v.get('vCodec'), v.get('vWidth'), v.get('vHeight'),
+                 v.get('vFps'), v.get('kbps'), v.get('aCodec'),
+                 v.get('aKbps'), self.tsn[:3] or 'default',
+                 self.video_str() / 1000))
+
+    def can_seek(self):
+        """ Whether ffmpeg can be started part way into the source.
+            .tivo files are piped through tivodecode, so they can't.
+
+        """
+        return (not self.is_tivo_file and not self.compatible[0] and
+                self.vInfo.get('millisecs', 0) > 0)
+
+    def seek_time(self, offset, hlen=0):
+        """ The source time, in seconds, at which to start ffmpeg so
+            that its output lines up with byte offset of the full
+            stream (after an hlen byte TiVo header). The estimate from
+            the planned constant bitrate is moved back to the previous
+            keyframe, if the source has been indexed.
+
+        """
+        duration = self.vInfo['millisecs'] / 1000.0
+        pos = max(0.0, min((offset - hlen) / self.byte_rate(),
+                           duration - 1))
+        if self.path in keyframe_cache:
+            mtime, frames = keyframe_cache[self.path]
+            i = bisect.bisect_right(frames, pos)
+            if mtime == self.mtime and i:
+                pos = frames[i - 1]
+        return pos
+
+    def settings(self, isQuery=False):
+        """ The ffmpeg template settings. Unless isQuery is set, working
+            these out may probe the audio with ffmpeg.
+
+        """
+        if isQuery not in self._settings:
+            inFile, tsn, mime = self.path, self.tsn, self.mime
+            video_str = self.video_str()
+            scale = 1.0
+            if self._full_str:
+                scale = float(video_str) / self._full_str
+            self._settings[isQuery] = {
+                'video_codec': select_videocodec(inFile, tsn, mime),
+                'video_br': '-b %dk' % (video_str / 1000),
                 'video_fps': select_videofps(inFile, tsn),
                 'max_video_br': select_maxvideobr(tsn),
-                'buff_size': select_buffsize(tsn),
+                'buff_size': select_buffsize(tsn, scale),
                 'aspect_ratio': ' '.join(select_aspect(inFile, tsn)),
                 'audio_br': select_audiobr(tsn),
                 'audio_fr': select_audiofr(inFile, tsn),
@@ -67,112 +193,730 @@ def transcode(isQuery, inFile, outFile, tsn='', mime='', thead=''):
                 'audio_lang': select_audiolang(inFile, tsn),
                 'ffmpeg_pram': select_ffmpegprams(tsn),
                 'format': select_format(tsn, mime)}
+        return self._settings[isQuery]
+
+    def cmd(self, seek=0):
+        """ The ffmpeg argv for this plan, reading from stdin for .tivo
+            files (fed by tivodecode or tivodecrypt), or '' if no ffmpeg
+            is needed.
+            If seek is given, ffmpeg starts that many seconds in.
+
+        """
+        if seek:
+            cmd = self.cmd()
+            i = cmd.index('-i')
+            return cmd[:i] + ['-ss', '%.3f' % seek] + cmd[i:]
+        if self._cmd is None:
+            if (self.is_tivo_file and
+                get_plan(self.path, self.tsn).compatible[0]):
+                self._cmd = ''
+            else:
+                if self.is_tivo_file:
+                    fname = '-'
+                else:
+                    fname = unicode(self.path, 'utf-8')
+                    if mswindows:
+                        fname = fname.encode('cp1252')
+                cmd_string = config.getFFmpegTemplate(self.tsn) % \
+                             self.settings()
+                self._cmd = ([config.get_bin('ffmpeg'), '-i', fname] +
+                             cmd_string.split())
+        return self._cmd
+
+def get_plan(inFile, tsn='', mime='', adaptive=True):
+    """ The TranscodePlan for sending inFile to this TiVo now. Unless
+        adaptive is False (for output that's kept, like pre-transcodes),
+        the video bitrate may be lowered to what the TiVo's connection
+        has been seen to sustain, if adaptive_bitrate is set. Plans
+        made before the settings last changed aren't reused.
+
+    """
+    mtime = os.path.getmtime(unicode(inFile, 'utf-8'))
+    limits = None
+    if adaptive:
+        limits = throughput.ceiling(tsn)
+    key = (inFile, mtime, tsn, mime, limits, config.generation)
+    if key in plan_cache:
+        return plan_cache[key]
+    plan = TranscodePlan(inFile, mtime, tsn, mime, limits)
+    plan_cache[key] = plan
+    return plan
+
+def session_key(inFile, tsn='', mime='', thead=''):
+    """ Sessions are shared by any request that would produce the same
+        bytes: the same file, ffmpeg argv and faked TiVo header.
+
+    """
+    cmd = get_plan(inFile, tsn, mime).cmd()
+    return (inFile, tuple(cmd), thead)
+
+def find_session(key, offset):
+    """ Return a running session for key that can still supply output
+        from offset on, or None.
+
+    """
+    sessions_lock.acquire()
+    try:
+        for session in sessions.get(key, []):
+            if session.covers(offset):
+                return session
+    finally:
+        sessions_lock.release()
+    return None
+
+def add_session(session):
+    sessions_lock.acquire()
+    try:
+        sessions.setdefault(session.key, []).append(session)
+    finally:
+        sessions_lock.release()
+
+def remove_session(session):
+    """ Returns False if session had already been removed. """
+    sessions_lock.acquire()
+    try:
+        running = sessions.get(session.key, [])
+        if session not in running:
+            return False
+        running.remove(session)
+        if not running:
+            del sessions[session.key]
+        return True
+    finally:
+        sessions_lock.release()
+
+class Cursor(object):
+    """ One HTTP consumer's read position in a TranscodeSession. """
+    def __init__(self, offset):
+        self.offset = offset
+
+class TranscodeSession(object):
+    """ One running encoder (ffmpeg, and tivodecode for .tivo files)
+        whose output may be read by several HTTP consumers at once.
+        A reader thread drains the encoder into a fixed size ring
+        buffer, so that neither a slow network nor a slow encoder
+        stalls the other; it waits only when the ring is full of
+        output that some consumer hasn't read yet (or, with nobody
+        attached, that the last consumer to leave hadn't), which
+        also lets a TiVo resume a little way back. Each consumer has
+        its own Cursor. If the spool is enabled, everything is also
+        written to a SpoolFile, and output no longer in the ring is
+        sent from there. A tee SpoolFile, if given, gets a copy of the
+        output without the TiVo header, to keep once it's complete.
+        The encoder keeps running until the stream ends or the session
+        is reaped after the last consumer has gone. A speculative
+        session (see speculate()) is reaped after SPECULATIVE seconds
+        if no consumer ever attaches.
+
+    """
+    def __init__(self, key, procs, thead='', spoolfile=None, offset=0,
+                 job=None, tee=None, speculative=False, tsn=''):
+        self.key = key
+        self.path = key[0]
+        self.tsn = tsn
+        self.procs = procs
+        self.stdout = procs[-1].stdout
+        self.spool = spoolfile
+        self.job = job
+        self.tee = tee
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.size = max(config.getTranscodeBuffer(), 2 * READSIZE)
+        self.prebuffer = min(config.getTranscodePrebuffer(), self.size)
+        self.ring = bytearray(self.size)
+        self.base = offset
+        self.start = offset  # oldest output still in the ring
+        self.end = offset    # output produced so far
+        self.mark = offset   # where the last consumer left off
+        self.eof = False
+        self.error = None
+        self.stopped = False
+        self.primed = False
+        self.cursors = []
+        self.started = time.time()
+        self.last_read = self.started
+        self.speculative = speculative
+        self.claimed = False
+        self.underruns = 0
+        self.stalls = 0
+        if thead:
+            self._put(thead)
+            if self.spool:
+                self.spool.write(thead)
+        self.reader = threading.Thread(target=self._fill)
+        self.reader.setDaemon(True)
+        self.reader.start()
+
+    def spooled(self):
+        return self.spool and not self.spool.failed
+
+    def covers(self, offset):
+        if self.spooled():
+            start = 0
+        else:
+            start = self.start
+        return (start <= offset < self.end or
+                (offset == self.end and not self.eof))
+
+    def attach(self, offset):
+        """ Add a consumer starting at offset; None if that part of the
+            output is no longer (or not yet) available.
+
+        """
+        self.lock.acquire()
+        try:
+            if not self.covers(offset):
+                return None
+            cursor = Cursor(offset)
+            self.cursors.append(cursor)
+            if self.speculative and not self.claimed:
+                debug('claimed speculative transcode of %s after %.1f s, '
+                      '%d bytes ready' % (self.path,
+                                          time.time() - self.started,
+                                          self.end - self.base))
+            self.claimed = True
+            self.last_read = time.time()
+            self.changed.notifyAll()
+            return cursor
+        finally:
+            self.lock.release()
+
+    def detach(self, cursor):
+        self.lock.acquire()
+        try:
+            if cursor in self.cursors:
+                self.cursors.remove(cursor)
+                if not self.cursors:
+                    self.mark = max(cursor.offset, self.start)
+            self.changed.notifyAll()
+            return len(self.cursors)
+        finally:
+            self.lock.release()
+
+    def consumers(self):
+        return len(self.cursors)
+
+    def warm(self):
+        """ Whether this is a speculative session nobody has used yet. """
+        return self.speculative and not self.claimed
+
+    def last_used(self):
+        """ For the reaper: unclaimed speculative sessions look
+            TIMEOUT - SPECULATIVE seconds older than they are.
+
+        """
+        if self.warm():
+            return self.last_read - TIMEOUT + SPECULATIVE
+        return self.last_read
+
+    def _floor(self):
+        """ The oldest output that must not be overwritten. Anything
+            before self.start is in the spool, if it's anywhere.
+
+        """
+        if not self.cursors:
+            return self.mark
+        return min([max(c.offset, self.start) for c in self.cursors])
+
+    def _put(self, data):
+        # Only used before the reader starts
+        pos = self.end - self.base
+        self.ring[pos:pos + len(data)] = data
+        self.end += len(data)
+
+    def _fill(self):
+        """ Reader thread: copy encoder output into the ring. """
+        view = memoryview(self.ring)
+        while True:
+            self.lock.acquire()
+            try:
+                stalled = False
+                while (not self.stopped and
+                       self.end - self._floor() >= self.size):
+                    if not stalled:
+                        self.stalls += 1
+                        stalled = True
+                    self.changed.wait()
+                if self.stopped:
+                    return
+                pos = (self.end - self.base) % self.size
+                room = min(self.size - pos, READSIZE,
+                           self.size - (self.end - self._floor()))
+                # Claim the space before filling it
+                self.start = max(self.start, self.end + room - self.size)
+            finally:
+                self.lock.release()
+
+            try:
+                count = self.stdout.readinto(view[pos:pos + room])
+            except Exception, msg:
+                self.lock.acquire()
+                try:
+                    if not self.stopped:
+                        logger.info(msg)
+                        self.error = str(msg)
+                    self.eof = True
+                    self.changed.notifyAll()
+                finally:
+                    self.lock.release()
+                self.release()
+                return
+
+            failure = None
+            if not count:
+                failure = self._exit_status()
+
+            self.lock.acquire()
+            try:
+                if self.stopped:
+                    return
+                if count:
+                    self.end += count
+                else:
+                    self.eof = True
+                    if failure:
+                        logger.info(failure)
+                        self.error = failure
+                self.changed.notifyAll()
+            finally:
+                self.lock.release()
+
+            for spoolfile, keep in ((self.spool, config.getSpoolKeep()),
+                                    (self.tee, True)):
+                if spoolfile:
+                    if count:
+                        spoolfile.write(view[pos:pos + count])
+                    elif failure:
+                        spoolfile.abort()  # not a complete stream
+                    else:
+                        spoolfile.finish(keep)
+            if not count:
+                self.release()
+                return
+
+    def _exit_status(self):
+        """ At the end of the output, wait for the encoder (and
+            tivodecode) to exit; returns an error message if any of
+            them failed, or None.
+
+        """
+        for proc in self.procs:
+            if proc.wait():
+                return ('transcode of %s failed: exit status %d' %
+                        (self.path, proc.returncode))
+        return None
+
+    def release(self):
+        """ Give up the scheduler slot once the encoder is done. """
+        if self.job:
+            self.job.release()
+
+    def read(self, cursor):
+        """ Return the next piece of output for cursor, waiting for the
+            encoder if need be; '' at the end of the stream, or None
+            if cursor has fallen behind the ring (see spooled()).
+
+        """
+        self.lock.acquire()
+        try:
+            while not self.primed:
+                if self.eof or self.end - self.base >= self.prebuffer:
+                    self.primed = True
+                else:
+                    self.changed.wait()
+
+            waited = False
+            while cursor.offset >= self.end and not self.eof:
+                if not waited:
+                    self.underruns += 1
+                    waited = True
+                self.changed.wait()
+            self.last_read = time.time()
+
+            if cursor.offset < self.start:
+                return None
+            if cursor.offset >= self.end:
+                if self.error:
+                    raise IOError(self.error)
+                return ''
+            pos = (cursor.offset - self.base) % self.size
+            length = min(self.end - cursor.offset, self.size - pos,
+                         BLOCKSIZE)
+            data = str(self.ring[pos:pos + length])
+            cursor.offset += length
+            self.changed.notifyAll()
+            return data
+        finally:
+            self.lock.release()
+
+    def status(self):
+        """ The encoder's latest progress and the ring buffer counters
+            for this session.
+
+        """
+        status = {'path': self.path, 'speculative': self.warm(),
+                  'eof': self.eof, 'error': self.error or ''}
+        if self.job:
+            status.update(self.job.stats())
+        status.update(self.stats())
+        return status
+
+    def stats(self):
+        """ Ring buffer counters for this session. """
+        self.lock.acquire()
+        try:
+            return {'size': self.size, 'prebuffer': self.prebuffer,
+                    'occupancy': self.end - self._floor(),
+                    'produced': self.end - self.base,
+                    'consumers': len(self.cursors),
+                    'underruns': self.underruns, 'stalls': self.stalls}
+        finally:
+            self.lock.release()
+
+    def stop(self):
+        self.lock.acquire()
+        try:
+            self.stopped = True
+            if not self.eof:
+                # Anyone still reading gets an error, not a hang
+                self.eof = True
+                self.error = self.error or 'transcode stopped'
+            self.changed.notifyAll()
+        finally:
+            self.lock.release()
+        for proc in self.procs:
+            if proc.poll() is None:
+                kill(proc)
+        self.release()
+        self.reader.join(5)
+        if self.tee:
+            self.tee.abort()
+        if self.spool:
+            self.spool.abort()
+            spool.log_stats()
+
+def transcode(isQuery, inFile, outFile, tsn='', mime='', thead='',
+              tee=None):
+    plan = get_plan(inFile, tsn, mime)
 
     if isQuery:
-        return settings
+        return plan.settings(True)
 
-    ffmpeg_path = config.get_bin('ffmpeg')
-    cmd_string = config.getFFmpegTemplate(tsn) % settings
-    fname = unicode(inFile, 'utf-8')
-    if mswindows:
-        fname = fname.encode('cp1252')
+    key = session_key(inFile, tsn, mime, thead)
+    session = find_session(key, 0)
+    if session:
+        debug('sharing running transcode of %s' % inFile)
+    else:
+        name = spool.spool_name(key)
+        if spool.spooled_size(name):
+            debug('replaying spooled transcode of %s' % inFile)
+            return spool.send_spooled(name, outFile, 0)
+        try:
+            session = start_session(plan, key, thead, tee=tee)
+        except scheduler.Busy:
+            return 0
+    return transfer(session, outFile, 0)
+
+def speculate(inFile, tsn='', mime='', thead='', tee=None):
+    """ Start transcoding inFile before it's asked for. The TiVo
+        fetches a file's details (TVBusQuery) just before the GET, so
+        ffmpeg's startup and probing can overlap the round trip; the
+        GET then finds the session already running. With nobody
+        attached, the ring buffer fills and the encoder waits, and
+        the session is reaped after SPECULATIVE seconds. Only done
+        while a live transcode slot is free. Returns the session, or
+        None.
+
+    """
+    # Short files can finish before the reaper gets a look
+    expire_speculative(SPECULATIVE)
+    plan = get_plan(inFile, tsn, mime)
+    if plan.compatible[0] or not plan.cmd():
+        return None
+    key = session_key(inFile, tsn, mime, thead)
+    if find_session(key, 0) or spool.spooled_size(spool.spool_name(key)):
+        return None
+    try:
+        scheduler.check(scheduler.LIVE)
+        session = start_session(plan, key, thead, tee=tee, speculative=True)
+    except scheduler.Busy:
+        return None
+    debug('speculative transcode of %s' % inFile)
+    return session
 
-    if inFile[-5:].lower() == '.tivo':
-        tivodecode_path = config.get_bin('tivodecode')
-        tivo_mak = config.get_server('tivo_mak')
-        tcmd = [tivodecode_path, '-m', tivo_mak, fname]
-        tivodecode = subprocess.Popen(tcmd, stdout=subprocess.PIPE,
-                                      bufsize=(512 * 1024))
-        if tivo_compatible(inFile, tsn)[0]:
-            cmd = ''
-            ffmpeg = tivodecode
-        else:
-            cmd = [ffmpeg_path, '-i', '-'] + cmd_string.split()
-            ffmpeg = subprocess.Popen(cmd, stdin=tivodecode.stdout,
-                                      stdout=subprocess.PIPE,
-                                      bufsize=(512 * 1024))
+def expire_speculative(age=0):
+    """ Stop any speculative sessions nobody has claimed (started at
+        least age seconds ago), to free their slots and buffers.
+        Returns how many there were.
+
+    """
+    now = time.time()
+    sessions_lock.acquire()
+    try:
+        warm = [s for running in sessions.values() for s in running
+                if s.warm() and s.started + age <= now]
+    finally:
+        sessions_lock.release()
+    for session in warm:
+        logger.info('Dropping speculative transcode of "%s"' %
+                    unicode(session.path, 'utf-8'))
+        cleanup(session)
+        session.stop()
+    return len(warm)
+
+def start_session(plan, key, thead='', offset=0, seek=None, tee=None,
+                  speculative=False):
+    """ Start encoding plan. A nonzero offset starts a seek session:
+        ffmpeg begins at the matching source time (or at seek seconds,
+        if given), its output is taken to start at that byte offset,
+        and nothing is spooled. tee, if given, is called with the plan
+        to get a SpoolFile to copy the output to (see TranscodeSession).
+
+    """
+    inFile = plan.path
+    if offset:
+        if seek is None:
+            seek = plan.seek_time(offset, len(thead))
+        thead = ''
     else:
-        cmd = [ffmpeg_path, '-i', fname] + cmd_string.split()
-        ffmpeg = subprocess.Popen(cmd, bufsize=(512 * 1024),
-                                  stdout=subprocess.PIPE)
+        seek = 0
+    cmd = plan.cmd(seek)
+    procs = []
 
+    job = None
     if cmd:
-        debug('transcoding to tivo model ' + tsn[:3] + ' using ffmpeg command:')
-        debug(' '.join(cmd))
+        job = scheduler.admit(scheduler.LIVE, 'transcode of ' + inFile)
+        job.source = plan.describe()
+        cmd = job.limit(cmd)
 
-    ffmpeg_procs[inFile] = {'process': ffmpeg, 'start': 0, 'end': 0,
-                            'last_read': time.time(), 'blocks': []}
-    if thead:
-        ffmpeg_procs[inFile]['blocks'].append(thead)
-    reap_process(inFile)
-    return resume_transfer(inFile, outFile, 0)
-
-def is_resumable(inFile, offset):
-    if inFile in ffmpeg_procs:
-        proc = ffmpeg_procs[inFile]
-        if proc['start'] <= offset < proc['end']:
-            return True
+    try:
+        if plan.is_tivo_file:
+            fname = unicode(inFile, 'utf-8')
+            if mswindows:
+                fname = fname.encode('cp1252')
+            tivo_mak = config.get_server('tivo_mak')
+            ts = metadata.tivo_info(inFile, False)['ts']
+            tcmd = tivodecrypt.command(tivo_mak, fname, ts)
+            tivodecode = subprocess.Popen(tcmd, stdout=subprocess.PIPE,
+                                          bufsize=(512 * 1024))
+            procs.append(tivodecode)
+            if cmd:
+                ffmpeg = subprocess.Popen(cmd, stdin=tivodecode.stdout,
+                                          stdout=subprocess.PIPE,
+                                          stderr=subprocess.PIPE,
+                                          bufsize=(512 * 1024),
+                                          **job.popen_args())
+                procs.append(ffmpeg)
         else:
-            cleanup(inFile)
-            kill(proc['process'])
-    return False
+            ffmpeg = subprocess.Popen(cmd, bufsize=(512 * 1024),
+                                      stdout=subprocess.PIPE,
+                                      stderr=subprocess.PIPE,
+                                      **job.popen_args())
+            procs.append(ffmpeg)
+    except:
+        if job:
+            job.release()
+        for proc in procs:
+            kill(proc)
+        raise
+    if job:
+        job.monitor(ffmpeg.stderr)
 
-def resume_transfer(inFile, outFile, offset):
-    proc = ffmpeg_procs[inFile]
-    offset -= proc['start']
-    count = 0
+    if cmd:
+        debug('transcoding to tivo model ' + plan.tsn[:3] +
+              ' using ffmpeg command:')
+        debug(' '.join(cmd))
+    if offset:
+        logger.info('Seeking "%s" to %.3f seconds for offset %d' %
+                    (unicode(inFile, 'utf-8'), seek, offset))
 
+    spoolfile = None
+    cache = spool.get_spool()
+    if cache and not offset:
+        try:
+            spoolfile = spool.SpoolFile(cache, spool.spool_name(key))
+        except IOError, msg:
+            logger.error('Unable to spool: %s' % msg)
+
+    teefile = None
+    if tee and not offset:
+        teefile = tee(plan)
+
+    session = TranscodeSession(key, procs, thead, spoolfile, offset, job,
+                               teefile, speculative, plan.tsn)
+    add_session(session)
+    reaper.watch(procs, TIMEOUT, session.last_used,
+                 lambda: reap(session), 'transcode of ' + inFile)
+    if plan.can_seek():
+        index_keyframes(inFile)
+    return session
+
+def status():
+    """ status() of each running session. """
+    sessions_lock.acquire()
     try:
-        for block in proc['blocks']:
-            length = len(block)
-            if offset < length:
-                if offset > 0:
-                    block = block[offset:]
-                outFile.write('%x\r\n' % len(block))
-                outFile.write(block)
-                outFile.write('\r\n')
-                count += len(block)
-            offset -= length
-        outFile.flush()
-    except Exception, msg:
-        logger.info(msg)
-        return count
+        running = [s for group in sessions.values() for s in group]
+    finally:
+        sessions_lock.release()
+    return [session.status() for session in running]
+
+def index_keyframes(inFile, wait=False):
+    """ Collect the source keyframe times for seek_time(), using
+        ffprobe if it's available, in the background unless wait is
+        set. Only packet headers are read, so this is much faster than
+        the transcode. Returns the times known so far.
+
+    """
+    fname = unicode(inFile, 'utf-8')
+    mtime = os.path.getmtime(fname)
+    if inFile in keyframe_cache and keyframe_cache[inFile][0] == mtime:
+        return keyframe_cache[inFile][1]
+    ffprobe_path = config.get_bin('ffprobe')
+    if not ffprobe_path:
+        return []
+    keyframe_cache[inFile] = (mtime, [])
 
-    proc['start'] = proc['end']
-    proc['blocks'] = []
+    if mswindows:
+        fname = fname.encode('cp1252')
+    cmd = [ffprobe_path, '-v', 'error', '-select_streams', 'v:0',
+           '-show_entries', 'packet=pts_time,flags', '-of', 'csv=p=0',
+           fname]
 
-    return count + transfer_blocks(inFile, outFile)
+    def collect():
+        frames = []
+        job = scheduler.admit(scheduler.PROBE, 'keyframe index of ' + inFile)
+        try:
+            ffprobe = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                       stderr=open(os.devnull, 'w'),
+                                       **job.popen_args())
+            reaper.watch_child(ffprobe, 'keyframe index of ' + inFile)
+            for line in ffprobe.stdout:
+                fields = line.strip().split(',')
+                if len(fields) == 2 and 'K' in fields[1]:
+                    try:
+                        frames.append(float(fields[0]))
+                    except ValueError:
+                        pass
+            ffprobe.wait()
+        except OSError, msg:
+            logger.info(msg)
+            job.release()
+            return []
+        job.release()
+        frames.sort()
+        keyframe_cache[inFile] = (mtime, frames)
+        debug('indexed %d keyframes in %s' % (len(frames), inFile))
+        return frames
+
+    if wait:
+        return collect()
+    thread = threading.Thread(target=collect)
+    thread.setDaemon(True)
+    thread.start()
+    return []
+
+def is_resumable(inFile, offset, tsn='', mime='', thead=''):
+    key = session_key(inFile, tsn, mime, thead)
+    if find_session(key, offset):
+        return True
+    if offset < spool.spooled_size(spool.spool_name(key)):
+        return True
 
-def transfer_blocks(inFile, outFile):
-    proc = ffmpeg_procs[inFile]
-    blocks = proc['blocks']
+    # Nobody can use the output we still have, so stop encoding
+    sessions_lock.acquire()
+    try:
+        idle = [s for s in sessions.get(key, []) if not s.consumers()]
+    finally:
+        sessions_lock.release()
+    for session in idle:
+        cleanup(session)
+        session.stop()
+
+    # ...but we may be able to start again from there
+    return get_plan(inFile, tsn, mime).can_seek()
+
+def resume_transfer(inFile, outFile, offset, tsn='', mime='', thead='',
+                    seek=None):
+    key = session_key(inFile, tsn, mime, thead)
+    session = find_session(key, offset)
+    if not session:
+        name = spool.spool_name(key)
+        if spool.spooled_size(name):
+            return spool.send_spooled(name, outFile, offset)
+        plan = get_plan(inFile, tsn, mime)
+        if not plan.can_seek():
+            return 0
+        try:
+            session = start_session(plan, key, thead, offset, seek)
+        except scheduler.Busy:
+            return 0
+    return transfer(session, outFile, offset)
+
+def check_capacity(inFile, offset=0, tsn='', mime='', thead=''):
+    """ Raise scheduler.Busy if sending inFile from offset would need a
+        new encoder, and the scheduler would refuse one.
+
+    """
+    key = session_key(inFile, tsn, mime, thead)
+    if find_session(key, offset):
+        return
+    if offset < spool.spooled_size(spool.spool_name(key)):
+        return
+    if get_plan(inFile, tsn, mime).cmd():
+        try:
+            scheduler.check(scheduler.LIVE)
+        except scheduler.Busy:
+            # A real request beats a guess
+            if not expire_speculative():
+                raise
+            scheduler.check(scheduler.LIVE)
+
+def transfer(session, outFile, offset):
+    """ Send session output from offset on as HTTP chunks. """
+    cursor = session.attach(offset)
+    if not cursor:
+        return 0
     count = 0
 
     while True:
+        if cursor.offset < session.start:
+            # No longer in memory, but it was spooled
+            try:
+                sent = session.spool.send(outFile, cursor.offset,
+                                          session.start - cursor.offset)
+            except Exception, msg:
+                logger.info(msg)
+                sent = 0
+            if not sent:
+                session.detach(cursor)
+                break
+            cursor.offset += sent
+            count += sent
+            continue
+
         try:
-            block = proc['process'].stdout.read(BLOCKSIZE)
-            proc['last_read'] = time.time()
+            block = session.read(cursor)
         except Exception, msg:
             logger.info(msg)
-            cleanup(inFile)
-            kill(proc['process'])
+            session.detach(cursor)
+            cleanup(session)
+            session.stop()
             break
 
+        if block is None:
+            continue  # overtaken by the encoder; use the spool
+
         if not block:
             try:
                 outFile.flush()
             except Exception, msg:
                 logger.info(msg)
+                session.detach(cursor)
             else:
-                cleanup(inFile)
+                if not session.detach(cursor):
+                    cleanup(session)
             break
 
-        blocks.append(block)
-        proc['end'] += len(block)
-        if len(blocks) > MAXBLOCKS:
-            proc['start'] += len(blocks[0])
-            blocks.pop(0)
-
         try:
             outFile.write('%x\r\n' % len(block))
             outFile.write(block)
@@ -180,26 +924,36 @@ def transfer_blocks(inFile, outFile):
             count += len(block)
         except Exception, msg:
             logger.info(msg)
+            session.detach(cursor)
             break
 
     return count
 
-def reap_process(inFile):
-    if ffmpeg_procs and inFile in ffmpeg_procs:
-        proc = ffmpeg_procs[inFile]
-        if proc['last_read'] + TIMEOUT < time.time():
-            del ffmpeg_procs[inFile]
-            del reapers[inFile]
-            kill(proc['process'])
-        else:
-            reaper = threading.Timer(TIMEOUT, reap_process, (inFile,))
-            reapers[inFile] = reaper
-            reaper.start()
-
-def cleanup(inFile):
-    del ffmpeg_procs[inFile]
-    reapers[inFile].cancel()
-    del reapers[inFile]
+def reap(session):
+    """ Called by the reaper once a session has been idle for TIMEOUT
+        seconds, whether or not its encoder is still running.
+
+    """
+    if session.warm():
+        logger.info('Speculative transcode of "%s" expired unused' %
+                    unicode(session.path, 'utf-8'))
+    cleanup(session)
+    session.stop()
+
+def cleanup(session):
+    if not remove_session(session):
+        return  # already done
+    debug('session stats for %s: %s' % (session.path, session.stats()))
+    if session.job and not session.warm():
+        throughput.record_speed(session.tsn, session.job.speed)
+    if session.eof:
+        # Otherwise stop() does this, once the reader has finished
+        session.reader.join()
+        if session.tee:
+            session.tee.abort()  # unless kept
+        if session.spool:
+            session.spool.abort()
+            spool.log_stats()
 
 def select_audiocodec(isQuery, inFile, tsn='', mime=''):
     if inFile[-5:].lower() == '.tivo':
@@ -338,11 +1092,11 @@ def select_videostr(inFile, tsn, mime=''):
             video_str -= int(vInfo['aKbps'])
         video_str *= 1000
     else:
-        video_str = config.strtod(config.getVideoBR(tsn))
-        if config.isHDtivo(tsn) and vInfo['kbps']:
+        profile = config.get_profile(tsn)
+        video_str = profile.video_bps
+        if profile.is_hd and vInfo['kbps']:
             video_str = max(video_str, int(vInfo['kbps']) * 1000)
-        video_str = int(min(config.strtod(config.getMaxVideoBR(tsn)) * 0.95,
-                            video_str))
+        video_str = int(min(profile.max_video_bps * 0.95, video_str))
     return video_str
 
 def select_audiobr(tsn):
@@ -351,8 +1105,15 @@ def select_audiobr(tsn):
 def select_maxvideobr(tsn):
     return '-maxrate ' + config.getMaxVideoBR(tsn)
 
-def select_buffsize(tsn):
-    return '-bufsize ' + config.getBuffSize(tsn)
+def select_buffsize(tsn, scale=1.0):
+    """ The configured bufsize, scaled down along with an adapted
+        bitrate.
+
+    """
+    size = config.getBuffSize(tsn)
+    if scale < 1.0:
+        size = '%dk' % (config.strtod(size) * scale / 1000)
+    return '-bufsize ' + size
 
 def select_ffmpegprams(tsn):
     params = config.getFFmpegPrams(tsn)
@@ -562,7 +1323,7 @@ def tivo_compatible_video(vInfo, tsn, mime=''):
         if vInfo['kbps'] != None:
             abit = max('0', vInfo['aKbps'])
             if (int(vInfo['kbps']) - int(abit) >
-                config.strtod(config.getMaxVideoBR(tsn)) / 1000):
+                config.get_profile(tsn).max_video_bps / 1000):
                 message = (False, '%s kbps exceeds max video bitrate' %
                                   vInfo['kbps'])
                 break
@@ -669,18 +1430,17 @@ def mp4_remuxable(inFile, tsn=''):
     vInfo = video_info(inFile)
     return tivo_compatible_video(vInfo, tsn, 'video/mp4')[0]
 
-def mp4_remux(inFile, basename, tsn=''):
-    outFile = inFile + '.pyTivo-temp'
-    newname = basename + '.pyTivo-temp'
-    if os.path.exists(outFile):
-        return None  # ugh!
+def mp4_remux_cmd(inFile, tsn='', oname='-', fragmented=False):
+    """ The ffmpeg argv to copy inFile's streams into an MP4 container
+        (converting the audio if need be). A fragmented MP4 starts
+        with an empty moov, so it can be written to a pipe and still
+        be played as it arrives.
 
+    """
     ffmpeg_path = config.get_bin('ffmpeg')
     fname = unicode(inFile, 'utf-8')
-    oname = unicode(outFile, 'utf-8')
     if mswindows:
         fname = fname.encode('cp1252')
-        oname = oname.encode('cp1252')
 
     settings = {'video_codec': '-vcodec copy',
             'video_br': select_videobr(inFile, tsn),
@@ -695,22 +1455,96 @@ def mp4_remux(inFile, basename, tsn=''):
             'audio_lang': select_audiolang(inFile, tsn),
             'ffmpeg_pram': select_ffmpegprams(tsn),
             'format': '-f mp4'}
+    if fragmented:
+        settings['format'] = '-movflags frag_keyframe+empty_moov -f mp4'
 
     cmd_string = config.getFFmpegTemplate(tsn) % settings
-    cmd = [ffmpeg_path, '-i', fname] + cmd_string.split() + [oname]
+    return [ffmpeg_path, '-i', fname] + cmd_string.split() + [oname]
+
+def mp4_remux(inFile, basename, tsn=''):
+    outFile = inFile + '.pyTivo-temp'
+    newname = basename + '.pyTivo-temp'
+    if os.path.exists(outFile):
+        return None  # ugh!
+
+    oname = unicode(outFile, 'utf-8')
+    if mswindows:
+        oname = oname.encode('cp1252')
+    cmd = mp4_remux_cmd(inFile, tsn, oname)
 
     debug('transcoding to tivo model ' + tsn[:3] + ' using ffmpeg command:')
     debug(' '.join(cmd))
 
-    ffmpeg = subprocess.Popen(cmd)
-    debug('remuxing ' + inFile + ' to ' + outFile)
-    if ffmpeg.wait():
+    try:
+        job = scheduler.admit(scheduler.PUSH, 'remux of ' + inFile)
+    except scheduler.Busy:
+        return None
+    try:
+        ffmpeg = subprocess.Popen(job.limit(cmd), **job.popen_args())
+        reaper.watch_child(ffmpeg, 'remux of ' + inFile)
+        debug('remuxing ' + inFile + ' to ' + outFile)
+        failed = ffmpeg.wait()
+    finally:
+        job.release()
+    if failed:
         debug('error during remuxing')
         os.remove(outFile)
         return None
 
     return newname
 
+def mp4_remux_stream(inFile, outFile, tsn='', offset=0):
+    """ Remux inFile to a fragmented MP4 on the fly, sending it from
+        offset on as HTTP chunks, for pushes with mp4_remux_stream set:
+        nothing is written to disk. A resume runs the remux again and
+        discards what was already sent, since stream copies come out
+        the same each time. Returns the number of bytes sent; 0 if no
+        slot is free.
+
+    """
+    cmd = mp4_remux_cmd(inFile, tsn, '-', True)
+    debug('streaming remux for tivo model ' + tsn[:3] +
+          ' using ffmpeg command:')
+    debug(' '.join(cmd))
+
+    try:
+        job = scheduler.admit(scheduler.PUSH, 'remux of ' + inFile)
+    except scheduler.Busy:
+        return 0
+    count = 0
+    try:
+        ffmpeg = subprocess.Popen(job.limit(cmd), stdout=subprocess.PIPE,
+                                  stderr=subprocess.PIPE,
+                                  bufsize=(512 * 1024), **job.popen_args())
+        reaper.watch_child(ffmpeg, 'remux of ' + inFile)
+        job.monitor(ffmpeg.stderr)
+        try:
+            skip = offset
+            while True:
+                block = ffmpeg.stdout.read(BLOCKSIZE)
+                if not block:
+                    break
+                if skip:
+                    if len(block) <= skip:
+                        skip -= len(block)
+                        continue
+                    block = block[skip:]
+                    skip = 0
+                outFile.write('%x\r\n' % len(block))
+                outFile.write(block)
+                outFile.write('\r\n')
+                count += len(block)
+        except Exception, msg:
+            logger.info(msg)
+        if ffmpeg.poll() is None:
+            kill(ffmpeg)
+        if ffmpeg.wait():
+            debug('streaming remux of %s ended with %s' %
+                  (inFile, ffmpeg.returncode))
+    finally:
+        job.release()
+    return count
+
 def tivo_compatible(inFile, tsn='', mime=''):
     vInfo = video_info(inFile)
 
@@ -768,8 +1602,15 @@ def video_info(inFile, cache=True):
     cmd = [ffmpeg_path, '-i', fname]
     # Windows and other OS buffer 4096 and ffmpeg can output more than that.
     err_tmp = tempfile.TemporaryFile()
-    ffmpeg = subprocess.Popen(cmd, stderr=err_tmp, stdout=subprocess.PIPE,
-                              stdin=subprocess.PIPE)
+    job = scheduler.admit(scheduler.PROBE, 'probe of ' + inFile)
+    try:
+        ffmpeg = subprocess.Popen(cmd, stderr=err_tmp,
+                                  stdout=subprocess.PIPE,
+                                  stdin=subprocess.PIPE, **job.popen_args())
+    except:
+        job.release()
+        raise
+    reaper.watch_child(ffmpeg, 'probe of ' + inFile)
 
     # wait configured # of seconds: if ffmpeg is not back give up
     limit = config.getFFmpegWait()
@@ -781,12 +1622,14 @@ def video_info(inFile, cache=True):
 
         if ffmpeg.poll() == None:
             kill(ffmpeg)
+            job.release()
             vInfo['Supported'] = False
             if cache:
                 info_cache[inFile] = (mtime, vInfo)
             return vInfo
     else:
         ffmpeg.wait()
+    job.release()
 
     err_tmp.seek(0)
     output = err_tmp.read()
@@ -988,7 +1831,14 @@ def audio_check(inFile, tsn):
     if mswindows:
         fname = fname.encode('cp1252')
     cmd = [config.get_bin('ffmpeg'), '-i', fname] + cmd_string.split()
-    ffmpeg = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    job = scheduler.admit(scheduler.PROBE, 'audio check of ' + inFile)
+    try:
+        ffmpeg = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                  **job.popen_args())
+    except:
+        job.release()
+        raise
+    reaper.watch_child(ffmpeg, 'audio check of ' + inFile)
     fd, testname = tempfile.mkstemp()
     testfile = os.fdopen(fd, 'wb')
     try:
@@ -1000,6 +1850,7 @@ def audio_check(inFile, tsn):
     else:
         testfile.close()
         vInfo = video_info(testname, False)
+    job.release()
     os.remove(testname)
     return vInfo
 
@@ -1010,31 +1861,6 @@ def supported_format(inFile):
         debug('FALSE, file not supported %s' % inFile)
         return False
 
-def kill(popen):
-    debug('killing pid=%s' % str(popen.pid))
-    if mswindows:
-        win32kill(popen.pid)
-    else:
-        import os, signal
-        for i in xrange(3):
-            debug('sending SIGTERM to pid: %s' % popen.pid)
-            os.kill(popen.pid, signal.SIGTERM)
-            time.sleep(.5)
-            if popen.poll() is not None:
-                debug('process %s has exited' % popen.pid)
-                break
-        else:
-            while popen.poll() is None:
-                debug('sending SIGKILL to pid: %s' % popen.pid)
-                os.kill(popen.pid, signal.SIGKILL)
-                time.sleep(.5)
-
-def win32kill(pid):
-    import ctypes
-    handle = ctypes.windll.kernel32.OpenProcess(1, False, pid)
-    ctypes.windll.kernel32.TerminateProcess(handle, -1)
-    ctypes.windll.kernel32.CloseHandle(handle)
-
 def gcd(a, b):
     while b:
         a, b = b, a % b
@@ -17,7 +17,13 @@ from lrucache import LRUCache
 import config
 import metadata
 import mind
+import pretranscode
+import push
 import qtfaststart
+import scheduler
+import spool
+import throughput
+import tivodecrypt
 import transcode
 from plugin import EncodeUnicode, Plugin, quote
 
@@ -29,6 +35,9 @@ CLASS_NAME = 'Video'
 
 PUSHED = '<h3>Queued for Push to %s</h3> <p>%s</p>'
 
+STATUS = '<?xml version="1.0" encoding="utf-8"?>\n' \
+         '<TranscodeStatus>\n%s</TranscodeStatus>'
+
 # Preload the templates
 def tmpl(name):
     return file(os.path.join(SCRIPTDIR, 'templates', name), 'rb').read()
@@ -51,7 +60,40 @@ try:
 except:
     use_extensions = False
 
-queue = []  # Recordings to push
+RANGE = re.compile(r'bytes=(\d+)-(\d*)')
+
+class MeteredFile(object):
+    """ Wraps a socket file to note when the body starts going out,
+        for the time-to-first-byte log, and how long the first
+        throughput.BURST bytes spent being written, for the TiVo's
+        throughput history.
+
+    """
+    def __init__(self, wfile):
+        self.wfile = wfile
+        self.first = None
+        self.burst = 0
+        self.burst_time = 0.0
+
+    def write(self, data):
+        if self.first is None and data:
+            self.first = time.time()
+        if self.burst < throughput.BURST:
+            start = time.time()
+            self.wfile.write(data)
+            self.burst_time += time.time() - start
+            self.burst += len(data)
+        else:
+            self.wfile.write(data)
+
+    def fileno(self):
+        # About to sendfile() straight to the socket
+        if self.first is None:
+            self.first = time.time()
+        return self.wfile.fileno()
+
+    def __getattr__(self, name):
+        return getattr(self.wfile, name)
 
 def uniso(iso):
     return time.strptime(iso[:19], '%Y-%m-%dT%H:%M:%S')
@@ -65,27 +107,44 @@ def isogm(iso):
 class Pushable(object):
 
     def push_one_file(self, f):
+        try:
+            mind.getMind(f['tsn']).pushVideo(**self.prepare_push(f))
+        except Exception, msg:
+            logger.error(msg)
+
+    def prepare_push(self, f):
+        """ Probe, remux if need be, and gather the details for
+            pushing f; returns the arguments for Mind.pushVideo().
+
+        """
         file_info = VideoDetails()
         file_info['valid'] = transcode.supported_format(f['path'])
 
         mime = 'video/mpeg'
+        remux = ''
         if config.isHDtivo(f['tsn']):
             for m in ['video/mp4', 'video/bif']:
-                if transcode.tivo_compatible(f['path'], f['tsn'], m)[0]:
+                if transcode.get_plan(f['path'], f['tsn'], m).compatible[0]:
                     mime = m
                     break
 
             if (mime == 'video/mpeg' and
                 transcode.mp4_remuxable(f['path'], f['tsn'])):
-                new_path = transcode.mp4_remux(f['path'], f['name'], f['tsn'])
-                if new_path:
+                if config.getMp4RemuxStream():
+                    # Remuxed by send_file when the TiVo asks for it
                     mime = 'video/mp4'
-                    f['name'] = new_path
+                    remux = '?Remux=mp4'
+                else:
+                    new_path = transcode.mp4_remux(f['path'], f['name'],
+                                                   f['tsn'])
+                    if new_path:
+                        mime = 'video/mp4'
+                        f['name'] = new_path
 
         if file_info['valid']:
             file_info.update(self.metadata_full(f['path'], f['tsn'], mime))
 
-        url = f['url'] + quote(f['name'])
+        url = f['url'] + quote(f['name']) + remux
 
         title = file_info['seriesTitle']
         if not title:
@@ -96,27 +155,16 @@ class Pushable(object):
             source = title
 
         subtitle = file_info['episodeTitle']
-        try:
-            m = mind.getMind(f['tsn'])
-            m.pushVideo(
-                tsn = f['tsn'],
-                url = url,
-                description = file_info['description'],
-                duration = file_info['duration'] / 1000,
-                size = file_info['size'],
-                title = title,
-                subtitle = subtitle,
-                source = source,
-                mime = mime,
-                tvrating = file_info['tvRating'])
-        except Exception, msg:
-            logger.error(msg)
-
-    def process_queue(self):
-        while queue:
-            time.sleep(5)
-            item = queue.pop(0)
-            self.push_one_file(item)
+        return {'tsn': f['tsn'],
+                'url': url,
+                'description': file_info['description'],
+                'duration': file_info['duration'] / 1000,
+                'size': file_info['size'],
+                'title': title,
+                'subtitle': subtitle,
+                'source': source,
+                'mime': mime,
+                'tvrating': file_info['tvRating']}
 
     def readip(self):
         """ returns your external IP address by querying dyndns.org """
@@ -163,10 +211,8 @@ class Pushable(object):
         files = query.get('File', [])
         for f in files:
             file_path = os.path.normpath(path + '/' + f)
-            queue.append({'path': file_path, 'name': f, 'tsn': tsn,
-                          'url': baseurl})
-            if len(queue) == 1:
-                thread.start_new_thread(Video.process_queue, (self,))
+            push.submit(self, {'path': file_path, 'name': f, 'tsn': tsn,
+                               'url': baseurl})
 
             logger.info('[%s] Queued "%s" for Push to %s' %
                         (time.strftime('%d/%b/%Y %H:%M:%S'),
@@ -181,6 +227,9 @@ class BaseVideo(Plugin):
 
     tvbus_cache = LRUCache(1)
 
+    def init(self):
+        pretranscode.start()
+
     def video_file_filter(self, full_path, type=None):
         if os.path.isdir(unicode(full_path, 'utf-8')):
             return True
@@ -190,6 +239,7 @@ class BaseVideo(Plugin):
             return transcode.supported_format(full_path)
 
     def send_file(self, handler, path, query):
+        begin = time.time()
         mime = 'video/x-tivo-mpeg'
         tsn = handler.headers.getheader('tsn', '')
         try:
@@ -203,25 +253,27 @@ class BaseVideo(Plugin):
         if 'Format' in query:
             mime = query['Format'][0]
 
+        if query.get('Remux') == ['mp4']:
+            self.send_remux(handler, path, tsn, tivo_name)
+            return
+
         needs_tivodecode = (is_tivo_file and mime == 'video/mpeg')
         compatible = (not needs_tivodecode and
-                      transcode.tivo_compatible(path, tsn, mime)[0])
+                      transcode.get_plan(path, tsn, mime).compatible[0])
 
-        try:  # "bytes=XXX-"
-            offset = int(handler.headers.getheader('Range')[6:-1])
+        try:  # "bytes=XXX-" or "bytes=XXX-YYY"
+            match = RANGE.match(handler.headers.getheader('Range'))
+            offset, last = int(match.group(1)), match.group(2)
         except:
-            offset = 0
+            offset, last = 0, ''
 
         if needs_tivodecode:
-            valid = bool(config.get_bin('tivodecode') and
-                         config.get_server('tivo_mak'))
+            ts = metadata.tivo_info(path, False)['ts']
+            valid = bool(config.get_server('tivo_mak') and
+                         tivodecrypt.command('', path, ts))
         else:
             valid = True
 
-        if valid and offset:
-            valid = ((compatible and offset < os.path.getsize(path)) or
-                     (not compatible and transcode.is_resumable(path, offset)))
-
         #faking = (mime in ['video/x-tivo-mpeg-ts', 'video/x-tivo-mpeg'] and
         faking = (mime == 'video/x-tivo-mpeg' and
                   not (is_tivo_file and compatible))
@@ -229,12 +281,58 @@ class BaseVideo(Plugin):
         thead = ''
         if faking:
             thead = self.tivo_header(tsn, path, mime)
+
+        # Pre-transcoded output is sent just like a compatible file;
+        # if only the start was pre-transcoded, that's sent first.
+        source = fname
+        prefix = None
+        if valid and not compatible and not needs_tivodecode:
+            cached = pretranscode.lookup(path, tsn, mime)
+            if cached and cached[2]:
+                prefix = cached
+                logger.debug('"%s" is partly pre-transcoded' % fname)
+            elif cached:
+                source = cached[0]
+                compatible = True
+                logger.debug('"%s" is pre-transcoded' % fname)
+        prefix_end = 0
+        if prefix:
+            prefix_end = len(thead) + prefix[1]
+
+        if compatible:
+            size = os.path.getsize(source) + len(thead)
+            if mime == 'video/mp4':
+                # Moving the moov may drop free atoms
+                try:
+                    f = open(source, 'rb')
+                    try:
+                        size = qtfaststart.output_size(f)
+                    finally:
+                        f.close()
+                except Exception, msg:
+                    logger.info(msg)
+            end = size - 1
+            if last:
+                end = min(int(last), end)
+        if valid and offset:
+            valid = ((compatible and offset <= end) or
+                     (not compatible and offset < prefix_end) or
+                     (not compatible and
+                      transcode.is_resumable(path, offset, tsn, mime, thead)))
+        if valid and not compatible:
+            try:
+                transcode.check_capacity(path, max(offset, prefix_end),
+                                         tsn, mime, thead)
+            except scheduler.Busy, msg:
+                logger.error('Unable to send "%s" to %s: %s' %
+                             (fname, tivo_name, msg))
+                handler.send_error(503, str(msg))
+                return
         if compatible:
-            size = os.path.getsize(fname) + len(thead)
             handler.send_response(200)
-            handler.send_header('Content-Length', size - offset)
+            handler.send_header('Content-Length', end - offset + 1)
             handler.send_header('Content-Range', 'bytes %d-%d/%d' % 
-                                (offset, size - offset - 1, size))
+                                (offset, end, size))
         else:
             handler.send_response(206)
             handler.send_header('Transfer-Encoding', 'chunked')
@@ -245,37 +343,55 @@ class BaseVideo(Plugin):
                     (time.strftime('%d/%b/%Y %H:%M:%S'), fname, tivo_name))
         start = time.time()
         count = 0
+        wfile = MeteredFile(handler.wfile)
 
         if valid:
             if compatible:
-                if faking and not offset:
-                    handler.wfile.write(thead)
+                if source != fname:
+                    how = 'pre-transcoded'
+                else:
+                    how = 'direct'
+                if faking and offset < len(thead):
+                    wfile.write(thead[offset:end + 1])
                 logger.debug('"%s" is tivo compatible' % fname)
-                f = open(fname, 'rb')
+                f = open(source, 'rb')
                 try:
                     if mime == 'video/mp4':
-                        count = qtfaststart.process(f, handler.wfile, offset)
+                        count = qtfaststart.process(f, wfile, offset,
+                                                    end + 1 - offset)
                     else:
-                        if offset:
-                            offset -= len(thead)
-                            f.seek(offset)
-                        while True:
-                            block = f.read(512 * 1024)
-                            if not block:
-                                break
-                            handler.wfile.write(block)
-                            count += len(block)
+                        pos = max(offset - len(thead), 0)
+                        length = end + 1 - len(thead) - pos
+                        if length > 0:
+                            count = spool.send_range(f, wfile, pos, length)
                 except Exception, msg:
                     logger.info(msg)
                 f.close()
             else:
                 logger.debug('"%s" is not tivo compatible' % fname)
-                if offset:
-                    count = transcode.resume_transfer(path, handler.wfile, 
-                                                      offset)
+                if offset < prefix_end:
+                    how = 'pre-transcoded prefix'
+                    try:
+                        count = pretranscode.send_prefix(prefix, wfile,
+                                                         offset, thead)
+                    except Exception, msg:
+                        logger.info(msg)
+                    else:
+                        count += transcode.resume_transfer(path, wfile,
+                            prefix_end, tsn, mime, thead, prefix[2])
+                elif offset:
+                    how = 'resumed transcode'
+                    count = transcode.resume_transfer(path, wfile, offset,
+                                                      tsn, mime, thead)
                 else:
-                    count = transcode.transcode(False, path, handler.wfile,
-                                                tsn, mime, thead)
+                    how = self.transcode_path(path, tsn, mime, thead)
+                    count = transcode.transcode(False, path, wfile,
+                                                tsn, mime, thead,
+                                                pretranscode.remux_file)
+            if wfile.first:
+                logger.info('Time to first byte of "%s" (%s): %.3f s' %
+                            (fname, how, wfile.first - begin))
+            throughput.record_rate(tsn, wfile.burst, wfile.burst_time)
         try:
             if not compatible:
                  handler.wfile.write('0\r\n\r\n')
@@ -294,8 +410,73 @@ class BaseVideo(Plugin):
         if fname.endswith('.pyTivo-temp'):
             os.remove(fname)
 
-    def __duration(self, full_path):
-        return transcode.video_info(full_path)['millisecs']
+    def send_remux(self, handler, path, tsn, tivo_name):
+        """ Send a pushed file as a fragmented MP4, remuxed as it goes
+            (see mp4_remux_stream).
+
+        """
+        fname = unicode(path, 'utf-8')
+        try:  # "bytes=XXX-" or "bytes=XXX-YYY"
+            offset = int(RANGE.match(handler.headers.getheader('Range'))
+                         .group(1))
+        except:
+            offset = 0
+        try:
+            scheduler.check(scheduler.PUSH)
+        except scheduler.Busy, msg:
+            logger.error('Unable to send "%s" to %s: %s' %
+                         (fname, tivo_name, msg))
+            handler.send_error(503, str(msg))
+            return
+
+        handler.send_response(206)
+        handler.send_header('Transfer-Encoding', 'chunked')
+        handler.send_header('Content-Type', 'video/mp4')
+        handler.end_headers()
+        logger.info('[%s] Start remuxing "%s" to %s' %
+                    (time.strftime('%d/%b/%Y %H:%M:%S'), fname, tivo_name))
+        start = time.time()
+        count = transcode.mp4_remux_stream(path, handler.wfile, tsn, offset)
+        try:
+            handler.wfile.write('0\r\n\r\n')
+            handler.wfile.flush()
+        except Exception, msg:
+            logger.info(msg)
+        logger.info('[%s] Done remuxing "%s" to %s, %d bytes in %.1f s' %
+                    (time.strftime('%d/%b/%Y %H:%M:%S'), fname, tivo_name,
+                     count, time.time() - start))
+
+    def transcode_path(self, path, tsn, mime, thead):
+        """ How a request from the start will be served, for the log. """
+        key = transcode.session_key(path, tsn, mime, thead)
+        session = transcode.find_session(key, 0)
+        if session and session.warm():
+            return 'speculative transcode'
+        if session:
+            return 'shared transcode'
+        if spool.spooled_size(spool.spool_name(key)):
+            return 'spooled transcode'
+        return 'new transcode'
+
+    def speculate(self, tsn, path):
+        """ Start transcoding path for the GET that usually follows
+            a TVBusQuery, in the format the listings offered.
+
+        """
+        if self.use_ts(tsn, path):
+            mime = 'video/x-tivo-mpeg-ts'
+        else:
+            mime = 'video/x-tivo-mpeg'
+        try:
+            if pretranscode.lookup(path, tsn, mime):
+                return
+            thead = ''
+            if mime == 'video/x-tivo-mpeg':
+                thead = self.tivo_header(tsn, path, mime)
+            transcode.speculate(path, tsn, mime, thead,
+                                pretranscode.remux_file)
+        except Exception, msg:
+            logger.info('Speculative transcode of %s: %s' % (path, msg))
 
     def __total_items(self, full_path):
         count = 0
@@ -318,23 +499,10 @@ class BaseVideo(Plugin):
             pass
         return count
 
-    def __est_size(self, full_path, tsn='', mime=''):
-        # Size is estimated by taking audio and video bit rate adding 2%
-
-        if transcode.tivo_compatible(full_path, tsn, mime)[0]:
-            return os.path.getsize(unicode(full_path, 'utf-8'))
-        else:
-            # Must be re-encoded
-            audioBPS = config.getMaxAudioBR(tsn) * 1000
-            #audioBPS = config.strtod(config.getAudioBR(tsn))
-            videoBPS = transcode.select_videostr(full_path, tsn)
-            bitrate =  audioBPS + videoBPS
-            return int((self.__duration(full_path) / 1000) *
-                       (bitrate * 1.02 / 8))
-
     def metadata_full(self, full_path, tsn='', mime='', mtime=None):
         data = {}
-        vInfo = transcode.video_info(full_path)
+        plan = transcode.get_plan(full_path, tsn, mime)
+        vInfo = plan.vInfo
 
         if ((int(vInfo['vHeight']) >= 720 and
              config.getTivoHeight >= 720) or
@@ -356,12 +524,11 @@ class BaseVideo(Plugin):
             data['episodeNumber'] = str(ep)
 
         if config.getDebug() and 'vHost' not in data:
-            compatible, reason = transcode.tivo_compatible(full_path, tsn, mime)
+            compatible, reason = plan.compatible
             if compatible:
                 transcode_options = {}
             else:
-                transcode_options = transcode.transcode(True, full_path,
-                                                        '', tsn, mime)
+                transcode_options = plan.settings(True)
             data['vHost'] = (
                 ['TRANSCODE=%s, %s' % (['YES', 'NO'][compatible], reason)] +
                 ['SOURCE INFO: '] +
@@ -390,7 +557,7 @@ class BaseVideo(Plugin):
                     logger.warning('Bad time format: ' + data['time'] +
                                    ' , using current time')
 
-        duration = self.__duration(full_path)
+        duration = vInfo['millisecs']
         duration_delta = timedelta(milliseconds = duration)
         min = duration_delta.seconds / 60
         sec = duration_delta.seconds % 60
@@ -400,7 +567,7 @@ class BaseVideo(Plugin):
         data.update({'time': now.isoformat(),
                      'startTime': now.isoformat(),
                      'stopTime': (now + duration_delta).isoformat(),
-                     'size': self.__est_size(full_path, tsn, mime),
+                     'size': plan.est_size(),
                      'duration': duration,
                      'iso_duration': ('P%sDT%sH%sM%sS' % 
                           (duration_delta.days, hours, min, sec))})
@@ -489,11 +656,7 @@ class BaseVideo(Plugin):
     def use_ts(self, tsn, file_path):
         if config.is_ts_capable(tsn):
             if file_path[-5:].lower() == '.tivo':
-                try:
-                    flag = file(file_path).read(8)
-                except:
-                    return False
-                if ord(flag[7]) & 0x20:
+                if metadata.tivo_info(file_path, False)['ts']:
                     return True
             elif config.has_ts_flag():
                 return True
@@ -554,6 +717,29 @@ class BaseVideo(Plugin):
 
         handler.send_xml(details)
 
+        if config.getSpeculativeStart():
+            thread.start_new_thread(self.speculate, (tsn, file_path))
+
+    def TranscodeStatus(self, handler, query):
+        """ Progress of each running transcode, as XML:
+            /TiVoConnect?Command=TranscodeStatus&Container=<video share>
+
+        """
+        def element(name, values):
+            fields = []
+            for key, value in sorted(values.items()):
+                if isinstance(value, float):
+                    value = '%.3f' % value
+                elif isinstance(value, (list, tuple, dict)):
+                    continue
+                fields.append('<%s>%s</%s>' % (key, escape(str(value)), key))
+            return '<%s>%s</%s>\n' % (name, ''.join(fields), name)
+
+        body = [element('Scheduler', scheduler.stats())]
+        for status in transcode.status():
+            body.append(element('Session', status))
+        handler.send_xml(STATUS % ''.join(body))
+
 class Video(BaseVideo, Pushable):
         pass
 
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+
+""" Fill the pre-transcode cache for a video share ahead of time.
+
+    Usage: prewarm.py [-c config] [-e extraconf] share [tsn ...]
+           prewarm.py [-c config] [-e extraconf] -b file [tsn]
+
+    Each video in the share that the given TiVos (by default, those in
+    the config file) can't play directly is transcoded into the
+    pretranscode_path cache, which must be set.
+
+    With -b, the file is transcoded once with a single ffmpeg and once
+    split into parallel_segments pieces, and the times are compared.
+
+"""
+
+import getopt
+import logging
+import sys
+
+if sys.version_info[0] != 2 or sys.version_info[1] < 5:
+    print ('ERROR: pyTivo requires Python >= 2.5, < 3.0.\n')
+    sys.exit(1)
+
+import config
+import reaper
+
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv, 'c:e:b',
+                                   ['config=', 'extraconf=', 'benchmark'])
+    except getopt.GetoptError, msg:
+        print msg
+        args = []
+    if not args:
+        print __doc__
+        return 2
+
+    confopts = []
+    bench = False
+    for opt, value in opts:
+        if opt in ('-b', '--benchmark'):
+            bench = True
+        else:
+            confopts += [opt, value]
+    config.init(confopts)
+    config.init_logging()
+    from plugins.video import pretranscode
+
+    if bench:
+        from plugins.video import parallel
+        tsn = (args[1:] or [''])[0]
+        r = parallel.benchmark(args[0], tsn, pretranscode.default_mime(tsn))
+        print ('single: %(single).1f s, parallel (%(pieces)d pieces): ' +
+               '%(parallel).1f s, speedup %(speedup).2fx') % r
+        reaper.shutdown()
+        return 0
+
+    if not pretranscode.get_cache():
+        print 'pretranscode_path is not set'
+        return 1
+    share = args[0]
+    if not pretranscode.shares(share):
+        print 'No video share named', share
+        return 1
+
+    logger = logging.getLogger('pyTivo.prewarm')
+    done = 0
+    for path, tsn in pretranscode.candidates(share, args[1:]):
+        try:
+            if pretranscode.warm(path, tsn):
+                done += 1
+        except Exception, msg:
+            logger.error('%s: %s' % (path, msg))
+    pretranscode.log_stats()
+    reaper.shutdown()
+    print done, 'files cached'
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
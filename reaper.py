@@ -0,0 +1,251 @@
+import heapq
+import itertools
+import logging
+import os
+import sys
+import threading
+import time
+
+logger = logging.getLogger('pyTivo.reaper')
+
+POLL = 5            # seconds between checks on each watched process
+ORPHAN_GRACE = 60   # seconds a process may outlive the thread that owns it
+
+mswindows = (sys.platform == 'win32')
+
+class Watch(object):
+    """ A group of child processes (e.g. tivodecode feeding ffmpeg)
+        being supervised together. See watch().
+
+    """
+    def __init__(self, procs, timeout=None, last_used=None, on_reap=None,
+                 owner=None, name=''):
+        self.procs = list(procs)
+        self.timeout = timeout
+        self.last_used = last_used
+        self.on_reap = on_reap
+        self.owner = owner
+        self.name = name
+        self.orphaned = None
+        self.done = False
+
+    def running(self):
+        return [p for p in self.procs if p.poll() is None]
+
+class Reaper(object):
+    """ One supervisor thread for every encoder and helper process
+        pyTivo starts. Watches sit in a heap ordered by when they're
+        next due; when one comes up, its processes are polled (which
+        also collects zombies), and it's reaped if it has been idle for
+        longer than its timeout, or if the thread that started it has
+        been gone for ORPHAN_GRACE seconds with the processes still
+        running.
+
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.heap = []
+        self.seq = itertools.count()
+        self.thread = None
+        self.stopping = False
+        self.live = 0
+        self.collected = 0
+        self.reaped = 0
+        self.orphans = 0
+
+    def watch(self, procs, timeout=None, last_used=None, on_reap=None,
+              owner=None, name=''):
+        """ Supervise procs. If timeout is set, they're reaped once
+            last_used() (a time.time() value) is that many seconds in
+            the past. If owner (a Thread) is set, they're reaped as
+            orphans when it dies. on_reap, if given, is called to do
+            the reaping instead of killing the processes directly; it's
+            also called if they all exit on their own, once last_used()
+            is timeout seconds old, so that whatever holds their output
+            is let go.
+
+        """
+        w = Watch(procs, timeout, last_used, on_reap, owner, name)
+        self.lock.acquire()
+        try:
+            self.live += len(procs)
+            self._push(time.time() + POLL, w)
+            if not self.thread:
+                self.thread = threading.Thread(target=self._run)
+                self.thread.setDaemon(True)
+                self.thread.start()
+        finally:
+            self.lock.release()
+        return w
+
+    def shutdown(self):
+        """ Stop the supervisor thread, e.g. before a script exits. """
+        self.lock.acquire()
+        try:
+            self.stopping = True
+            self.changed.notify()
+            thread = self.thread
+        finally:
+            self.lock.release()
+        if thread:
+            thread.join()
+
+    def _push(self, when, w):
+        heapq.heappush(self.heap, (when, self.seq.next(), w))
+        self.changed.notify()
+
+    def _run(self):
+        while True:
+            self.lock.acquire()
+            try:
+                while True:
+                    if self.stopping:
+                        return
+                    now = time.time()
+                    if self.heap and self.heap[0][0] <= now:
+                        w = heapq.heappop(self.heap)[2]
+                        break
+                    if self.heap:
+                        self.changed.wait(self.heap[0][0] - now)
+                    else:
+                        self.changed.wait()
+            finally:
+                self.lock.release()
+
+            try:
+                when = self._check(w)
+            except Exception, msg:
+                logger.error('reaping %s: %s' % (w.name, msg))
+                when = time.time() + POLL
+
+            self.lock.acquire()
+            try:
+                if when:
+                    self._push(when, w)
+                else:
+                    w.done = True
+            finally:
+                self.lock.release()
+
+    def _check(self, w):
+        """ Deal with a watch that has come due, and return when it
+            should next be checked, or None if it's finished with.
+
+        """
+        now = time.time()
+        running = w.running()
+        self._collect(w)
+        if not running:
+            if not (w.on_reap and w.timeout and w.last_used):
+                return None
+            # Exited on their own; reap what's left once it's idle
+            due = w.last_used() + w.timeout
+            if due > now:
+                return max(due, now + 1)
+            logger.debug('reaping idle exited %s' % w.name)
+            w.on_reap()
+            return None
+
+        why = None
+        if w.timeout and w.last_used and w.last_used() + w.timeout < now:
+            why = 'idle'
+        elif w.owner and not w.owner.isAlive():
+            if w.orphaned is None:
+                w.orphaned = now
+            elif w.orphaned + ORPHAN_GRACE < now:
+                why = 'orphaned'
+
+        if why:
+            self.lock.acquire()
+            try:
+                self.reaped += len(running)
+                if why == 'orphaned':
+                    self.orphans += len(running)
+            finally:
+                self.lock.release()
+            logger.info('reaping %s process(es) for %s: %s' %
+                        (why, w.name, ' '.join([str(p.pid)
+                                                for p in running])))
+            if w.on_reap:
+                w.on_reap()
+            else:
+                for p in running:
+                    kill(p)
+            running = w.running()
+            self._collect(w)
+            self.log_stats()
+            if not running:
+                return None
+
+        when = now + POLL
+        if w.timeout and w.last_used:
+            when = min(when, w.last_used() + w.timeout)
+        return max(when, now + 1)
+
+    def _collect(self, w):
+        # Popen.poll() has already waited for them; just keep count
+        gone = [p for p in w.procs if p.poll() is not None]
+        for p in gone:
+            w.procs.remove(p)
+        self.lock.acquire()
+        try:
+            self.live -= len(gone)
+            self.collected += len(gone)
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        self.lock.acquire()
+        try:
+            return {'live': self.live, 'collected': self.collected,
+                    'reaped': self.reaped, 'orphans': self.orphans,
+                    'watches': len(self.heap)}
+        finally:
+            self.lock.release()
+
+    def log_stats(self):
+        logger.info(('processes: %(live)d live, %(reaped)d reaped ' +
+                     '(%(orphans)d orphans), %(collected)d collected') %
+                    self.stats())
+
+reaper = Reaper()
+
+def watch(procs, timeout=None, last_used=None, on_reap=None, owner=None,
+          name=''):
+    return reaper.watch(procs, timeout, last_used, on_reap, owner, name)
+
+def watch_child(proc, name=''):
+    """ Supervise a helper process started by the current thread. """
+    return reaper.watch([proc], owner=threading.currentThread(), name=name)
+
+def stats():
+    return reaper.stats()
+
+def shutdown():
+    reaper.shutdown()
+
+def kill(popen):
+    logger.debug('killing pid=%s' % str(popen.pid))
+    if mswindows:
+        win32kill(popen.pid)
+    else:
+        import signal
+        for i in xrange(3):
+            logger.debug('sending SIGTERM to pid: %s' % popen.pid)
+            os.kill(popen.pid, signal.SIGTERM)
+            time.sleep(.5)
+            if popen.poll() is not None:
+                logger.debug('process %s has exited' % popen.pid)
+                break
+        else:
+            while popen.poll() is None:
+                logger.debug('sending SIGKILL to pid: %s' % popen.pid)
+                os.kill(popen.pid, signal.SIGKILL)
+                time.sleep(.5)
+
+def win32kill(pid):
+    import ctypes
+    handle = ctypes.windll.kernel32.OpenProcess(1, False, pid)
+    ctypes.windll.kernel32.TerminateProcess(handle, -1)
+    ctypes.windll.kernel32.CloseHandle(handle)
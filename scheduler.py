@@ -0,0 +1,288 @@
+import logging
+import os
+import re
+import sys
+import threading
+import time
+
+import config
+
+logger = logging.getLogger('pyTivo.scheduler')
+
+LIVE, PUSH, PROBE = range(3)
+TIERS = {LIVE: 'live', PUSH: 'push', PROBE: 'probe'}
+
+NICE = {LIVE: 0, PUSH: 10, PROBE: 15}
+DOWNGRADED_NICE = 19
+WARMUP = 10  # seconds before an encoder's speed is taken seriously
+LOG_INTERVAL = 60  # seconds between progress reports in the log
+
+# ffmpeg's progress line, e.g.
+# frame= 1234 fps= 60 q=2.0 size=   12345kB time=00:00:41.23
+#   bitrate=2453.1kbits/s speed=2.01x
+PROGRESS = re.compile(r'(frame|fps|size|time|bitrate|speed)=\s*(\S+)')
+NUMBER = re.compile(r'[0-9.]+')
+
+mswindows = (sys.platform == 'win32')
+BELOW_NORMAL_PRIORITY_CLASS = 0x4000
+IDLE_PRIORITY_CLASS = 0x40
+
+try:
+    import multiprocessing
+    CORES = multiprocessing.cpu_count()
+except (ImportError, NotImplementedError):
+    CORES = 1
+
+class Busy(Exception):
+    pass
+
+class Job(object):
+    """ One admitted encoder (or probe). Holds the nice level and
+        thread limit it should run with, and its speed relative to
+        realtime, as last reported by ffmpeg.
+
+    """
+    def __init__(self, sched, priority, name, threads=0, nice=0,
+                 downgraded=False):
+        self.sched = sched
+        self.priority = priority
+        self.name = name
+        self.threads = threads
+        self.nice = nice
+        self.downgraded = downgraded
+        self.started = time.time()
+        self.speed = None
+        self.released = False
+        self.source = ''  # what's being encoded, for warnings
+        self.status = {}  # the latest of ffmpeg's progress reports
+        self.updated = None
+        self.logged = self.started
+        self.warned = False
+
+    def popen_args(self):
+        """ Extra keyword arguments for subprocess.Popen. """
+        if not self.nice:
+            return {}
+        if mswindows:
+            if self.nice >= DOWNGRADED_NICE:
+                return {'creationflags': IDLE_PRIORITY_CLASS}
+            return {'creationflags': BELOW_NORMAL_PRIORITY_CLASS}
+        nice = self.nice
+        return {'preexec_fn': lambda: os.nice(nice)}
+
+    def limit(self, cmd):
+        """ Add this job's thread limit to an ffmpeg argv. """
+        if not self.threads or '-i' not in cmd:
+            return cmd
+        i = cmd.index('-i') + 2
+        return cmd[:i] + ['-threads', str(self.threads)] + cmd[i:]
+
+    def monitor(self, stderr):
+        """ Read ffmpeg's stderr (which must be drained anyway) in the
+            background, keeping track of its progress reports.
+
+        """
+        thread = threading.Thread(target=self._read_stderr, args=(stderr,))
+        thread.setDaemon(True)
+        thread.start()
+
+    def _read_stderr(self, stderr):
+        fd = stderr.fileno()
+        pending = ''
+        try:
+            while True:
+                data = os.read(fd, 4096)
+                if not data:
+                    break
+                lines = re.split('[\r\n]', pending + data)
+                pending = lines.pop()
+                for line in lines:
+                    self.progress(line)
+        except OSError, msg:
+            logger.debug(msg)
+        if pending:
+            self.progress(pending)
+        stderr.close()
+
+    def progress(self, line):
+        """ Handle one line of ffmpeg's stderr. """
+        fields = PROGRESS.findall(line)
+        if not fields:
+            if line.strip():
+                logger.debug('%s: %s' % (self.name, line))
+            return
+        status = dict(self.status)
+        for key, value in fields:
+            if key == 'time':
+                key, value = 'out_time', parse_time(value)
+                if value is None:
+                    continue
+            else:
+                match = NUMBER.match(value)
+                try:
+                    value = float(match.group())
+                except (AttributeError, ValueError):
+                    continue
+                if key == 'frame':
+                    value = int(value)
+                elif key == 'size':
+                    key = 'out_kb'
+            status[key] = value
+        self.status = status
+        self.updated = time.time()
+        if 'speed' in status:
+            self.speed = status['speed']
+
+        if self.updated - self.logged >= LOG_INTERVAL:
+            self.logged = self.updated
+            logger.info('%s: %s' % (self.name, self.describe()))
+        if self.priority == LIVE and self.slow() and not self.warned:
+            self.warned = True
+            logger.warning('%s is running below realtime: %s; %s' %
+                           (self.name, self.describe(), self.source))
+
+    def describe(self):
+        """ The latest progress report, for the log. """
+        status = self.status
+        parts = []
+        for key, fmt in (('frame', 'frame %d'), ('fps', '%.1f fps'),
+                         ('out_time', 'at %.1f s'),
+                         ('bitrate', '%.1f kbit/s'), ('speed', '%.2fx')):
+            if key in status:
+                parts.append(fmt % status[key])
+        return ', '.join(parts) or 'no progress yet'
+
+    def stats(self):
+        """ This job's settings and latest progress. """
+        stats = {'name': self.name, 'tier': TIERS[self.priority],
+                 'threads': self.threads, 'nice': self.nice,
+                 'downgraded': self.downgraded,
+                 'elapsed': time.time() - self.started,
+                 'source': self.source}
+        stats.update(self.status)
+        return stats
+
+    def slow(self):
+        """ Whether this encoder has been measured below realtime. """
+        return (self.speed is not None and self.speed < 1.0 and
+                self.started + WARMUP < time.time())
+
+    def release(self):
+        self.sched.release(self)
+
+def parse_time(value):
+    """ Seconds from ffmpeg's HH:MM:SS.ss, or None. """
+    try:
+        seconds = 0.0
+        for part in value.split(':'):
+            seconds = seconds * 60 + float(part)
+        return seconds
+    except ValueError:
+        return None
+
+class Scheduler(object):
+    """ Admission control for encoders, by priority tier. Live playback
+        may use every transcode slot (transcode_slots, by default one
+        per core); push and pre-transcode work only gets a slot that
+        live playback isn't using, runs niced with fewer threads, and
+        is downgraded further while any live encoder is below realtime.
+        Probes are never refused, but run at the lowest priority.
+
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.jobs = []
+        self.refused = 0
+        self.downgrades = 0
+
+    def slots(self):
+        return config.getTranscodeSlots(CORES)
+
+    def _count(self, priority):
+        return len([j for j in self.jobs if j.priority == priority])
+
+    def _verdict(self, priority):
+        """ Returns (threads, nice, downgraded), or raises Busy. """
+        slots = self.slots()
+        live = self._count(LIVE)
+        push = self._count(PUSH)
+        if priority == LIVE:
+            if live >= slots:
+                raise Busy('all %d transcode slots are in use by live '
+                           'playback' % slots)
+            return 0, NICE[LIVE], False
+        if priority == PUSH:
+            if live + push >= slots:
+                raise Busy('no transcode slot free for push or '
+                           'pre-transcode (%d live, %d push, %d slots)' %
+                           (live, push, slots))
+            if [j for j in self.jobs if j.priority == LIVE and j.slow()]:
+                return 1, DOWNGRADED_NICE, True
+            return max(1, CORES / 4), NICE[PUSH], False
+        return 1, NICE[PROBE], False
+
+    def check(self, priority):
+        """ Raise Busy if a job of this priority would be refused. """
+        self.lock.acquire()
+        try:
+            self._verdict(priority)
+        finally:
+            self.lock.release()
+
+    def admit(self, priority, name):
+        """ Return a Job for new work, or raise Busy. Release the job
+            when the work is finished.
+
+        """
+        self.lock.acquire()
+        try:
+            try:
+                threads, nice, downgraded = self._verdict(priority)
+            except Busy, msg:
+                self.refused += 1
+                logger.error('Refused %s %s: %s' %
+                             (TIERS[priority], name, msg))
+                raise
+            job = Job(self, priority, name, threads, nice, downgraded)
+            self.jobs.append(job)
+            if downgraded:
+                self.downgrades += 1
+                logger.warning('Live playback is below realtime; running '
+                               '%s with 1 thread at nice %d' %
+                               (name, nice))
+            return job
+        finally:
+            self.lock.release()
+
+    def release(self, job):
+        self.lock.acquire()
+        try:
+            if not job.released:
+                job.released = True
+                self.jobs.remove(job)
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        self.lock.acquire()
+        try:
+            stats = {'cores': CORES, 'slots': self.slots(),
+                     'refused': self.refused, 'downgrades': self.downgrades}
+            for priority, tier in TIERS.items():
+                stats[tier] = self._count(priority)
+            stats['speeds'] = [(j.name, j.speed) for j in self.jobs
+                               if j.speed is not None]
+            return stats
+        finally:
+            self.lock.release()
+
+scheduler = Scheduler()
+
+def admit(priority, name):
+    return scheduler.admit(priority, name)
+
+def check(priority):
+    scheduler.check(priority)
+
+def stats():
+    return scheduler.stats()
@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+
+""" .tivo decryption without tivodecode
+
+    Reads the header and chunks of a .tivo file, decrypts the details
+    chunk (see metadata.from_tivo()), and decrypts the MPEG program
+    stream that follows, as tivodecode does. Each PES stream has its
+    own Turing keystream, keyed from the MAK, the file's key chunk,
+    the stream id and the block number carried in the packet's private
+    data. Only program streams are handled; transport stream .tivo
+    files still need tivodecode.
+
+    Run as a script, it takes tivodecode's arguments, so that it can
+    stand in for it:
+
+        tivodecrypt.py -m MAK [-o OUTFILE] INFILE|-
+
+"""
+
+import getopt
+import hashlib
+import os
+import struct
+import sys
+
+import turing
+
+READSIZE = 512 * 1024
+
+CHUNK_PLAINTEXT = 0
+CHUNK_ENCRYPTED = 1
+
+TS_FLAG = 0x20  # in byte 7 of the header
+
+# PES stream ids whose payload may be scrambled: private stream 1,
+# audio and video
+SCRAMBLED = [0xbd] + range(0xc0, 0xf0)
+
+# PES header fields that may come before the extension, by flag
+OPTIONAL = ((0x80, 5), (0x40, 5), (0x20, 6), (0x10, 3), (0x08, 1),
+            (0x04, 1), (0x02, 2))
+
+def read_header(f):
+    """ Read the header and chunks from the start of a .tivo file,
+        leaving f at the start of the MPEG data. Returns a dict with
+        'ts' (whether the stream is a transport stream), 'offset'
+        (where the MPEG data starts), and 'chunks', a list of dicts
+        with 'id', 'enc', 'data', and 'start' (the data's offset in
+        the file, which is where the Turing data for it starts).
+
+    """
+    header = f.read(16)
+    if len(header) < 16 or header[:4] != 'TiVo':
+        raise ValueError('not a .tivo file')
+    offset, count = struct.unpack('>LH', header[10:])
+    rawdata = f.read(offset - 16)
+
+    chunks = []
+    pos = 0
+    for i in xrange(count):
+        chunk_size, data_size, id, enc = struct.unpack('>LLHH',
+            rawdata[pos:pos + 12])
+        pos += 12
+        chunks.append({'id': id, 'enc': enc, 'start': pos + 16,
+                       'data': rawdata[pos:pos + data_size]})
+        pos += chunk_size - 12
+
+    return {'ts': bool(ord(header[7]) & TS_FLAG), 'offset': offset,
+            'chunks': chunks}
+
+def details(header, tivo_mak):
+    """ The details XML (chunk 2), decrypted if need be. """
+    chunks = dict([(chunk['id'], chunk) for chunk in header['chunks']])
+    chunk = chunks[2]
+    data = chunk['data']
+    if chunk['enc']:
+        xml_key = chunks[3]['data']
+
+        hexmak = hashlib.md5('tivo:TiVo DVR:' + tivo_mak).hexdigest()
+        key = hashlib.sha1(hexmak + xml_key).digest()[:16] + '\0\0\0\0'
+
+        turkey = hashlib.sha1(key[:17]).digest()
+        turiv = hashlib.sha1(key).digest()
+
+        data = turing.Turing(turkey, turiv).crypt(data, chunk['start'])
+
+    return data
+
+def _xor(a, b):
+    if not a:
+        return ''
+    x = int(a.encode('hex'), 16) ^ int(b.encode('hex'), 16)
+    return ('%0*x' % (len(a) * 2, x)).decode('hex')
+
+class Keystream(object):
+    """ The Turing keystream for one PES stream. The key depends only
+        on the stream; the IV is loaded again whenever the block number
+        changes, and otherwise each packet carries on from where the
+        last one stopped.
+
+    """
+    def __init__(self, key, stream_id):
+        self.key = key[:16] + chr(stream_id)
+        self.block = None
+        self.cipher = turing.Turing(hashlib.sha1(self.key).digest())
+        self.buf = ''
+
+    def get(self, block, length):
+        if block != self.block:
+            key = self.key + struct.pack('>L', block)[1:]
+            self.cipher.loadiv(hashlib.sha1(key).digest())
+            self.block = block
+            self.buf = ''
+        buf = self.buf
+        if len(buf) < length:
+            # whole rounds, so that nothing is skipped
+            buf += self.cipher.gen(0, (length - len(buf) + 19) // 20 * 20)
+        self.buf = buf[length:]
+        return buf[:length]
+
+def _block_no(private):
+    """ The block number from a packet's 16 bytes of PES private data
+        (tivodecode's do_header()).
+
+    """
+    b = [ord(c) for c in private[1:5]]
+    return (((b[0] & 0x3f) << 18) | (b[1] << 10) | ((b[2] & 0xc0) << 2) |
+            ((b[2] & 0x1f) << 3) | ((b[3] & 0xe0) >> 5))
+
+class Decoder(object):
+    """ Decrypts a .tivo program stream, fed in pieces of any size.
+        Pack headers and other packets are passed through as they are;
+        a scrambled PES packet whose private data carries a block
+        number has its payload decrypted and its scrambling bits
+        cleared. decode() holds back a packet that isn't complete yet,
+        until the next call or flush().
+
+    """
+    def __init__(self, header, tivo_mak):
+        if header['ts']:
+            raise ValueError('transport stream .tivo files need tivodecode')
+        plain = [chunk for chunk in header['chunks']
+                 if chunk['enc'] == CHUNK_PLAINTEXT]
+        if not plain:
+            raise ValueError('no key chunk')
+        self.key = hashlib.sha1(tivo_mak + plain[-1]['data']).digest()
+        self.streams = {}
+        self.pending = ''
+
+    def decode(self, data):
+        buf = self.pending + data
+        end = len(buf)
+        out = []
+        pos = 0
+        while True:
+            i = buf.find('\x00\x00\x01', pos)
+            if i < 0:
+                # keep what may be the start of a start code
+                i = max(pos, end - 2)
+                break
+            if i + 6 > end:
+                break
+            code = ord(buf[i + 3])
+            if code == 0xba:
+                if i + 14 > end:
+                    break
+                if ord(buf[i + 4]) >> 6 == 1:  # MPEG-2
+                    size = 14 + (ord(buf[i + 13]) & 7)
+                else:
+                    size = 12
+            elif code > 0xba:
+                size = 6 + ((ord(buf[i + 4]) << 8) | ord(buf[i + 5]))
+            else:
+                size = 4
+            if i + size > end:
+                break
+
+            out.append(buf[pos:i])
+            packet = buf[i:i + size]
+            if code in SCRAMBLED:
+                packet = self.packet(code, packet)
+            out.append(packet)
+            pos = i + size
+
+        out.append(buf[pos:i])
+        self.pending = buf[i:]
+        return ''.join(out)
+
+    def flush(self):
+        rest, self.pending = self.pending, ''
+        return rest
+
+    def packet(self, code, packet):
+        """ Decrypt one PES packet, if it's scrambled. """
+        flags1 = ord(packet[6])
+        flags2 = ord(packet[7])
+        if flags1 >> 6 != 2 or (flags1 >> 4) & 3 != 3 or not flags2 & 1:
+            return packet
+        ext = 9
+        for flag, size in OPTIONAL:
+            if flags2 & flag:
+                ext += size
+        header_len = 9 + ord(packet[8])
+        if ext + 17 > header_len or not ord(packet[ext]) & 0x80:
+            return packet
+
+        block = _block_no(packet[ext + 1:ext + 17])
+        stream = self.streams.get(code)
+        if not stream:
+            stream = self.streams[code] = Keystream(self.key, code)
+        payload = packet[header_len:]
+        # the first four bytes go to the (unused) check value
+        keys = stream.get(block, 4 + len(payload))
+        return (packet[:6] + chr(flags1 & ~0x30) + packet[7:header_len] +
+                _xor(payload, keys[4:]))
+
+def decrypt(infile, outfile, tivo_mak):
+    """ Decrypt a .tivo file, read from infile, to outfile. Returns the
+        number of bytes written.
+
+    """
+    decoder = Decoder(read_header(infile), tivo_mak)
+    count = 0
+    while True:
+        data = infile.read(READSIZE)
+        if not data:
+            break
+        data = decoder.decode(data)
+        outfile.write(data)
+        count += len(data)
+    data = decoder.flush()
+    outfile.write(data)
+    return count + len(data)
+
+def command(tivo_mak, fname='-', ts=False):
+    """ The argv to decrypt fname (or stdin) to stdout: tivodecode, if
+        there is one, or else this module, in a Python of its own so
+        as not to hold up the server. None if it can't be done: a
+        transport stream with no tivodecode, or no Python to run.
+
+    """
+    import config
+    tivodecode = config.get_bin('tivodecode')
+    if tivodecode:
+        return [tivodecode, '-m', tivo_mak, fname]
+    if ts or getattr(sys, 'frozen', False):
+        return None
+    script = os.path.splitext(os.path.abspath(__file__))[0] + '.py'
+    return [sys.executable, script, '-m', tivo_mak, fname]
+
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv, 'm:o:')
+    except getopt.GetoptError, msg:
+        sys.stderr.write('%s\n' % msg)
+        return 2
+    opts = dict(opts)
+    if '-m' not in opts or len(args) != 1:
+        sys.stderr.write('usage: tivodecrypt.py -m MAK [-o OUTFILE] '
+                         'INFILE|-\n')
+        return 2
+
+    if args[0] == '-':
+        infile = sys.stdin
+    else:
+        infile = open(args[0], 'rb')
+    if opts.get('-o', '-') == '-':
+        outfile = sys.stdout
+    else:
+        outfile = open(opts['-o'], 'wb')
+    if sys.platform == 'win32':
+        import msvcrt
+        for f in (infile, outfile):
+            msvcrt.setmode(f.fileno(), os.O_BINARY)
+
+    try:
+        decrypt(infile, outfile, opts['-m'])
+        outfile.close()
+    except (IOError, ValueError), msg:
+        sys.stderr.write('tivodecrypt: %s\n' % msg)
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))